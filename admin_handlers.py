@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import threading
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import CallbackContext, ConversationHandler
-from database import Database
-from config import ADMIN_IDS
+from database import get_database
+from analytics import get_funnel_text
+from send_queue import queue_send, PRIORITY_BROADCAST
+from waitlist import notify_slot_offers
+from ai_providers import ai_router
+from circuit_breaker import CLOSED, OPEN, HALF_OPEN
+from update_tracing import get_profiling_sample_rate, set_profiling_sample_rate
+from query_stats import query_stats, explain_query_plan
+from config import ADMIN_IDS, QUERY_STATS_CONFIG
 
 logger = logging.getLogger(__name__)
 
@@ -15,7 +23,7 @@ ADMIN_BROADCAST = 3
 ADMIN_SET_API_KEY = 4
 ADMIN_EDIT_TEXT = 5
 
-db = Database()
+db = get_database()
 
 def admin_panel(update: Update, context: CallbackContext):
     """Show admin panel"""
@@ -24,7 +32,8 @@ def admin_panel(update: Update, context: CallbackContext):
     if user_id not in ADMIN_IDS:
         return
     
-    if hasattr(update, 'callback_query'):
+    # Also opened with /admin, where there is no callback query
+    if update.callback_query:
         query = update.callback_query
         query.answer()
         message_func = query.edit_message_text
@@ -38,11 +47,41 @@ def admin_panel(update: Update, context: CallbackContext):
         [InlineKeyboardButton("📢 ارسال پیام همگانی", callback_data='admin_broadcast')],
         [InlineKeyboardButton("🔑 تنظیم کلید API", callback_data='admin_api_key')],
         [InlineKeyboardButton("📊 آمار ربات", callback_data='admin_stats')],
+        [InlineKeyboardButton("🩺 پروفایلینگ", callback_data='admin_profiling')],
         [InlineKeyboardButton("🔙 بازگشت", callback_data='back_to_main')]
     ]
     
+    snapshots = [(provider.name, provider.circuit.snapshot()) for provider in ai_router.providers]
+    if any(snapshot[0] != CLOSED for _, snapshot in snapshots):
+        keyboard.insert(-1, [InlineKeyboardButton("🔄 وصل کردن دوباره سرویس طراحی", callback_data='admin_ai_reset')])
+    
+    # Named per provider only when there are several
+    status = "\n".join(
+        ai_circuit_status_text(name if len(snapshots) > 1 else None, *snapshot) for name, snapshot in snapshots
+    )
     reply_markup = InlineKeyboardMarkup(keyboard)
-    message_func("👑 پنل مدیریت\n\nیکی از گزینه‌های زیر را انتخاب کنید:", reply_markup=reply_markup)
+    message_func(
+        f"👑 پنل مدیریت\n\n{status}\n\nیکی از گزینه‌های زیر را انتخاب کنید:",
+        reply_markup=reply_markup
+    )
+
+def ai_circuit_status_text(name, state, failures, retry_in, timeout):
+    """One line on an AI provider's circuit breaker for the admin panel"""
+    label = f"🤖 سرویس طراحی {name}" if name else "🤖 سرویس طراحی"
+    if state == OPEN:
+        return f"{label}: ⛔ قطع ({failures} خطای پیاپی، تلاش دوباره تا {retry_in:.0f} ثانیه دیگر)"
+    if state == HALF_OPEN:
+        return f"{label}: 🔶 در حال بررسی بازگشت سرویس"
+    return f"{label}: ✅ فعال (مهلت پاسخ {timeout:.0f} ثانیه)"
+
+def admin_ai_reset(update: Update, context: CallbackContext):
+    """Close the AI providers' circuits, e.g. after fixing the API key"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    for provider in ai_router.providers:
+        provider.circuit.reset()
+    admin_panel(update, context)
 
 def admin_slots_menu(update: Update, context: CallbackContext):
     """Show slots management menu"""
@@ -76,7 +115,8 @@ def admin_add_slot_process(update: Update, context: CallbackContext):
     slot_text = update.message.text
     
     try:
-        db.add_slot(slot_text)
+        # A user on the waitlist may get the new slot right away
+        notify_slot_offers(context.bot, [db.add_slot(slot_text)])
         update.message.reply_text(
             f"✅ زمان جدید با موفقیت اضافه شد:\n{slot_text}",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data='admin_slots')]])
@@ -143,7 +183,7 @@ def admin_delete_slot_confirm(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     
-    slot_id = int(query.data.split('_')[2])
+    slot_id, = context.callback_args
     
     try:
         db.delete_slot(slot_id)
@@ -169,7 +209,7 @@ def admin_settings_menu(update: Update, context: CallbackContext):
         [InlineKeyboardButton("👤 صاحب حساب", callback_data='edit_card_owner')],
         [InlineKeyboardButton("💰 مبلغ بیعانه", callback_data='edit_deposit_amount')],
         [InlineKeyboardButton("📞 اطلاعات تماس", callback_data='edit_contact_info')],
-        [InlineKeyboardButton("📢 کانال اجباری", callback_data='edit_force_channel')],
+        [InlineKeyboardButton("📢 کانال اجباری", callback_data='edit_force_join_channel')],
         [InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')]
     ]
     
@@ -181,7 +221,7 @@ def admin_edit_setting_start(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     
-    setting_key = query.data.replace('edit_', '')
+    setting_key, = context.callback_args
     context.user_data['editing_setting'] = setting_key
     
     # Get current value
@@ -193,7 +233,7 @@ def admin_edit_setting_start(update: Update, context: CallbackContext):
         'card_owner': 'صاحب حساب',
         'deposit_amount': 'مبلغ بیعانه (تومان)',
         'contact_info': 'اطلاعات تماس',
-        'force_channel': 'کانال اجباری (@ همراه نام کانال)'
+        'force_join_channel': 'کانال اجباری (@ همراه نام کانال)'
     }
     
     setting_name = setting_names.get(setting_key, setting_key)
@@ -223,7 +263,7 @@ def admin_edit_setting_process(update: Update, context: CallbackContext):
             'card_owner': 'صاحب حساب',
             'deposit_amount': 'مبلغ بیعانه',
             'contact_info': 'اطلاعات تماس',
-            'force_channel': 'کانال اجباری'
+            'force_join_channel': 'کانال اجباری'
         }
         
         setting_name = setting_names.get(setting_key, setting_key)
@@ -269,26 +309,29 @@ def admin_broadcast_process(update: Update, context: CallbackContext):
     
     # Send progress message
     progress_msg = update.message.reply_text("در حال ارسال پیام...")
+    results = {'sent': 0, 'failed': 0}
+    results_lock = threading.Lock()
+    
+    def report(future):
+        with results_lock:
+            results['failed' if future.exception() else 'sent'] += 1
+            if results['sent'] + results['failed'] < len(users):
+                return
+        
+        # Update progress message with results once every message went out or failed
+        queue_send(
+            context.bot.edit_message_text, progress_msg.chat_id,
+            message_id=progress_msg.message_id,
+            text=f"📊 نتایج ارسال پیام همگانی:\n\n"
+                 f"✅ ارسال شده: {results['sent']}\n"
+                 f"❌ ناموفق: {results['failed']}\n"
+                 f"📊 کل: {len(users)}",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')]])
+        )
     
-    sent_count = 0
-    failed_count = 0
-    
+    # Queued behind receipts and notifications, paced under Telegram's limits
     for user_id in users:
-        try:
-            context.bot.send_message(chat_id=user_id, text=message_text)
-            sent_count += 1
-        except Exception as e:
-            logger.error(f"Failed to send broadcast to {user_id}: {e}")
-            failed_count += 1
-    
-    # Update progress message with results
-    progress_msg.edit_text(
-        f"📊 نتایج ارسال پیام همگانی:\n\n"
-        f"✅ ارسال شده: {sent_count}\n"
-        f"❌ ناموفق: {failed_count}\n"
-        f"📊 کل: {len(users)}",
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')]])
-    )
+        queue_send(context.bot.send_message, user_id, PRIORITY_BROADCAST, text=message_text).add_done_callback(report)
     
     return ConversationHandler.END
 
@@ -326,6 +369,14 @@ def admin_api_key_process(update: Update, context: CallbackContext):
     
     return ConversationHandler.END
 
+MAINTENANCE_TASK_NAMES = {
+    'backup': 'پشتیبان‌گیری',
+    'analyze': 'ANALYZE',
+    'optimize': 'PRAGMA optimize',
+    'vacuum': 'VACUUM',
+    'incremental_vacuum': 'آزادسازی فضا'
+}
+
 def admin_stats(update: Update, context: CallbackContext):
     """Show bot statistics"""
     query = update.callback_query
@@ -335,18 +386,8 @@ def admin_stats(update: Update, context: CallbackContext):
         users_count = len(db.get_all_users())
         available_slots = len(db.get_available_slots())
         
-        # Get pending reservations count
-        import sqlite3
-        conn = sqlite3.connect(db.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT COUNT(*) FROM reservations WHERE status = 'pending'")
-        pending_reservations = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM reservations WHERE status = 'confirmed'")
-        confirmed_reservations = cursor.fetchone()[0]
-        
-        conn.close()
+        pending_reservations = db.count_reservations('pending')
+        confirmed_reservations = db.count_reservations('confirmed')
         
         stats_text = f"""📊 آمار ربات
 
@@ -355,6 +396,16 @@ def admin_stats(update: Update, context: CallbackContext):
 ⏳ رزروهای در انتظار: {pending_reservations}
 ✅ رزروهای تایید شده: {confirmed_reservations}"""
         
+        funnel = get_funnel_text()
+        if funnel:
+            stats_text += "\n\n📈 قیف طراحی تا رزرو (کاربران):\n" + "\n".join(funnel)
+        
+        maintenance = db.get_last_maintenance()
+        if maintenance:
+            stats_text += "\n\n🛠 آخرین نگهداری پایگاه داده:"
+            for task, duration_ms, detail, finished_at in maintenance:
+                stats_text += f"\n• {MAINTENANCE_TASK_NAMES.get(task, task)}: {duration_ms / 1000:.1f} ثانیه ({finished_at})"
+        
         query.edit_message_text(
             stats_text,
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')]])
@@ -367,6 +418,66 @@ def admin_stats(update: Update, context: CallbackContext):
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')]])
         )
 
+def admin_query_stats(update: Update, context: CallbackContext):
+    """/queries: show the SQL statements with the most total time and their query plans"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+
+    if not QUERY_STATS_CONFIG['enabled']:
+        update.message.reply_text("ℹ️ ثبت آمار کوئری‌ها غیرفعال است (QUERY_STATS_CONFIG).")
+        return
+
+    top = query_stats.top(QUERY_STATS_CONFIG['top_n'])
+    if not top:
+        update.message.reply_text("هنوز کوئری‌ای ثبت نشده است.")
+        return
+
+    parts = ["🗄 پرهزینه‌ترین کوئری‌ها"]
+    for sql, count, total, p99, slow in top:
+        plan = '\n'.join(f"  {line}" for line in explain_query_plan(db.db_name, sql))
+        parts.append(
+            f"{sql[:300]}\n"
+            f"count={count} total={total * 1000:.1f}ms p99={p99 * 1000:.1f}ms slow={slow}"
+            + (f"\n{plan}" if plan else '')
+        )
+
+    # Stay under Telegram's 4096 character message limit
+    update.message.reply_text('\n\n'.join(parts)[:4000])
+
+# Sample rates offered in the profiling menu, in percent
+PROFILING_RATES = (0, 1, 5, 25, 100)
+
+def admin_profiling_menu(update: Update, context: CallbackContext):
+    """Show and switch the cProfile sampling rate for slow updates"""
+    query = update.callback_query
+    if update.effective_user.id not in ADMIN_IDS:
+        query.answer()
+        return
+    query.answer()
+
+    current = round(get_profiling_sample_rate() * 100)
+    keyboard = [[
+        InlineKeyboardButton(f"{'✅ ' if rate == current else ''}{rate}%", callback_data=f'admin_profiling_set_{rate}')
+        for rate in PROFILING_RATES
+    ]]
+    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')])
+
+    text = f"""🩺 پروفایلینگ
+
+درصد درخواست‌هایی که با cProfile بررسی می‌شوند: {current}%
+گزارش درخواست‌های کند در لاگ ربات ثبت می‌شود."""
+    query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+def admin_profiling_set(update: Update, context: CallbackContext):
+    """Change the profiling sample rate"""
+    if update.effective_user.id not in ADMIN_IDS:
+        update.callback_query.answer()
+        return
+
+    rate, = context.callback_args
+    set_profiling_sample_rate(rate / 100)
+    admin_profiling_menu(update, context)
+
 def admin_text_management(update: Update, context: CallbackContext):
     """Show comprehensive text management menu"""
     query = update.callback_query
@@ -429,6 +540,9 @@ def admin_booking_messages(update: Update, context: CallbackContext):
         [InlineKeyboardButton("✅ رزرو تایید شد", callback_data='edit_text_booking_confirmed')],
         [InlineKeyboardButton("❌ رزرو رد شد", callback_data='edit_text_booking_rejected')],
         [InlineKeyboardButton("💰 انتخاب با تخفیف", callback_data='edit_text_booking_discount_select')],
+        [InlineKeyboardButton("🔔 ثبت در لیست انتظار", callback_data='edit_text_booking_waitlist_joined')],
+        [InlineKeyboardButton("🔕 خروج از لیست انتظار", callback_data='edit_text_booking_waitlist_left')],
+        [InlineKeyboardButton("🔔 پیشنهاد زمان آزاد شده", callback_data='edit_text_booking_waitlist_offer')],
         [InlineKeyboardButton("🔙 بازگشت", callback_data='admin_text_management')]
     ]
     
@@ -446,6 +560,10 @@ def admin_button_texts(update: Update, context: CallbackContext):
         [InlineKeyboardButton("📞 دکمه تماس", callback_data='edit_text_button_contact')],
         [InlineKeyboardButton("👑 دکمه پنل ادمین", callback_data='edit_text_button_admin_panel')],
         [InlineKeyboardButton("💰 دکمه رزرو با تخفیف", callback_data='edit_text_booking_discount_button')],
+        [InlineKeyboardButton("🔔 دکمه لیست انتظار (بازه)", callback_data='edit_text_booking_waitlist_days_button')],
+        [InlineKeyboardButton("🔔 دکمه لیست انتظار (هر زمانی)", callback_data='edit_text_booking_waitlist_any_button')],
+        [InlineKeyboardButton("🔕 دکمه خروج از لیست انتظار", callback_data='edit_text_booking_waitlist_leave_button')],
+        [InlineKeyboardButton("📅 دکمه رزرو زمان پیشنهادی", callback_data='edit_text_booking_waitlist_offer_button')],
         [InlineKeyboardButton("🔙 دکمه بازگشت", callback_data='edit_text_back_button')],
         [InlineKeyboardButton("❌ دکمه لغو", callback_data='edit_text_cancel_button')],
         [InlineKeyboardButton("✅ دکمه تایید ادمین", callback_data='edit_text_admin_approve_button')],
@@ -461,7 +579,7 @@ def admin_edit_text_start(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     
-    setting_key = query.data.replace('edit_text_', '')
+    setting_key, = context.callback_args
     context.user_data['editing_text'] = setting_key
     
     # Get current value
@@ -489,6 +607,9 @@ def admin_edit_text_start(update: Update, context: CallbackContext):
         'booking_confirmed': 'رزرو تایید شد',
         'booking_rejected': 'رزرو رد شد',
         'booking_discount_select': 'انتخاب با تخفیف',
+        'booking_waitlist_joined': 'ثبت در لیست انتظار',
+        'booking_waitlist_left': 'خروج از لیست انتظار',
+        'booking_waitlist_offer': 'پیشنهاد زمان آزاد شده',
         
         # Button texts
         'button_ai_design': 'دکمه طراحی',
@@ -496,6 +617,10 @@ def admin_edit_text_start(update: Update, context: CallbackContext):
         'button_contact': 'دکمه تماس',
         'button_admin_panel': 'دکمه پنل ادمین',
         'booking_discount_button': 'دکمه رزرو با تخفیف',
+        'booking_waitlist_days_button': 'دکمه لیست انتظار (بازه)',
+        'booking_waitlist_any_button': 'دکمه لیست انتظار (هر زمانی)',
+        'booking_waitlist_leave_button': 'دکمه خروج از لیست انتظار',
+        'booking_waitlist_offer_button': 'دکمه رزرو زمان پیشنهادی',
         'back_button': 'دکمه بازگشت',
         'cancel_button': 'دکمه لغو',
         'admin_approve_button': 'دکمه تایید ادمین',
@@ -545,6 +670,9 @@ def admin_edit_text_process(update: Update, context: CallbackContext):
             'booking_confirmed': 'رزرو تایید شد',
             'booking_rejected': 'رزرو رد شد',
             'booking_discount_select': 'انتخاب با تخفیف',
+            'booking_waitlist_joined': 'ثبت در لیست انتظار',
+            'booking_waitlist_left': 'خروج از لیست انتظار',
+            'booking_waitlist_offer': 'پیشنهاد زمان آزاد شده',
             
             # Button texts
             'button_ai_design': 'دکمه طراحی',
@@ -552,6 +680,10 @@ def admin_edit_text_process(update: Update, context: CallbackContext):
             'button_contact': 'دکمه تماس',
             'button_admin_panel': 'دکمه پنل ادمین',
             'booking_discount_button': 'دکمه رزرو با تخفیف',
+            'booking_waitlist_days_button': 'دکمه لیست انتظار (بازه)',
+            'booking_waitlist_any_button': 'دکمه لیست انتظار (هر زمانی)',
+            'booking_waitlist_leave_button': 'دکمه خروج از لیست انتظار',
+            'booking_waitlist_offer_button': 'دکمه رزرو زمان پیشنهادی',
             'back_button': 'دکمه بازگشت',
             'cancel_button': 'دکمه لغو',
             'admin_approve_button': 'دکمه تایید ادمین',
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import logging
+import requests
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from circuit_breaker import CircuitBreaker
+from database import get_database
+from metrics import AI_REQUEST_DURATION, AI_RESPONSES_TOTAL, AI_COST_TOTAL, AI_HEDGES_TOTAL
+from config import AI_API_CONFIG, AI_CIRCUIT_CONFIG, AI_PROVIDERS_CONFIG
+
+logger = logging.getLogger(__name__)
+
+class ProviderError(Exception):
+    """A provider failed to generate an image; status is the bot_ai_responses_total label.
+
+    outage is False for errors that say nothing about the provider's health,
+    such as a rejected prompt or a missing API key, so they don't count
+    towards opening its circuit.
+    """
+
+    def __init__(self, status, message='', outage=True):
+        super().__init__(message or status)
+        self.status = status
+        self.outage = outage
+
+class AIProvider(ABC):
+    """A text-to-image backend with its own circuit breaker, timeouts and cost.
+
+    Subclasses implement generate(); generate_image() adds the circuit
+    breaker and the metrics around it.
+    """
+
+    def __init__(self, name, weight=1, api_key='', api_key_setting='ai_api_key', timeout_seconds=0, cost_per_image=0.0):
+        self.name = name
+        self.weight = weight
+        self.cost_per_image = cost_per_image
+        self._api_key = api_key
+        self.api_key_setting = api_key_setting
+        self.circuit = CircuitBreaker(
+            name, max_timeout_seconds=timeout_seconds or AI_API_CONFIG['timeout_seconds'], **AI_CIRCUIT_CONFIG
+        )
+
+    @property
+    def api_key(self):
+        return self._api_key or get_database().get_setting(self.api_key_setting)
+
+    @abstractmethod
+    def generate(self, prompt, timeout):
+        """Return the image bytes for prompt or raise ProviderError"""
+
+    def generate_image(self, prompt):
+        if not self.circuit.allow():
+            AI_RESPONSES_TOTAL.inc(provider=self.name, status='circuit_open')
+            raise ProviderError('circuit_open', f"{self.name} circuit is open", outage=False)
+
+        started = time.monotonic()
+        try:
+            with AI_REQUEST_DURATION.time(provider=self.name):
+                image = self.generate(prompt, self.circuit.timeout())
+        except ProviderError as e:
+            AI_RESPONSES_TOTAL.inc(provider=self.name, status=e.status)
+            if e.status == 'timeout':
+                self.circuit.record_timeout(time.monotonic() - started)
+            elif e.outage:
+                self.circuit.record_failure()
+            else:
+                # Says nothing about the provider's health; a half-open probe just makes way for the next one
+                self.circuit.release_probe()
+            raise
+        except Exception as e:
+            AI_RESPONSES_TOTAL.inc(provider=self.name, status='error')
+            self.circuit.record_failure()
+            raise ProviderError('error', str(e)) from e
+
+        AI_RESPONSES_TOTAL.inc(provider=self.name, status='200')
+        AI_COST_TOTAL.inc(self.cost_per_image, provider=self.name)
+        self.circuit.record_success(time.monotonic() - started)
+        return image
+
+class ClipDropProvider(AIProvider):
+    """ClipDrop text-to-image, or a server speaking its protocol such as benchmarks/fake_clipdrop.py"""
+
+    def __init__(self, name, api_url='', width=512, height=512, max_connections=None, **kwargs):
+        super().__init__(name, **kwargs)
+        self.api_url = api_url or AI_API_CONFIG['api_url']
+        self.width = width
+        self.height = height
+        # Keep-alive connections, one per concurrent request
+        pool_size = max_connections or AI_API_CONFIG['max_parallel_requests']
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=pool_size))
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=pool_size))
+
+    def generate(self, prompt, timeout):
+        api_key = self.api_key
+        if not api_key:
+            raise ProviderError('no_api_key', f"{self.name} API key not set", outage=False)
+
+        try:
+            response = self.session.post(
+                self.api_url,
+                headers={'x-api-key': api_key},
+                data={'prompt': prompt, 'width': self.width, 'height': self.height},
+                timeout=timeout
+            )
+        except requests.exceptions.Timeout:
+            raise ProviderError('timeout', f"{self.name} timed out after {timeout:.1f}s")
+        except requests.exceptions.ConnectionError as e:
+            raise ProviderError('connection_error', f"{self.name} connection error: {e}")
+
+        if response.status_code == 200:
+            return response.content
+        # Rate limiting and server errors mean the provider is in trouble, other errors are about this request
+        raise ProviderError(
+            str(response.status_code), f"{self.name} error: {response.status_code}, {response.text}",
+            outage=response.status_code == 429 or response.status_code >= 500
+        )
+
+# Provider classes by the 'type' of AI_PROVIDERS_CONFIG entries
+PROVIDER_TYPES = {
+    'clipdrop': ClipDropProvider
+}
+
+def build_provider(options):
+    options = dict(options)
+    return PROVIDER_TYPES[options.pop('type')](**options)
+
+class AIRouter:
+    """Send each image request to a provider picked by weight, failing over to the others.
+
+    Providers with an open circuit are skipped. With hedging, when the
+    provider asked first has not answered by its hedge_percentile latency,
+    the next one is asked too and the first image to arrive is used; the
+    slower request still finishes in the background and is paid for.
+    """
+
+    def __init__(self, providers, hedging=True, hedge_percentile=0.95, hedge_min_delay_seconds=1.0, max_hedges=1,
+                 seed=None):
+        self.providers = providers
+        self.hedging = hedging
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay_seconds
+        self.max_hedges = max_hedges
+        self._rng = random.Random(seed)
+        # Callers already run on ai_executor; hedged requests need threads of their own
+        self._executor = ThreadPoolExecutor(
+            max_workers=AI_API_CONFIG['max_parallel_requests'] * (1 + max_hedges), thread_name_prefix='ai_provider'
+        )
+
+    def available(self):
+        """Whether any provider would take a request now"""
+        return any(provider.circuit.available() for provider in self.providers)
+
+    def _order(self):
+        """Providers in the order to try them: a weighted random permutation, weight 0 last"""
+        def key(provider):
+            return self._rng.random() ** (1.0 / provider.weight) if provider.weight > 0 else -1
+        return sorted((provider for provider in self.providers if provider.circuit.available()), key=key, reverse=True)
+
+    def _hedge_delay(self, provider):
+        latency = provider.circuit.percentile(self.hedge_percentile)
+        return None if latency is None else max(self.hedge_min_delay, latency)
+
+    def generate_image(self, prompt):
+        """Return image bytes from the first provider that delivers, or raise the last ProviderError"""
+        candidates = self._order()
+        if not candidates:
+            raise ProviderError('circuit_open', "No AI provider available", outage=False)
+
+        in_flight = {}
+        hedges = 0
+        error = None
+        while True:
+            if not in_flight:
+                if not candidates:
+                    raise error
+                provider = candidates.pop(0)
+                in_flight[self._executor.submit(provider.generate_image, prompt)] = provider
+                started = time.monotonic()
+
+            # The provider asked last decides when to hedge; with its latency still unknown there is no hedging
+            timeout = None
+            if self.hedging and candidates and hedges < self.max_hedges:
+                hedge_delay = self._hedge_delay(provider)
+                if hedge_delay is not None:
+                    timeout = max(0, started + hedge_delay - time.monotonic())
+
+            done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                hedges += 1
+                logger.info(f"{provider.name} slower than {hedge_delay:.1f}s, also asking {candidates[0].name}")
+                provider = candidates.pop(0)
+                AI_HEDGES_TOTAL.inc(provider=provider.name)
+                in_flight[self._executor.submit(provider.generate_image, prompt)] = provider
+                started = time.monotonic()
+                continue
+
+            for future in done:
+                finished = in_flight.pop(future)
+                try:
+                    image = future.result()
+                except ProviderError as e:
+                    logger.error(f"AI provider {finished.name} failed: {e}")
+                    error = e
+                    continue
+                if len(self.providers) > 1:
+                    logger.info(f"Image generated by {finished.name}")
+                return image
+
+ai_router = AIRouter(
+    [build_provider(options) for options in AI_PROVIDERS_CONFIG['providers']],
+    hedging=AI_PROVIDERS_CONFIG['hedging'],
+    hedge_percentile=AI_PROVIDERS_CONFIG['hedge_percentile'],
+    hedge_min_delay_seconds=AI_PROVIDERS_CONFIG['hedge_min_delay_seconds'],
+    max_hedges=AI_PROVIDERS_CONFIG['max_hedges']
+)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from datetime import datetime
+from config import ANALYTICS_CONFIG
+from database import get_database
+
+logger = logging.getLogger(__name__)
+
+# Funnel steps in order, with their stats screen labels
+FUNNEL_STEPS = (
+    ('ai_design_open', 'باز کردن طراح'),
+    ('ai_design_image', 'دریافت طرح'),
+    ('discount_tap', 'رزرو با تخفیف'),
+    ('booking_confirmed', 'رزرو تایید شده')
+)
+
+class EventBuffer:
+    """Collect funnel events in memory, append them in batches and roll them up.
+
+    A background thread flushes every flush_interval_ms, or as soon as
+    max_batch_rows events are pending. After each write the new events are
+    added to the event_daily aggregates, so reading the funnel never scans
+    raw events.
+    """
+
+    def __init__(self, db, flush_interval_ms=2000, max_batch_rows=500):
+        self.db = db
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_batch_rows = max_batch_rows
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def record(self, event, user_id):
+        """Queue an event; returns immediately"""
+        # Same format as CURRENT_TIMESTAMP, so date() groups by UTC day
+        row = (event, user_id, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+        with self._lock:
+            self._pending.append(row)
+            pending_count = len(self._pending)
+
+            if self._thread is None and not self._stopped:
+                self._thread = threading.Thread(target=self._run, name='event_buffer', daemon=True)
+                self._thread.start()
+
+        if pending_count >= self.max_batch_rows:
+            self._wakeup.set()
+
+    @property
+    def pending(self):
+        """Number of events waiting to be written"""
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Write pending events in one transaction and roll them up"""
+        with self._lock:
+            batch = self._pending
+            self._pending = []
+
+        if batch:
+            try:
+                self.db.insert_events(batch)
+            except Exception as e:
+                logger.error(f"Error flushing {len(batch)} buffered events: {e}")
+                with self._lock:
+                    # Keep the original order for the retry on the next flush
+                    self._pending[:0] = batch
+                return 0
+
+        try:
+            # Also picks up events written by other processes
+            self.db.rollup_events()
+        except Exception as e:
+            logger.error(f"Error rolling up events: {e}")
+        return len(batch)
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def stop(self):
+        """Stop the background thread and write whatever is still pending"""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        self.flush()
+
+event_buffer = EventBuffer(
+    get_database(),
+    flush_interval_ms=ANALYTICS_CONFIG['flush_interval_ms'],
+    max_batch_rows=ANALYTICS_CONFIG['max_batch_rows']
+)
+
+def record_event(event, user_id):
+    """Record a funnel event for the user, when analytics are enabled"""
+    if ANALYTICS_CONFIG['enabled']:
+        event_buffer.record(event, user_id)
+
+def get_funnel_text(weeks=None):
+    """Stats screen lines: one per week with each step's users and its conversion from the previous step"""
+    weeks = weeks or ANALYTICS_CONFIG['funnel_weeks']
+    funnel = get_database().get_funnel([event for event, _ in FUNNEL_STEPS], weeks)
+    lines = []
+    for week, counts in funnel.items():
+        steps = []
+        previous = None
+        for event, label in FUNNEL_STEPS:
+            users = counts.get(event, (0, 0))[1]
+            conversion = f" ({users * 100 // previous}٪)" if previous else ''
+            steps.append(f"{label} {users}{conversion}")
+            previous = users
+        lines.append(f"هفته {week}: " + ' ← '.join(steps))
+    return lines
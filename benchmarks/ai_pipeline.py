@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""Measure end-to-end AI design throughput and tail latency against the fake ClipDrop server.
+
+Each design is a user opening the AI design conversation and sending a
+description, handled by the real handlers up to the generated photo being
+sent. Latency, errors, 429s and timeouts are injected by FakeClipDropServer;
+--timeout-rate 1 simulates ClipDrop being down:
+
+    python -m benchmarks.ai_pipeline --designs 100 --threads 8 --latency lognormal:500:0.5 \\
+        --error-rate 0.05 --rate-limit-rate 0.05 --timeout-rate 0.02 --client-timeout 2
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import config
+
+from benchmarks.fake_clipdrop import FakeClipDropServer
+from benchmarks.fake_telegram import make_callback_update, make_text_update
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def _report(name, latencies, wall_time):
+    ordered = sorted(latencies)
+    print(f"{name:8s} {len(ordered):6d} {len(ordered) / wall_time:8.2f} "
+          f"{_percentile(ordered, 0.50) * 1000:9.0f} {_percentile(ordered, 0.95) * 1000:9.0f} "
+          f"{_percentile(ordered, 0.99) * 1000:9.0f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--designs', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=8, help='designs requested concurrently')
+    parser.add_argument('--latency', default='lognormal:500:0.5', help="fixed:MS, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--timeout-rate', type=float, default=0.0)
+    parser.add_argument('--variants', type=int, default=1, help="AI_API_CONFIG['variants'] for the run")
+    parser.add_argument('--client-timeout', type=float, default=5.0, help="AI_API_CONFIG['timeout_seconds'] for the run")
+    parser.add_argument('--no-circuit', action='store_true', help='disable the circuit breaker and adaptive timeout')
+    parser.add_argument('--dir', default=None, help='directory for the temporary database (default: system temp)')
+    args = parser.parse_args()
+
+    server = FakeClipDropServer(
+        latency=args.latency, error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+        timeout_rate=args.timeout_rate, hang_seconds=args.client_timeout * 2, seed=7
+    ).start()
+    config.AI_API_CONFIG['api_url'] = server.url
+    config.AI_API_CONFIG['timeout_seconds'] = args.client_timeout
+    config.AI_API_CONFIG['variants'] = args.variants
+    if args.no_circuit:
+        config.AI_CIRCUIT_CONFIG['failure_threshold'] = config.AI_CIRCUIT_CONFIG['min_samples'] = float('inf')
+        config.AI_CIRCUIT_CONFIG['slow_call_seconds'] = float('inf')
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        config.DATABASE_NAME = os.path.join(tmp_dir, 'ai.db')
+        from database import get_database, get_user_write_buffer
+        from metrics import AI_RESPONSES_TOTAL
+        from handlers import ai_executor
+        from image_processing import image_executor
+        from benchmarks.handler_load import LoadRun, build_dispatcher
+
+        get_database().set_setting('ai_api_key', 'benchmark')
+        dispatcher = build_dispatcher()
+        # Injected failures are expected, don't log each one
+        logging.getLogger('handlers').setLevel(logging.CRITICAL)
+        load = LoadRun(dispatcher)
+        started_at = {}
+        handler_latencies = {}
+        lock = threading.Lock()
+        user_ids = list(range(200001, 200001 + args.designs))
+
+        def worker(index):
+            for user_id in user_ids[index::args.threads]:
+                load.send('browse', make_callback_update(load.next_id(), user_id, 'ai_design'))
+                started = time.perf_counter()
+                load.send('design', make_text_update(load.next_id(), user_id, f'dragon and rose #{user_id}'))
+                with lock:
+                    started_at[user_id] = started
+                    handler_latencies[user_id] = time.perf_counter() - started
+
+        workers = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        # Designs finish in the background after the handler returns
+        ai_executor.shutdown(wait=True)
+        image_executor.shutdown(wait=True)
+        wall_time = time.perf_counter() - started
+        get_user_write_buffer().stop()
+
+    server.stop()
+
+    photos = {}
+    first_photos = {}
+    uploaded = 0
+    for sent_at, method, params in dispatcher.bot.request.calls:
+        if method == 'sendPhoto':
+            files = [params['photo']]
+        elif method == 'sendMediaGroup':
+            files = [media.media for media in params['media']]
+        else:
+            continue
+        photos[int(params['chat_id'])] = sent_at
+        # With several variants the first one is previewed before the album
+        first_photos.setdefault(int(params['chat_id']), sent_at)
+        uploaded += sum(len(getattr(photo, 'input_file_content', b'')) for photo in files)
+    time_to_photo = [sent_at - started_at[chat_id] for chat_id, sent_at in photos.items()]
+    time_to_first = [sent_at - started_at[chat_id] for chat_id, sent_at in first_photos.items()]
+
+    print(f"{args.designs} designs, {args.threads} threads, {wall_time:.2f}s, {server.requests} ClipDrop requests")
+    print(f"{'latency':8s} {'count':>6s} {'per sec':>8s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s}")
+    _report('handler', handler_latencies.values(), wall_time)
+    _report('first', time_to_first, wall_time)
+    _report('photo', time_to_photo, wall_time)
+    _report('failed', [latency for user_id, latency in handler_latencies.items() if user_id not in photos], wall_time)
+
+    statuses = ('200', '429', '500', 'timeout', 'connection_error', 'error', 'circuit_open')
+    print('responses: ' + ', '.join(f"{status}={int(AI_RESPONSES_TOTAL.value(provider='clipdrop', status=status))}" for status in statuses))
+    if photos:
+        print(f"uploaded {uploaded / len(photos) / 1024:.0f} KiB per design message")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""Measure image latency across two AI providers with and without hedging, and failover when one is down.
+
+Both providers are FakeClipDropServers with the same long-tailed latency;
+--down makes the first one hang on every request instead:
+
+    python -m benchmarks.ai_providers --requests 200 --threads 8 --latency lognormal:500:0.6
+    python -m benchmarks.ai_providers --requests 200 --down
+"""
+
+import argparse
+import logging
+import threading
+import time
+
+import config
+
+from benchmarks.fake_clipdrop import FakeClipDropServer
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def _run(router, count, threads):
+    """Generate count images from threads callers; returns (latencies of successes, failures)"""
+    from ai_providers import ProviderError
+
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+
+    def worker(index):
+        for _ in range(index, count, threads):
+            started = time.perf_counter()
+            try:
+                router.generate_image('dragon and rose')
+            except ProviderError:
+                with lock:
+                    failures[0] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return latencies, failures[0]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--latency', default='lognormal:500:0.6', help="fixed:MS, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA")
+    parser.add_argument('--down', action='store_true', help='the first provider times out on every request')
+    parser.add_argument('--client-timeout', type=float, default=5.0)
+    parser.add_argument('--cost', type=float, default=0.02, help='cost_per_image of each provider')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    servers = [
+        FakeClipDropServer(latency=args.latency, timeout_rate=1.0 if args.down else 0.0,
+                           hang_seconds=args.client_timeout * 2, seed=1).start(),
+        FakeClipDropServer(latency=args.latency, seed=2).start()
+    ]
+    from ai_providers import AIRouter, ClipDropProvider
+    from metrics import AI_COST_TOTAL, AI_HEDGES_TOTAL, AI_RESPONSES_TOTAL
+
+    print(f"{args.requests} images, {args.threads} threads, latency {args.latency}" + (", primary down" if args.down else ''))
+    print(f"{'mode':10s} {'ok':>5s} {'failed':>6s} {'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s} {'requests':>9s} {'hedges':>7s} {'cost':>7s}")
+    for hedging in (False, True):
+        names = [f"{'hedged' if hedging else 'single'}_{index}" for index in range(len(servers))]
+        providers = [
+            ClipDropProvider(name, api_url=server.url, api_key='benchmark', weight=weight, cost_per_image=args.cost,
+                             timeout_seconds=args.client_timeout)
+            for name, server, weight in zip(names, servers, (1, 0))
+        ]
+        router = AIRouter(providers, hedging=hedging, **{
+            key: config.AI_PROVIDERS_CONFIG[key] for key in ('hedge_percentile', 'hedge_min_delay_seconds', 'max_hedges')
+        }, seed=7)
+        if not args.down:
+            # Latency percentiles to hedge by, as a running bot has them
+            for provider in providers:
+                for _ in range(config.AI_CIRCUIT_CONFIG['min_samples']):
+                    provider.generate_image('warm up')
+        requests_before = sum(server.requests for server in servers)
+        cost_before = sum(AI_COST_TOTAL.value(provider=name) for name in names)
+
+        latencies, failures = _run(router, args.requests, args.threads)
+        # Let the losing hedged requests finish so their cost is counted
+        router._executor.shutdown(wait=True)
+        ordered = sorted(latencies)
+        requests_made = sum(server.requests for server in servers) - requests_before
+        hedges = sum(AI_HEDGES_TOTAL.value(provider=name) for name in names)
+        cost = sum(AI_COST_TOTAL.value(provider=name) for name in names) - cost_before
+        print(f"{'hedged' if hedging else 'single':10s} {len(ordered):5d} {failures:6d} "
+              f"{_percentile(ordered, 0.50) * 1000:8.0f} {_percentile(ordered, 0.95) * 1000:8.0f} "
+              f"{_percentile(ordered, 0.99) * 1000:8.0f} {requests_made:9d} {int(hedges):7d} {cost:7.2f}")
+        if args.down:
+            print('           ' + ', '.join(
+                f"{name}: " + ' '.join(f"{status}={int(AI_RESPONSES_TOTAL.value(provider=name, status=status))}"
+                                       for status in ('200', 'timeout', 'circuit_open'))
+                for name in names
+            ))
+
+    for server in servers:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""Compare finding the handler for a callback query with the regex chain and with the CallbackRouter.
+
+Every button's callback_data is checked against the handlers in
+registration order, as the dispatcher does for group 0:
+
+    python -m benchmarks.callback_dispatch --rounds 2000
+"""
+
+import argparse
+import logging
+import time
+
+from telegram import Bot, Update
+from telegram.ext import CallbackQueryHandler, ConversationHandler
+
+from benchmarks.fake_telegram import make_callback_update
+from callback_router import Payload, encode_callback
+
+# Patterns of the CallbackQueryHandlers the router replaced, in the order they were registered
+LEGACY_PATTERNS = (
+    'ai_design', r'^book_(slot|discount)_\d+$', 'admin_add_slot', 'edit_.*', 'admin_broadcast', 'admin_api_key',
+    'edit_text_.*',
+    r'^(book_appointment|contact|book_appointment_discount(_\d+)?|back_to_main|book_discount_.*)$',
+    '^(approve_reservation_|reject_reservation_).*', 'admin_panel', 'admin_slots', 'admin_view_slots',
+    'admin_delete_slots', 'delete_slot_.*', 'admin_settings', 'admin_stats', 'admin_text_management',
+    'admin_main_messages', 'admin_ai_messages', 'admin_booking_messages', 'admin_button_texts',
+    r'^admin_profiling$', r'^admin_profiling_set_\d+$'
+)
+
+CALLBACK_DATA = (
+    'ai_design', 'book_appointment', 'contact', 'back_to_main', 'book_slot_12', 'book_discount_12',
+    'book_appointment_discount', 'book_appointment_discount_3', 'approve_reservation_981', 'reject_reservation_981',
+    'admin_panel', 'admin_slots', 'admin_add_slot', 'admin_view_slots', 'admin_delete_slots', 'delete_slot_12',
+    'admin_settings', 'edit_card_number', 'admin_text_management', 'admin_main_messages', 'edit_text_welcome_message',
+    'admin_button_texts', 'admin_stats', 'admin_broadcast', 'admin_api_key', 'admin_profiling', 'admin_profiling_set_25'
+)
+
+def _first_match(handlers, update):
+    for handler in handlers:
+        check = handler.check_update(update)
+        if check is not None and check is not False:
+            return handler
+    return None
+
+def _time(handlers, updates, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for update in updates:
+            _first_match(handlers, update)
+    return (time.perf_counter() - started) / (rounds * len(updates)) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+
+    from benchmarks.handler_load import build_dispatcher
+    import main as bot_main
+
+    logging.getLogger().setLevel(logging.WARNING)
+    bot = Bot('123456:ABCDEF')
+    updates = [Update.de_json(make_callback_update(i + 1, 1000 + i, data), bot) for i, data in enumerate(CALLBACK_DATA)]
+
+    noop = lambda update, context: None
+    legacy = [CallbackQueryHandler(noop, pattern=pattern) for pattern in LEGACY_PATTERNS]
+
+    router = bot_main.build_callback_router()
+    conversation_routes = (('ai_design',), ('book_slot', 'book_discount'), ('admin_add_slot',), ('edit',),
+                           ('admin_broadcast',), ('admin_api_key',), ('edit_text',))
+    routed = [router.handler(*actions, callback=noop) for actions in conversation_routes] + [router.handler()]
+
+    dispatcher = build_dispatcher()
+    full = dispatcher.handlers[0]
+    conversations = sum(isinstance(handler, ConversationHandler) for handler in full)
+
+    print(f"{len(updates)} callback_data values, {args.rounds} rounds")
+    print(f"regex chain ({len(legacy)} handlers):        {_time(legacy, updates, args.rounds):6.2f} µs per callback")
+    print(f"router ({len(routed)} handlers):              {_time(routed, updates, args.rounds):6.2f} µs per callback")
+    compact = [Update.de_json(make_callback_update(i + 1, 1000 + i, data), bot) for i, data in enumerate((
+        encode_callback('book_slot', 12), encode_callback('book_discount', 12, Payload({'variant': 2})),
+        encode_callback('book_appointment_discount', Payload({'variant': 2, 'description': 'koi fish'})),
+        encode_callback('approve_reservation', 981), encode_callback('reject_reservation', 981)
+    ))]
+    print(f"router, compact data ({len(compact)} values):  {_time(routed, compact, args.rounds):6.2f} µs per callback")
+    print(f"full group 0 ({conversations} conversations + router): {_time(full, updates, args.rounds):6.2f} µs per callback")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""Local stand-in for the ClipDrop text-to-image API with latency and failure injection.
+
+Speaks the same protocol as AI_API_CONFIG['api_url']: a POST with an
+x-api-key header and prompt/width/height form fields, answered with a PNG.
+Point the bot at it by setting AI_API_CONFIG['api_url'] to its url, or run
+it standalone:
+
+    python -m benchmarks.fake_clipdrop --port 8765 --latency lognormal:2000:0.4 --error-rate 0.02
+"""
+
+import argparse
+import io
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from PIL import Image, ImageDraw
+
+def parse_latency(spec):
+    """Turn 'fixed:MS', 'uniform:LOW_MS:HIGH_MS' or 'lognormal:MEDIAN_MS:SIGMA' into a sampler returning seconds"""
+    kind, *params = spec.split(':')
+    params = [float(param) for param in params]
+    if kind == 'fixed':
+        return lambda rng: params[0] / 1000
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(params[0], params[1]) / 1000
+    if kind == 'lognormal':
+        median, sigma = params
+        return lambda rng: median * rng.lognormvariate(0, sigma) / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+def render_design(width, height, seed=7):
+    """PNG resembling a generated tattoo design: shaded strokes over a grainy gradient.
+
+    The grain keeps PNG sizes in the range of real generated images.
+    """
+    rng = random.Random(seed)
+    gradient = Image.linear_gradient('L').resize((width, height))
+    grain = Image.frombytes('L', (width, height), rng.randbytes(width * height))
+    image = Image.blend(gradient, grain, 0.15).convert('RGB')
+
+    draw = ImageDraw.Draw(image)
+    for _ in range(60):
+        box = sorted(rng.randrange(width) for _ in range(2)) + sorted(rng.randrange(height) for _ in range(2))
+        shade = rng.randrange(0, 90)
+        draw.arc((box[0], box[2], box[1], box[3]), rng.randrange(360), rng.randrange(360),
+                 fill=(shade, shade, shade), width=rng.randrange(1, 6))
+
+    output = io.BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
+
+class FakeClipDropServer:
+    """Answer text-to-image requests with generated PNGs after an injected delay.
+
+    Each request independently fails with a 500 (error_rate), is rate limited
+    with a 429 (rate_limit_rate) or hangs for hang_seconds before answering
+    (timeout_rate), so clients with a shorter timeout see a timeout.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency='fixed:0', error_rate=0.0,
+                 rate_limit_rate=0.0, timeout_rate=0.0, hang_seconds=60.0, seed=None):
+        self.sample_latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.timeout_rate = timeout_rate
+        self.hang_seconds = hang_seconds
+        self.requests = 0
+        self._rng = random.Random(seed)
+        self._images = {}
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/text-to-image/v1"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _image(self, width, height):
+        with self._lock:
+            png = self._images.get((width, height))
+        if png is None:
+            png = render_design(width, height)
+            with self._lock:
+                self._images[(width, height)] = png
+        return png
+
+    def _outcome(self):
+        """Draw the injected outcome and delay of one request"""
+        with self._lock:
+            self.requests += 1
+            roll = self._rng.random()
+            delay = self.sample_latency(self._rng)
+        if roll < self.timeout_rate:
+            return 'timeout', self.hang_seconds
+        roll -= self.timeout_rate
+        if roll < self.rate_limit_rate:
+            return 'rate_limited', delay
+        roll -= self.rate_limit_rate
+        if roll < self.error_rate:
+            return 'error', delay
+        return 'ok', delay
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, body, content_type='application/json', headers=None):
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                    for name, value in (headers or {}).items():
+                        self.send_header(name, value)
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up first, as intended for injected timeouts
+                    pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                form = parse_qs(self.rfile.read(length).decode('utf-8')) if length else {}
+
+                if not self.headers.get('x-api-key'):
+                    self._reply(401, b'{"error": "Missing x-api-key header"}')
+                    return
+                if not form.get('prompt'):
+                    self._reply(400, b'{"error": "prompt is required"}')
+                    return
+
+                outcome, delay = server._outcome()
+                time.sleep(delay)
+
+                if outcome == 'rate_limited':
+                    self._reply(429, b'{"error": "Too many requests"}', headers={'Retry-After': '1'})
+                elif outcome == 'error':
+                    self._reply(500, b'{"error": "Internal server error"}')
+                else:
+                    width = int(form.get('width', ['1024'])[0])
+                    height = int(form.get('height', ['1024'])[0])
+                    self._reply(200, server._image(width, height), content_type='image/png')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', default='lognormal:2000:0.4', help="fixed:MS, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--timeout-rate', type=float, default=0.0)
+    parser.add_argument('--hang-seconds', type=float, default=60.0)
+    args = parser.parse_args()
+
+    server = FakeClipDropServer(
+        args.host, args.port, latency=args.latency, error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate, timeout_rate=args.timeout_rate, hang_seconds=args.hang_seconds
+    )
+    print(f"Fake ClipDrop listening on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
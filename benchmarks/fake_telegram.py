@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""Minimal local stand-in for the Telegram Bot API used by the benchmarks"""
+
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telegram.utils.request import Request
+
+BOT_USER = {'id': 1000000001, 'is_bot': True, 'first_name': 'TattooBot', 'username': 'tattoo_test_bot'}
+
+def api_result(method, params, next_message_id):
+    """Result a Bot API method returns for the given parameters"""
+    if method == 'getMe':
+        return BOT_USER
+    if method in ('setWebhook', 'deleteWebhook', 'answerCallbackQuery', 'deleteMessage'):
+        return True
+    if method == 'getChatMember':
+        return {'status': 'member', 'user': {'id': int(params.get('user_id') or 0), 'is_bot': False, 'first_name': 'User'}}
+
+    chat_id = params.get('chat_id')
+    if method == 'sendMediaGroup':
+        return [api_result('sendPhoto', params, next_message_id) for _ in params.get('media', [])]
+    return {
+        'message_id': next_message_id(),
+        'date': int(time.time()),
+        'chat': {'id': int(chat_id) if chat_id else 0, 'type': 'private'},
+        'from': BOT_USER,
+        'text': params.get('text', '')
+    }
+
+class RecordingRequest(Request):
+    """In-process replacement for the HTTP layer of a Bot: answers like the Bot API and records calls"""
+
+    # PTB warns about new attributes on its objects, slots avoid that
+    __slots__ = ('calls', '_message_id', '_lock')
+
+    def __init__(self):
+        super().__init__(con_pool_size=1)
+        self.calls = []
+        self._message_id = 0
+        self._lock = threading.Lock()
+
+    def _next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def post(self, url, data=None, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        params = data or {}
+        self.calls.append((time.perf_counter(), method, params))
+        return api_result(method, params, self._next_message_id)
+
+    def retrieve(self, url, timeout=None):
+        return b''
+
+class FakeTelegramServer:
+    """Serve getUpdates/setWebhook/sendMessage locally and record outgoing calls"""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.pending_updates = queue.Queue()
+        self.replies = queue.Queue()
+        self.calls = []
+        self._message_id = 0
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def push_update(self, update):
+        """Queue an update for the next getUpdates long poll"""
+        self.pending_updates.put(update)
+
+    def _next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def _handle(self, method, params):
+        self.calls.append(method)
+
+        if method == 'getUpdates':
+            timeout = float(params.get('timeout') or 0)
+            try:
+                return [self.pending_updates.get(timeout=timeout)]
+            except queue.Empty:
+                return []
+
+        result = api_result(method, params, self._next_message_id)
+        if isinstance(result, dict) and 'message_id' in result:
+            self.replies.put((time.perf_counter(), method, params.get('chat_id')))
+        return result
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                try:
+                    params = json.loads(body) if body else {}
+                except ValueError:
+                    params = {}
+
+                payload = json.dumps({'ok': True, 'result': server._handle(method, params)}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+def make_command_update(update_id, user_id, text='/start'):
+    """Build a raw private-chat command update as Telegram would deliver it"""
+    command_length = len(text.split()[0])
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': f'User{user_id}'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': command_length}]
+        }
+    }
+
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+def _chat(user_id):
+    return {'id': user_id, 'type': 'private', 'first_name': f'User{user_id}'}
+
+def make_callback_update(update_id, user_id, data, caption=None):
+    """Build a raw callback query update for a button under an earlier bot message"""
+    message = {'message_id': update_id, 'date': int(time.time()), 'chat': _chat(user_id), 'from': BOT_USER}
+    if caption is None:
+        message['text'] = 'menu'
+    else:
+        message['caption'] = caption
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': _user(user_id),
+            'message': message,
+            'chat_instance': str(user_id),
+            'data': data
+        }
+    }
+
+def make_photo_update(update_id, user_id, file_id='receipt'):
+    """Build a raw private-chat photo message update"""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': _chat(user_id),
+            'from': _user(user_id),
+            'photo': [
+                {'file_id': f'{file_id}_small', 'file_unique_id': f'{file_id}_s', 'width': 90, 'height': 160},
+                {'file_id': file_id, 'file_unique_id': f'{file_id}_l', 'width': 720, 'height': 1280}
+            ]
+        }
+    }
+
+def make_text_update(update_id, user_id, text):
+    """Build a raw private-chat text message update"""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': _chat(user_id),
+            'from': _user(user_id),
+            'text': text
+        }
+    }
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+"""Drive the real handlers with synthetic updates and report throughput and latency per flow.
+
+Runs fully offline: updates go through a Dispatcher with the bot's handlers
+registered, Bot API calls are answered in-process by RecordingRequest and the
+database is a seeded temporary SQLite file.
+
+    python -m benchmarks.handler_load --users 200 --threads 8
+    python -m benchmarks.handler_load --save-baseline baseline.json
+    python -m benchmarks.handler_load --baseline baseline.json --tolerance 0.25
+
+With --baseline the exit status is 1 when any flow's p95 latency or
+throughput is worse than the baseline by more than the tolerance.
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+from itertools import count
+
+import config
+
+from callback_router import encode_callback
+
+from benchmarks.fake_telegram import (
+    RecordingRequest, make_callback_update, make_command_update, make_photo_update
+)
+
+FLOWS = ('start', 'browse', 'booking', 'approval', 'admin')
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+class LoadRun:
+    """Per-flow update latencies of one benchmark run"""
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.update_ids = count(1)
+        self.latencies = {flow: [] for flow in FLOWS}
+        self._lock = threading.Lock()
+
+    def send(self, flow, raw_update):
+        from telegram import Update
+
+        update = Update.de_json(raw_update, self.dispatcher.bot)
+        started = time.perf_counter()
+        self.dispatcher.process_update(update)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies.setdefault(flow, []).append(elapsed)
+
+    def next_id(self):
+        with self._lock:
+            return next(self.update_ids)
+
+    def run_user(self, user_id, slot_id, approvals):
+        """One user's journey: /start, browse the menus, book a slot and upload a receipt"""
+        self.send('start', make_command_update(self.next_id(), user_id))
+
+        for data in ('book_appointment', 'contact', 'back_to_main'):
+            self.send('browse', make_callback_update(self.next_id(), user_id, data))
+
+        self.send('booking', make_callback_update(self.next_id(), user_id, encode_callback('book_slot', slot_id)))
+        self.send('booking', make_photo_update(self.next_id(), user_id, file_id=f'receipt{user_id}'))
+
+        reservation_id = self.dispatcher.user_data[user_id].get('current_reservation_id')
+        if reservation_id:
+            approvals.put(reservation_id)
+
+    def run_admin(self, admin_id, approvals, users_done):
+        """Admin opening the panel and stats, then approving or rejecting each receipt as it arrives"""
+        handled = 0
+        while True:
+            try:
+                reservation_id = approvals.get(timeout=0.05)
+            except queue.Empty:
+                if users_done.is_set() and approvals.empty():
+                    return
+                continue
+
+            for data in ('admin_panel', 'admin_stats', 'admin_view_slots'):
+                self.send('admin', make_callback_update(self.next_id(), admin_id, data))
+
+            action = 'approve' if handled % 2 == 0 else 'reject'
+            handled += 1
+            self.send('approval', make_callback_update(
+                self.next_id(), admin_id, encode_callback(f'{action}_reservation', reservation_id), caption='receipt'
+            ))
+
+    def summary(self, wall_time):
+        results = {}
+        for flow in FLOWS:
+            ordered = sorted(self.latencies[flow])
+            if not ordered:
+                continue
+            results[flow] = {
+                'updates': len(ordered),
+                'updates_per_sec': len(ordered) / wall_time,
+                'p50_ms': _percentile(ordered, 0.50) * 1000,
+                'p95_ms': _percentile(ordered, 0.95) * 1000,
+                'p99_ms': _percentile(ordered, 0.99) * 1000
+            }
+        return results
+
+def build_dispatcher():
+    """Dispatcher with the bot's handlers and SQLite persistence whose Bot API calls are answered in-process"""
+    from telegram import Bot
+    from telegram.ext import Dispatcher
+    from persistence import SQLitePersistence
+    import main
+
+    bot = Bot('123456:ABCDEF', request=RecordingRequest())
+    dispatcher = Dispatcher(bot, queue.Queue(), workers=1, persistence=SQLitePersistence())
+    main.register_handlers(dispatcher)
+    # main configures INFO logging on import, keep the report readable
+    logging.getLogger().setLevel(logging.WARNING)
+    return dispatcher
+
+def run(users, threads):
+    from database import get_database, get_user_write_buffer
+
+    db = get_database()
+    for i in range(users):
+        db.add_slot(f'Slot {i + 1}')
+    slot_ids = [slot_id for slot_id, _ in db.get_available_slots()]
+
+    dispatcher = build_dispatcher()
+    load = LoadRun(dispatcher)
+    approvals = queue.Queue()
+    users_done = threading.Event()
+    user_ids = list(range(100001, 100001 + users))
+
+    def worker(index):
+        for user_id, slot_id in list(zip(user_ids, slot_ids))[index::threads]:
+            load.run_user(user_id, slot_id, approvals)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    admin = threading.Thread(target=load.run_admin, args=(config.ADMIN_IDS[0], approvals, users_done))
+
+    started = time.perf_counter()
+    admin.start()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    users_done.set()
+    admin.join()
+    wall_time = time.perf_counter() - started
+
+    get_user_write_buffer().stop()
+    return load.summary(wall_time), wall_time, len(dispatcher.bot.request.calls)
+
+def check_regressions(results, baseline, tolerance):
+    """Return a description of every flow that got worse than the baseline by more than tolerance"""
+    failures = []
+    for flow, expected in baseline.items():
+        actual = results.get(flow)
+        if actual is None:
+            failures.append(f"{flow}: missing from this run")
+            continue
+        if actual['p95_ms'] > expected['p95_ms'] * (1 + tolerance):
+            failures.append(f"{flow}: p95 {actual['p95_ms']:.2f}ms > baseline {expected['p95_ms']:.2f}ms")
+        if actual['updates_per_sec'] < expected['updates_per_sec'] * (1 - tolerance):
+            failures.append(
+                f"{flow}: {actual['updates_per_sec']:.0f} updates/s < baseline {expected['updates_per_sec']:.0f}"
+            )
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200, help='users each running a full booking journey')
+    parser.add_argument('--threads', type=int, default=8, help='users handled concurrently')
+    parser.add_argument('--dir', default=None, help='directory for the temporary database (default: system temp)')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression')
+    parser.add_argument('--save-baseline', help='write this run\'s results as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        config.DATABASE_NAME = os.path.join(tmp_dir, 'load.db')
+        results, wall_time, api_calls = run(args.users, args.threads)
+
+    print(f"{args.users} users, {args.threads} threads, {wall_time:.2f}s, {api_calls} Bot API calls")
+    print(f"{'flow':10s} {'updates':>8s} {'upd/s':>8s} {'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s}")
+    for flow, row in results.items():
+        print(f"{flow:10s} {row['updates']:8d} {row['updates_per_sec']:8.0f} "
+              f"{row['p50_ms']:8.2f} {row['p95_ms']:8.2f} {row['p99_ms']:8.2f}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failures = check_regressions(results, baseline, args.tolerance)
+        for failure in failures:
+            print(f"REGRESSION {failure}")
+        if failures:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+if __name__ == '__main__':
+    main()
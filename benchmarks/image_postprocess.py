@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+"""Compare bytes uploaded and time-to-photo of generated designs per IMAGE_CONFIG format.
+
+Time-to-photo is the post-processing time plus the upload time of the
+result over a link of the given speed:
+
+    python -m benchmarks.image_postprocess --size 1024 --uplink-kbps 2000 --watermark "@tattoo_studio"
+"""
+
+import argparse
+import time
+
+import config
+
+from benchmarks.fake_clipdrop import render_design
+
+VARIANTS = (
+    ('png (as generated)', {'format': 'png', 'strip_metadata': False}),
+    ('png (re-encoded)', {'format': 'png', 'strip_metadata': True}),
+    ('jpeg', {'format': 'jpeg'}),
+    ('webp', {'format': 'webp'})
+)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1024, help='width and height of the generated design')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--uplink-kbps', type=float, default=2000, help='upload speed used for time-to-photo')
+    parser.add_argument('--quality', type=int, default=config.IMAGE_CONFIG['quality'])
+    parser.add_argument('--watermark', default='', help='watermark text, none by default')
+    args = parser.parse_args()
+
+    from image_processing import postprocess_image
+
+    original = render_design(args.size, args.size)
+    config.IMAGE_CONFIG.update(quality=args.quality, watermark_text=args.watermark)
+
+    print(f"{args.size}x{args.size} design, {len(original) / 1024:.0f} KiB PNG, uplink {args.uplink_kbps:.0f} kbit/s")
+    print(f"{'variant':20s} {'KiB':>8s} {'process ms':>11s} {'upload ms':>10s} {'to photo ms':>12s}")
+    for name, overrides in VARIANTS:
+        config.IMAGE_CONFIG.update(overrides)
+        timings = []
+        for _ in range(args.iterations):
+            started = time.perf_counter()
+            data, _ = postprocess_image(original)
+            timings.append(time.perf_counter() - started)
+
+        process_ms = sorted(timings)[len(timings) // 2] * 1000
+        upload_ms = len(data) * 8 / args.uplink_kbps
+        print(f"{name:20s} {len(data) / 1024:8.0f} {process_ms:11.1f} {upload_ms:10.0f} {process_ms + upload_ms:12.0f}")
+
+if __name__ == '__main__':
+    main()
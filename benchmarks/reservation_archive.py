@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""Measure get_expired_reservations before and after archiving a large reservations table.
+
+Seeds a database with mostly old confirmed/rejected reservations and a few
+recent pending ones, as after years of operation, then archives:
+
+    python -m benchmarks.reservation_archive --rows 1000000 --pending 50 --dir .
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import config
+
+def _seed(db_name, rows, pending, seed=7):
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    conn = sqlite3.connect(db_name)
+    conn.execute('INSERT INTO slots (slot_text, is_available) VALUES (?, 0)', ('seeded',))
+
+    def finished():
+        # Spread over the year before the archive cutoff and the weeks after it
+        for i in range(rows - pending):
+            created = now - timedelta(days=400 - i * 390 / rows)
+            yield (rng.randrange(1, 100000), 1, rng.choice(('confirmed', 'rejected')), f'receipt{i}',
+                   created, created.strftime('%Y-%m-%d %H:%M:%S'))
+
+    conn.executemany('''
+        INSERT INTO reservations (user_id, slot_id, status, receipt_photo_id, pending_time, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', finished())
+    # Recent pending reservations, some past the timeout
+    conn.executemany('''
+        INSERT INTO reservations (user_id, slot_id, status, pending_time)
+        VALUES (?, 1, 'pending', ?)
+    ''', [(rng.randrange(1, 100000), datetime.now() - timedelta(minutes=rng.randrange(240))) for _ in range(pending)])
+    conn.commit()
+    conn.close()
+
+def _time_expired(db, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        expired = db.get_expired_reservations(config.SCHEDULER_CONFIG['reservation_timeout_minutes'])
+        timings.append(time.perf_counter() - started)
+    ordered = sorted(timings)
+    return len(expired), ordered[len(ordered) // 2] * 1000, ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--pending', type=int, default=50)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=config.ARCHIVE_CONFIG['batch_size'])
+    parser.add_argument('--dir', default=None, help='directory for the temporary database (default: system temp)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        config.DATABASE_NAME = os.path.join(tmp_dir, 'archive.db')
+        from database import Database, database_writer
+
+        db = Database(config.DATABASE_NAME)
+        started = time.perf_counter()
+        _seed(config.DATABASE_NAME, args.rows, args.pending)
+        print(f"seeded {args.rows} reservations in {time.perf_counter() - started:.1f}s")
+
+        expired, p50, p95 = _time_expired(db, args.iterations)
+        print(f"before: get_expired_reservations p50 {p50:8.2f}ms  p95 {p95:8.2f}ms  ({expired} expired)")
+
+        started = time.perf_counter()
+        moved = db.archive_reservations(batch_size=args.batch_size)
+        elapsed = time.perf_counter() - started
+        print(f"archived {moved} rows in {elapsed:.1f}s ({moved / elapsed:.0f} rows/s, batches of {args.batch_size})")
+
+        expired, p50, p95 = _time_expired(db, args.iterations)
+        print(f"after:  get_expired_reservations p50 {p50:8.2f}ms  p95 {p95:8.2f}ms  ({expired} expired)")
+        print(f"confirmed across both tables: {db.count_reservations('confirmed')}")
+        database_writer.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+"""Compare blocking and non-blocking AI design handling under many concurrent conversations.
+
+A burst of users send design descriptions while other users keep sending
+/start. With DISPATCH_CONFIG['nonblocking_ai'] disabled every design holds
+an update worker for the whole ClipDrop call, so /start waits behind them;
+enabled, the handler returns at once and the design finishes in the
+background. Each mode runs in its own process:
+
+    python -m benchmarks.runtime_modes --designs 1000 --probes 200 --workers 8 --latency lognormal:1000:0.3
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import config
+
+from benchmarks.fake_clipdrop import FakeClipDropServer
+from benchmarks.fake_telegram import make_callback_update, make_command_update, make_text_update
+
+MODES = ('blocking', 'nonblocking')
+
+def _percentiles(values):
+    ordered = sorted(values)
+    if not ordered:
+        return '-'
+    return ' '.join(f"p{int(q * 100)}={ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000:.0f}ms"
+                    for q in (0.5, 0.95, 0.99))
+
+def run_mode(args):
+    config.DISPATCH_CONFIG['nonblocking_ai'] = args.mode == 'nonblocking'
+    config.AI_API_CONFIG['max_parallel_requests'] = args.ai_parallel
+    server = FakeClipDropServer(latency=args.latency, seed=7).start()
+    config.AI_API_CONFIG['api_url'] = server.url
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        config.DATABASE_NAME = os.path.join(tmp_dir, 'modes.db')
+        from telegram import Update
+        from concurrency import ChatOrderedExecutor
+        from database import get_database, get_user_write_buffer, database_writer
+        from handlers import ai_executor
+        from image_processing import image_executor
+        from benchmarks.handler_load import build_dispatcher
+
+        get_database().set_setting('ai_api_key', 'benchmark')
+        dispatcher = build_dispatcher()
+        executor = ChatOrderedExecutor(args.workers)
+        probe_latencies = []
+        submitted_at = {}
+        lock = threading.Lock()
+
+        def submit(raw_update, user_id, on_done=None):
+            update = Update.de_json(raw_update, dispatcher.bot)
+            queued = time.perf_counter()
+
+            def task():
+                dispatcher.process_update(update)
+                if on_done:
+                    on_done(time.perf_counter() - queued)
+            executor.submit(user_id, task)
+            return queued
+
+        design_users = list(range(300001, 300001 + args.designs))
+        for user_id in design_users:
+            submit(make_callback_update(user_id, user_id, 'ai_design'), user_id)
+        executor.wait_idle()
+
+        def record_probe(latency):
+            with lock:
+                probe_latencies.append(latency)
+
+        started = time.perf_counter()
+        for user_id in design_users:
+            submitted_at[user_id] = submit(make_text_update(user_id, user_id, f'koi fish #{user_id}'), user_id)
+        for probe in range(args.probes):
+            user_id = 400001 + probe
+            submit(make_command_update(user_id, user_id), user_id, record_probe)
+            time.sleep(args.probe_interval_ms / 1000)
+
+        executor.wait_idle()
+        ai_executor.shutdown(wait=True)
+        image_executor.shutdown(wait=True)
+        wall_time = time.perf_counter() - started
+        get_user_write_buffer().stop()
+        database_writer.stop()
+        executor.shutdown()
+
+    server.stop()
+    photos = {int(params['chat_id']): sent_at for sent_at, method, params in dispatcher.bot.request.calls
+              if method == 'sendPhoto'}
+    time_to_photo = [sent_at - submitted_at[chat_id] for chat_id, sent_at in photos.items()]
+
+    print(f"{args.mode:12s} wall {wall_time:6.2f}s  designs {len(photos)}/{args.designs}")
+    print(f"{'':12s} /start latency  {_percentiles(probe_latencies)}")
+    print(f"{'':12s} time to photo   {_percentiles(time_to_photo)}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=MODES, help='run a single mode in this process')
+    parser.add_argument('--designs', type=int, default=500, help='users requesting a design at once')
+    parser.add_argument('--probes', type=int, default=200, help='/start updates sent during the burst')
+    parser.add_argument('--probe-interval-ms', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=config.DISPATCH_CONFIG['workers'], help='update worker threads')
+    parser.add_argument('--ai-parallel', type=int, default=64, help="AI_API_CONFIG['max_parallel_requests']")
+    parser.add_argument('--latency', default='lognormal:1000:0.3', help='fake ClipDrop latency distribution')
+    parser.add_argument('--dir', default=None, help='directory for the temporary database (default: system temp)')
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args)
+        return
+
+    forwarded = [arg for arg in sys.argv[1:]]
+    for mode in MODES:
+        subprocess.run([sys.executable, '-m', 'benchmarks.runtime_modes', '--mode', mode] + forwarded, check=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""Compare sending a broadcast and concurrent notifications directly and through the SendQueue.
+
+A fake Bot API answers after --latency-ms and raises RetryAfter like
+Telegram's flood control: more than 30 messages in a second overall, or
+more than about one a second to one chat. Notifications to --chats chats are
+sent from other threads while the broadcast runs:
+
+    python -m benchmarks.send_queue --users 300 --notifications 60
+"""
+
+import argparse
+import logging
+import random
+import statistics
+import threading
+import time
+from collections import deque
+
+from telegram.error import RetryAfter
+
+from send_queue import SendQueue, PRIORITY_BROADCAST
+import config
+
+class FloodLimitedApi:
+    """send_message(chat_id, text) that enforces Telegram-like flood limits"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._recent = deque()
+        self._per_chat = {}
+        self.flood_errors = 0
+        self.delivered = 0
+
+    def send_message(self, chat_id, text):
+        time.sleep(self.latency)
+        with self._lock:
+            now = time.monotonic()
+            while self._recent and self._recent[0] < now - 1:
+                self._recent.popleft()
+            chat = self._per_chat.setdefault(chat_id, deque())
+            # A little under a second, so the scheduling jitter of 1/s sends is tolerated
+            while chat and chat[0] < now - 0.9:
+                chat.popleft()
+            if len(self._recent) >= 30 or chat:
+                self.flood_errors += 1
+                raise RetryAfter(1)
+            self._recent.append(now)
+            chat.append(now)
+            self.delivered += 1
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+def _notify(send, chats, count, latencies, seed=3):
+    """Send count notifications at random moments over ~5 seconds, recording time until delivered"""
+    rng = random.Random(seed)
+    threads = []
+    for _ in range(count):
+        chat_id = rng.choice(chats)
+
+        def notify(chat_id=chat_id, delay=rng.uniform(0, 5)):
+            time.sleep(delay)
+            started = time.monotonic()
+            if send(chat_id):
+                latencies.append(time.monotonic() - started)
+        threads.append(threading.Thread(target=notify))
+    for thread in threads:
+        thread.start()
+    return threads
+
+def run_direct(api, users, chats, notifications):
+    def send(chat_id):
+        try:
+            api.send_message(chat_id=chat_id, text='notification')
+            return True
+        except RetryAfter:
+            return False
+
+    latencies = []
+    threads = _notify(send, chats, notifications, latencies)
+    started = time.monotonic()
+    for user_id in users:
+        try:
+            api.send_message(chat_id=user_id, text='broadcast')
+        except RetryAfter:
+            pass
+    broadcast_seconds = time.monotonic() - started
+    for thread in threads:
+        thread.join()
+    return broadcast_seconds, latencies
+
+def run_queued(api, users, chats, notifications):
+    queue = SendQueue(**{
+        key: value for key, value in config.SEND_QUEUE_CONFIG.items() if key not in ('enabled', 'drain_timeout_seconds')
+    })
+
+    def send(chat_id):
+        return queue.submit(api.send_message, chat_id, text='notification').exception() is None
+
+    latencies = []
+    threads = _notify(send, chats, notifications, latencies)
+    started = time.monotonic()
+    futures = [queue.submit(api.send_message, user_id, PRIORITY_BROADCAST, text='broadcast') for user_id in users]
+    for future in futures:
+        future.exception()
+    broadcast_seconds = time.monotonic() - started
+    for thread in threads:
+        thread.join()
+    queue.stop()
+    return broadcast_seconds, latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--notifications', type=int, default=60)
+    parser.add_argument('--chats', type=int, default=20, help='distinct chats receiving notifications')
+    parser.add_argument('--latency-ms', type=float, default=20)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    users = list(range(1, args.users + 1))
+    chats = list(range(10 ** 6, 10 ** 6 + args.chats))
+    total = args.users + args.notifications
+
+    for name, run in (('direct', run_direct), ('queued', run_queued)):
+        api = FloodLimitedApi(args.latency_ms / 1000)
+        broadcast_seconds, latencies = run(api, users, chats, args.notifications)
+        print(f"{name}: delivered {api.delivered}/{total}  flood errors {api.flood_errors:4d}  "
+              f"broadcast {broadcast_seconds:5.1f}s  notification p50 {statistics.median(latencies or [0]) * 1000:6.0f}ms "
+              f"p95 {_percentile(latencies, 0.95) * 1000:6.0f}ms ({len(latencies)} delivered)")
+
+if __name__ == '__main__':
+    main()
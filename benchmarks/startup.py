@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""Measure database setup cost at bot startup and per scheduler tick.
+
+Counts and times every schema initialization triggered while the bot's
+modules are imported, then times the cleanup job, in a fresh process:
+
+    python -m benchmarks.startup --runs 10 --dir .
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+STARTUP_SNIPPET = """
+import sys, time
+import config
+config.DATABASE_NAME = sys.argv[1]
+import database
+
+timings = []
+init_database = database.Database.init_database
+def timed_init_database(self):
+    started = time.perf_counter()
+    init_database(self)
+    timings.append(time.perf_counter() - started)
+database.Database.init_database = timed_init_database
+
+import main
+startup = sum(timings)
+count = len(timings)
+
+started = time.perf_counter()
+for _ in range(int(sys.argv[2])):
+    main.cleanup_expired_reservations(None)  # No bot: nothing expires, so no offers are sent
+tick = (time.perf_counter() - started) / int(sys.argv[2])
+print(count, startup, tick)
+"""
+
+def _run(db_path, ticks):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', STARTUP_SNIPPET, db_path, str(ticks)],
+                                     cwd=root, stderr=subprocess.DEVNULL)
+    count, startup, tick = output.decode().strip().splitlines()[-1].split()
+    return int(count), float(startup), float(tick)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--ticks', type=int, default=100)
+    parser.add_argument('--dir', default=None, help='directory for the temporary database (default: system temp)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'startup.db')
+
+        count, first, _ = _run(db_path, 1)
+        runs = [_run(db_path, args.ticks) for _ in range(args.runs)]
+
+    print(f"schema initializations during import: {count}")
+    print(f"schema setup, new database:           {first * 1000:8.2f}ms")
+    print(f"schema setup, existing database:      {statistics.median(r[1] for r in runs) * 1000:8.2f}ms (median of {args.runs})")
+    print(f"cleanup_expired_reservations:         {statistics.median(r[2] for r in runs) * 1000:8.3f}ms per tick")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""Compare per-/start user writes with the batched UserWriteBuffer.
+
+Simulates a campaign spike of /start commands, many from returning users:
+
+    python -m benchmarks.user_upserts --starts 5000 --users 2000 --dir .
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+import config
+
+def _spike(count, users, seed=7):
+    rng = random.Random(seed)
+    return [(user_id, f'User{user_id}', f'user{user_id}') for user_id in (rng.randrange(users) for _ in range(count))]
+
+def _run_concurrently(rows, func, threads):
+    chunks = [rows[i::threads] for i in range(threads)]
+    workers = [threading.Thread(target=lambda chunk=chunk: [func(*row) for row in chunk]) for chunk in chunks]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--starts', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--dir', default=None, help='directory for the temporary database (default: system temp)')
+    args = parser.parse_args()
+
+    rows = _spike(args.starts, args.users)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        config.DATABASE_NAME = os.path.join(tmp_dir, 'upserts.db')
+        from database import Database, UserWriteBuffer
+
+        db = Database(config.DATABASE_NAME)
+        transactions = [0]
+        upsert_users = db.upsert_users
+
+        def counted_upsert_users(users):
+            transactions[0] += 1
+            upsert_users(users)
+        db.upsert_users = counted_upsert_users
+
+        elapsed = _run_concurrently(rows, db.add_user, args.threads)
+        print(f"direct:   {transactions[0]:6d} transactions  handler time {elapsed * 1000:8.1f}ms")
+
+        transactions[0] = 0
+        buffer = UserWriteBuffer(db, **config.USER_WRITE_BUFFER_CONFIG)
+        elapsed = _run_concurrently(rows, buffer.add, args.threads)
+        buffer.stop()
+        print(f"buffered: {transactions[0]:6d} transactions  handler time {elapsed * 1000:8.1f}ms")
+
+if __name__ == '__main__':
+    main()
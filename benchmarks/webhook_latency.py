@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""Compare update-to-reply latency of webhook mode and long polling.
+
+Runs the real handler set against a temporary database and a local fake Bot
+API server, so no network access or bot token is needed:
+
+    python -m benchmarks.webhook_latency --updates 200
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import statistics
+import tempfile
+import time
+import urllib.request
+
+import config
+
+BENCH_TOKEN = '123456:BENCHMARK-TOKEN'
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+def _wait_reply(server, user_id, timeout=10):
+    deadline = time.perf_counter() + timeout
+    while True:
+        replied_at, method, chat_id = server.replies.get(timeout=max(0.01, deadline - time.perf_counter()))
+        if method == 'sendMessage' and int(chat_id) == user_id:
+            return replied_at
+
+def _build_updater(server):
+    from concurrency import build_updater
+    from main import register_handlers
+
+    logging.getLogger().setLevel(logging.WARNING)
+    updater = build_updater(BENCH_TOKEN, config.DISPATCH_CONFIG, base_url=server.base_url)
+    register_handlers(updater.dispatcher)
+    return updater
+
+def run_polling(count, first_user_id):
+    from benchmarks.fake_telegram import FakeTelegramServer, make_command_update
+
+    server = FakeTelegramServer().start()
+    updater = _build_updater(server)
+    updater.start_polling(poll_interval=0.0, timeout=5)
+
+    latencies = []
+    try:
+        for i in range(count):
+            user_id = first_user_id + i
+            sent_at = time.perf_counter()
+            server.push_update(make_command_update(i + 1, user_id))
+            latencies.append(_wait_reply(server, user_id) - sent_at)
+    finally:
+        updater.stop()
+        server.stop()
+    return latencies
+
+def run_webhook(count, first_user_id):
+    from benchmarks.fake_telegram import FakeTelegramServer, make_command_update
+
+    server = FakeTelegramServer().start()
+    updater = _build_updater(server)
+    port = _free_port()
+    url_path = 'bench-secret'
+    updater.start_webhook(listen='127.0.0.1', port=port, url_path=url_path,
+                          webhook_url=f'http://127.0.0.1:{port}/{url_path}')
+    endpoint = f'http://127.0.0.1:{port}/{url_path}'
+
+    latencies = []
+    try:
+        for i in range(count):
+            user_id = first_user_id + i
+            body = json.dumps(make_command_update(i + 1, user_id)).encode('utf-8')
+            request = urllib.request.Request(endpoint, data=body, headers={'Content-Type': 'application/json'})
+            sent_at = time.perf_counter()
+            urllib.request.urlopen(request, timeout=5).read()
+            latencies.append(_wait_reply(server, user_id) - sent_at)
+    finally:
+        updater.stop()
+        server.stop()
+    return latencies
+
+def _report(name, latencies):
+    ms = [value * 1000 for value in latencies]
+    print(f"{name:<8} n={len(ms):<5} mean={statistics.mean(ms):7.2f}ms "
+          f"p50={_percentile(ms, 50):7.2f}ms p95={_percentile(ms, 95):7.2f}ms p99={_percentile(ms, 99):7.2f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', type=int, default=200, help='updates to send per mode')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config.DATABASE_NAME = os.path.join(tmp_dir, 'bench.db')
+        _report('polling', run_polling(args.updates, 10_000))
+        _report('webhook', run_webhook(args.updates, 20_000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+
+import time
+import base64
+import secrets
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from telegram import Update
+from telegram.ext import Handler, ConversationHandler
+from config import CALLBACK_CONFIG
+
+# Telegram rejects longer callback_data
+MAX_CALLBACK_DATA_BYTES = 64
+
+# Compact callback_data starts with this, which no plain text action does
+COMPACT_PREFIX = '~'
+COMPACT_VERSION = 1
+
+# Action codes of compact callback_data. Buttons of sent messages keep their
+# codes, so entries are only ever appended.
+ACTION_CODES = {
+    'book_slot': 1,
+    'book_discount': 2,
+    'book_appointment_discount': 3,
+    'approve_reservation': 4,
+    'reject_reservation': 5,
+    'waitlist_join': 6
+}
+ACTIONS_BY_CODE = {code: action for action, code in ACTION_CODES.items()}
+
+# Argument tags of the compact encoding
+TAG_INT, TAG_STR, TAG_FALSE, TAG_TRUE, TAG_PAYLOAD, TAG_NONE = range(6)
+PAYLOAD_KEY_BYTES = 6
+
+class Payload:
+    """A button argument too large for callback_data, kept in the payload store.
+
+    The button only carries its short key. Payloads decoded from a button
+    look their value up on access, so it is None once the entry expired or
+    was evicted, e.g. for a button pressed after a restart.
+    """
+
+    __slots__ = ('_value', 'key')
+
+    def __init__(self, value=None, key=None):
+        self._value = value
+        self.key = key
+
+    @property
+    def value(self):
+        if self._value is None and self.key is not None:
+            return payload_store.get(self.key)
+        return self._value
+
+class PayloadStore:
+    """In-memory LRU of button payloads with a TTL, keyed by random short keys"""
+
+    def __init__(self, ttl_seconds=86400, max_entries=50000):
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, value, key=None):
+        """Store value, under key when passing on a payload already stored; returns the key"""
+        key = key or secrets.token_bytes(PAYLOAD_KEY_BYTES)
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return key
+
+    def get(self, key):
+        """Return the stored value, or None when missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+payload_store = PayloadStore(
+    ttl_seconds=CALLBACK_CONFIG['payload_ttl_seconds'],
+    max_entries=CALLBACK_CONFIG['payload_max_entries']
+)
+
+def _write_varint(out, value):
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+def _read_varint(data, position):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+def encode_callback(action, *args):
+    """Pack an action with int, str, bool, None and Payload arguments into compact callback_data.
+
+    Raises ValueError when the result exceeds Telegram's 64 bytes; put large
+    values in a Payload instead.
+    """
+    out = bytearray([COMPACT_VERSION])
+    _write_varint(out, ACTION_CODES[action])
+    for arg in args:
+        if isinstance(arg, Payload):
+            arg.key = payload_store.put(arg.value, arg.key)
+            out.append(TAG_PAYLOAD)
+            out += arg.key
+        elif arg is None:
+            out.append(TAG_NONE)
+        elif isinstance(arg, bool):
+            out.append(TAG_TRUE if arg else TAG_FALSE)
+        elif isinstance(arg, int):
+            out.append(TAG_INT)
+            # Zigzag, so small negative numbers stay short too
+            _write_varint(out, arg * 2 if arg >= 0 else -arg * 2 - 1)
+        elif isinstance(arg, str):
+            encoded = arg.encode('utf-8')
+            out.append(TAG_STR)
+            _write_varint(out, len(encoded))
+            out += encoded
+        else:
+            raise TypeError(f"Can't encode {type(arg).__name__} in callback_data")
+
+    data = COMPACT_PREFIX + base64.urlsafe_b64encode(bytes(out)).decode('ascii').rstrip('=')
+    if len(data) > MAX_CALLBACK_DATA_BYTES:
+        raise ValueError(f"callback_data for {action} is {len(data)} bytes, the limit is {MAX_CALLBACK_DATA_BYTES}")
+    return data
+
+def decode_callback(data):
+    """Return (action, args) of compact callback_data, or None if it is malformed or from an unknown version"""
+    try:
+        encoded = data[len(COMPACT_PREFIX):]
+        raw = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+        if not raw or raw[0] != COMPACT_VERSION:
+            return None
+        code, position = _read_varint(raw, 1)
+        args = []
+        while position < len(raw):
+            tag = raw[position]
+            position += 1
+            if tag == TAG_INT:
+                value, position = _read_varint(raw, position)
+                args.append(value // 2 if not value & 1 else -(value + 1) // 2)
+            elif tag == TAG_STR:
+                length, position = _read_varint(raw, position)
+                if position + length > len(raw):
+                    return None
+                args.append(raw[position:position + length].decode('utf-8'))
+                position += length
+            elif tag in (TAG_FALSE, TAG_TRUE):
+                args.append(tag == TAG_TRUE)
+            elif tag == TAG_NONE:
+                args.append(None)
+            elif tag == TAG_PAYLOAD:
+                if position + PAYLOAD_KEY_BYTES > len(raw):
+                    return None
+                key = raw[position:position + PAYLOAD_KEY_BYTES]
+                position += PAYLOAD_KEY_BYTES
+                args.append(Payload(key=key))
+            else:
+                return None
+    except (ValueError, IndexError, UnicodeDecodeError):
+        return None
+    action = ACTIONS_BY_CODE.get(code)
+    return (action, tuple(args)) if action else None
+
+class Route:
+    """An action prefix of callback_data, the types of the arguments after it and its callback"""
+
+    __slots__ = ('action', 'arg_types', 'callback')
+
+    def __init__(self, action, arg_types, callback):
+        self.action = action
+        self.arg_types = arg_types
+        self.callback = callback
+
+    def parse(self, rest):
+        """Convert the '_' separated arguments after the action; None if they don't fit"""
+        if not self.arg_types:
+            return () if rest is None else None
+        if rest is None:
+            return None
+        # The last argument takes the remainder, so string keys may contain '_'
+        parts = rest.split('_', len(self.arg_types) - 1)
+        if len(parts) != len(self.arg_types):
+            return None
+        if Payload in self.arg_types:
+            # Only compact callback_data carries payloads
+            return None
+        try:
+            return tuple(arg_type(part) for arg_type, part in zip(self.arg_types, parts))
+        except ValueError:
+            return None
+
+    def accepts(self, args):
+        """Whether decoded compact arguments have this route's types; None fits any of them"""
+        return len(args) == len(self.arg_types) and all(
+            arg is None or isinstance(arg, arg_type) for arg, arg_type in zip(args, self.arg_types)
+        )
+
+class CallbackRouter:
+    """Parse callback_data into (action, args) with one lookup instead of a regex per handler.
+
+    Actions without arguments are found with a dict lookup; the others by
+    walking a trie of '_' separated tokens and taking the longest action whose
+    arguments parse, so 'edit_text_welcome_message' goes to 'edit_text' even
+    though 'edit' is a route too. Compact callback_data made by
+    encode_callback() is decoded and matched on the action and argument
+    types instead; plain text data keeps working for buttons sent before.
+    """
+
+    def __init__(self, cache_size=4096):
+        self.routes = []
+        self._exact = {}
+        self._trie = {}
+        self._by_action = {}
+        # Conversation entry points and the catch-all handler all look up the same data
+        self.match = lru_cache(maxsize=cache_size)(self._match)
+
+    def add(self, action, *arg_types, callback=None):
+        """Route action, followed by arguments of arg_types, to callback.
+
+        Routes without a callback are only parsed here; conversations handle
+        them through handler(action, callback=...).
+        """
+        route = Route(action, arg_types, callback)
+        self.routes.append(route)
+        self._by_action.setdefault(action, []).append(route)
+        if not arg_types:
+            self._exact[action] = route
+            self.match.cache_clear()
+            return route
+        node = self._trie
+        for token in action.split('_'):
+            node = node.setdefault(token, {})
+        node.setdefault(None, []).append(route)
+        self.match.cache_clear()
+        return route
+
+    def _match(self, data):
+        """Return (route, args) for callback_data, or None; cached per data string as match()"""
+        if data.startswith(COMPACT_PREFIX):
+            return self._match_compact(data)
+        return self._match_text(data)
+
+    def _match_compact(self, data):
+        decoded = decode_callback(data)
+        if decoded is None:
+            return None
+        action, args = decoded
+        for route in self._by_action.get(action, ()):
+            if route.accepts(args):
+                return route, args
+        return None
+
+    def _match_text(self, data):
+        route = self._exact.get(data)
+        if route is not None:
+            return route, ()
+
+        tokens = data.split('_')
+        candidates = []
+        node = self._trie
+        for depth, token in enumerate(tokens):
+            node = node.get(token)
+            if node is None:
+                break
+            if None in node and depth + 1 < len(tokens):
+                candidates.append((depth + 1, node[None]))
+
+        for depth, routes in reversed(candidates):
+            rest = '_'.join(tokens[depth:])
+            for route in routes:
+                args = route.parse(rest)
+                if args is not None:
+                    return route, args
+        return None
+
+    def handler(self, *actions, callback=None, ends_conversation=False):
+        """PTB handler for the given actions, or for every route with a callback when none are given"""
+        return CallbackRouteHandler(self, actions, callback, ends_conversation)
+
+    def wrap_callbacks(self, wrapper):
+        """Replace every route callback with wrapper(callback), e.g. for timing"""
+        for route in self.routes:
+            if route.callback is not None:
+                route.callback = wrapper(route.callback)
+
+class CallbackRouteHandler(Handler):
+    """Handle callback queries routed by a CallbackRouter.
+
+    The parsed arguments are passed as context.callback_args and the
+    matched action as context.callback_action.
+    """
+
+    def __init__(self, router, actions=(), callback=None, ends_conversation=False):
+        super().__init__(callback)
+        self.router = router
+        self.actions = frozenset(actions)
+        self.ends_conversation = ends_conversation
+
+    def check_update(self, update):
+        if not isinstance(update, Update) or not update.callback_query or not update.callback_query.data:
+            return None
+        match = self.router.match(update.callback_query.data)
+        if match is None:
+            return None
+        route = match[0]
+        if self.actions:
+            return match if route.action in self.actions else None
+        return match if route.callback is not None else None
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        route, args = check_result
+        context.callback_action = route.action
+        context.callback_args = args
+        result = (self.callback or route.callback)(update, context)
+        return ConversationHandler.END if self.ends_conversation else result
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitBreaker:
+    """Stop calling a failing service for a while and size request timeouts from its recent latency.
+
+    After failure_threshold consecutive failures, successes slower than
+    slow_call_seconds included, the circuit opens and allow() returns False
+    for open_seconds. Then it half-opens: a single probe request is let
+    through, and its outcome closes the circuit or opens it again.
+
+    timeout() is timeout_multiplier times the timeout_percentile of recent
+    durations, between min_timeout_seconds and max_timeout_seconds; it stays
+    at max_timeout_seconds until min_samples are known, and the half-open
+    probe always gets max_timeout_seconds. Requests that time out count as
+    samples of the timeout they hit, so a timeout that is too short grows
+    back instead of failing every request.
+    """
+
+    def __init__(self, name, max_timeout_seconds=30, failure_threshold=5, slow_call_seconds=20, open_seconds=30,
+                 latency_samples=200, min_samples=20, timeout_percentile=0.99, timeout_multiplier=1.5,
+                 min_timeout_seconds=10):
+        self.name = name
+        self.max_timeout = max_timeout_seconds
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.min_samples = min_samples
+        self.timeout_percentile = timeout_percentile
+        self.timeout_multiplier = timeout_multiplier
+        self.min_timeout = min_timeout_seconds
+        self._latencies = deque(maxlen=latency_samples)
+        self._timeout = max_timeout_seconds
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    def _transition(self, state, now):
+        logger.warning(f"{self.name} circuit {self._state} -> {state}")
+        self._state = state
+        if state == OPEN:
+            self._opened_at = now
+        self._probe_started = None
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                return HALF_OPEN
+            return self._state
+
+    def available(self):
+        """Whether a request could be let through now, without claiming the half-open probe"""
+        return self.state != OPEN
+
+    def allow(self):
+        """Whether to make a request now; in half-open state only the first caller gets to probe"""
+        with self._lock:
+            now = time.monotonic()
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if now - self._opened_at < self.open_seconds:
+                    return False
+                self._transition(HALF_OPEN, now)
+            # A probe that never reported back doesn't keep the circuit half-open forever
+            if self._probe_started is not None and now - self._probe_started < self.max_timeout:
+                return False
+            self._probe_started = now
+            return True
+
+    def percentile(self, fraction):
+        """Latency percentile of recent requests, None until min_samples are known"""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+    def timeout(self):
+        """Seconds to wait for the next request"""
+        with self._lock:
+            if self._state == HALF_OPEN:
+                # The probe decides whether the circuit closes; a tight timeout would keep it open
+                return self.max_timeout
+            return self._timeout
+
+    def _add_sample(self, duration):
+        self._latencies.append(duration)
+        if len(self._latencies) >= self.min_samples:
+            ordered = sorted(self._latencies)
+            percentile = ordered[min(len(ordered) - 1, int(len(ordered) * self.timeout_percentile))]
+            self._timeout = min(self.max_timeout, max(self.min_timeout, percentile * self.timeout_multiplier))
+
+    def record_success(self, duration=None):
+        """Report a working request; duration, when given, is a latency sample for timeout()"""
+        with self._lock:
+            now = time.monotonic()
+            if duration is not None:
+                self._add_sample(duration)
+                if duration > self.slow_call_seconds:
+                    self._failed(now)
+                    return
+
+            self._failures = 0
+            if self._state != CLOSED:
+                self._transition(CLOSED, now)
+
+    def release_probe(self):
+        """Report a request that neither worked nor failed, e.g. a rejected prompt, leaving the state alone"""
+        with self._lock:
+            self._probe_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failed(time.monotonic())
+
+    def record_timeout(self, duration):
+        """Report a request that timed out after duration seconds; a failure and a latency sample"""
+        with self._lock:
+            self._add_sample(duration)
+            self._failed(time.monotonic())
+
+    def _failed(self, now):
+        self._failures += 1
+        if self._state == HALF_OPEN or (self._state == CLOSED and self._failures >= self.failure_threshold):
+            self._transition(OPEN, now)
+
+    def reset(self):
+        """Close the circuit and forget its latencies, e.g. after an admin fixed the API key"""
+        with self._lock:
+            self._failures = 0
+            self._latencies.clear()
+            self._timeout = self.max_timeout
+            self._probe_started = None
+            if self._state != CLOSED:
+                self._transition(CLOSED, time.monotonic())
+
+    def snapshot(self):
+        """State for the admin panel: (state, consecutive failures, seconds until a probe, timeout)"""
+        state = self.state
+        with self._lock:
+            retry_in = max(0, self.open_seconds - (time.monotonic() - self._opened_at)) if state == OPEN else 0
+            return state, self._failures, retry_in, self._timeout
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import Dispatcher, ExtBot, JobQueue, Updater
+from telegram.utils.request import Request
+
+logger = logging.getLogger(__name__)
+
+class ChatOrderedExecutor:
+    """Run tasks on a worker pool while keeping tasks with the same key strictly in order"""
+
+    def __init__(self, workers=8):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='update_worker')
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._queues = {}
+        self._active = 0
+
+    def submit(self, key, func, *args):
+        """Queue func(*args); tasks sharing a key never run concurrently or out of order"""
+        with self._lock:
+            self._active += 1
+            if key is not None and key in self._queues:
+                # A worker is already draining this key, it will pick the task up
+                self._queues[key].append((func, args))
+                return
+            if key is not None:
+                self._queues[key] = deque()
+
+        self._pool.submit(self._run, key, func, args)
+
+    def _run(self, key, func, args):
+        while True:
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error(f"Unhandled error in update worker: {e}")
+
+            with self._lock:
+                self._active -= 1
+                queue = self._queues.get(key) if key is not None else None
+                if not queue:
+                    self._queues.pop(key, None)
+                    if self._active == 0:
+                        self._idle.notify_all()
+                    return
+                func, args = queue.popleft()
+
+    @property
+    def pending(self):
+        """Number of queued or running tasks"""
+        with self._lock:
+            return self._active
+
+    def wait_idle(self, timeout=None):
+        """Block until every submitted task has finished"""
+        with self._lock:
+            return self._idle.wait_for(lambda: self._active == 0, timeout)
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+def update_ordering_key(update):
+    """Updates from the same chat (or user, for chat-less updates) share a key"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return None
+
+class ChatOrderedDispatcher(Dispatcher):
+    """Dispatcher that handles updates concurrently, but sequentially per chat.
+
+    ConversationHandler state is keyed by chat and user, so keeping each chat
+    ordered keeps conversation transitions consistent.
+    """
+
+    def __init__(self, *args, dispatch_workers=8, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ordered_executor = ChatOrderedExecutor(dispatch_workers)
+
+    def process_update(self, update):
+        if isinstance(update, TelegramError):
+            super().process_update(update)
+            return
+        self.ordered_executor.submit(update_ordering_key(update), self.run_update, update)
+
+    def run_update(self, update):
+        """Pass the update through the handler groups; runs on an executor worker"""
+        super().process_update(update)
+
+    def stop(self):
+        super().stop()
+        # Let already accepted updates finish before the process exits
+        self.ordered_executor.shutdown(wait=True)
+
+def build_updater(token, dispatch_config, persistence=None, base_url=None):
+    """Create an Updater, using ChatOrderedDispatcher when concurrent dispatch is enabled"""
+    if not dispatch_config['concurrent']:
+        return Updater(token, base_url=base_url, workers=dispatch_config['async_workers'],
+                       persistence=persistence)
+
+    workers = dispatch_config['workers']
+    # Every update worker may hold a connection to the Bot API at the same time
+    request = Request(con_pool_size=workers + dispatch_config['async_workers'] + 4)
+    bot = ExtBot(token, base_url, request=request)
+    job_queue = JobQueue()
+    dispatcher = ChatOrderedDispatcher(
+        bot,
+        Queue(),
+        job_queue=job_queue,
+        workers=dispatch_config['async_workers'],
+        persistence=persistence,
+        dispatch_workers=workers
+    )
+    job_queue.set_dispatcher(dispatcher)
+    return Updater(dispatcher=dispatcher, workers=None)
@@ -45,6 +45,15 @@ PERSIAN_TEXTS = {
     'booking_discount_select': "لطفاً یکی از زمان‌های موجود را با ۱۰٪ تخفیف انتخاب کنید:",
     'booking_discount_button': "📅 رزرو وقت برای اجرای این طرح (با ۱۰٪ تخفیف)",
     
+    # Waitlist, offered when no slot is free
+    'booking_waitlist_days_button': "🔔 خبرم کن: زمانی تا {days} روز آینده",
+    'booking_waitlist_any_button': "🔔 خبرم کن: هر زمانی",
+    'booking_waitlist_leave_button': "🔕 خروج از لیست انتظار",
+    'booking_waitlist_joined': "✅ در لیست انتظار ثبت شدید. به محض آزاد شدن یک زمان، آن را چند دقیقه فقط برای شما نگه می‌داریم و خبرتان می‌کنیم.",
+    'booking_waitlist_left': "از لیست انتظار خارج شدید.",
+    'booking_waitlist_offer': "🔔 یک زمان آزاد شد: {slot_text}\n\nاین زمان تا {hold_minutes} دقیقه فقط برای شما نگه داشته می‌شود. برای رزرو روی دکمه زیر بزنید.",
+    'booking_waitlist_offer_button': "📅 رزرو این زمان",
+    
     # General messages
     'back_button': "🔙 بازگشت",
     'cancel_button': "🔙 لغو",
@@ -76,11 +85,200 @@ PERSIAN_TEXTS = {
 # AI API Configuration (will be set via admin panel)
 AI_API_CONFIG = {
     'api_key': '',
-    'api_url': 'https://clipdrop-api.co/text-to-image/v1',  # ClipDrop API endpoint
-    'model': 'clipdrop'
+    'api_url': 'https://clipdrop-api.co/text-to-image/v1',  # ClipDrop API endpoint, or benchmarks/fake_clipdrop.py
+    'model': 'clipdrop',
+    'timeout_seconds': 30,
+    'variants': 1,  # Designs generated in parallel per description, sent as one album when > 1
+    'variant_styles': [  # Appended to the prompt of each variant
+        'bold traditional style',
+        'fine line minimalist style',
+        'blackwork with dotwork shading',
+        'realistic style with soft shading'
+    ],
+    'max_parallel_requests': 8  # ClipDrop requests in flight across all users
 }
 
 # Scheduler Configuration
 SCHEDULER_CONFIG = {
     'reservation_timeout_minutes': 120  # Changed from 30 to 120 minutes (2 hours)
-}
\ No newline at end of file
+}
+
+# Webhook Configuration (long polling is used when disabled)
+WEBHOOK_CONFIG = {
+    'enabled': False,
+    'listen': '0.0.0.0',
+    'port': 8443,
+    'url_path': '',  # Secret path segment; defaults to the bot token when empty
+    'public_url': '',  # Public base URL Telegram will call, e.g. https://bot.example.com
+    'cert': '',  # Optional path to a self-signed TLS certificate
+    'key': '',  # Optional path to the TLS private key
+    'max_connections': 40,
+    'drop_pending_updates': False
+}
+
+# Update dispatch configuration
+DISPATCH_CONFIG = {
+    'concurrent': True,  # Handle different chats in parallel, keeping each chat in order
+    'workers': 8,  # Update worker threads used when concurrent is enabled
+    'async_workers': 4,  # PTB run_async worker threads
+    'nonblocking_ai': True,  # Return from the AI design handler right away, finishing the design in the background
+    'ai_wait_timeout_seconds': 120  # Longest a blocking AI design handler waits for its variants
+}
+
+# Conversation states and user_data stored in SQLite (see persistence.py)
+PERSISTENCE_CONFIG = {
+    'max_cached_users': 10000  # Users whose last stored user_data is kept in memory to skip unchanged writes
+}
+
+# Batched user upserts from /start
+USER_WRITE_BUFFER_CONFIG = {
+    'flush_interval_ms': 500,  # Write pending users at least this often
+    'max_batch_rows': 500,  # Flush early once this many users are pending
+    'max_known_users': 100000  # Users remembered to skip unchanged upserts
+}
+
+# Forced channel membership cache
+MEMBERSHIP_CACHE_CONFIG = {
+    'member_ttl_seconds': 600,  # Members are re-checked every 10 minutes
+    'not_member_ttl_seconds': 30,  # Short, so users get in soon after joining
+    'max_entries': 100000
+}
+
+# Prometheus metrics endpoint
+METRICS_CONFIG = {
+    'enabled': False,
+    'listen': '127.0.0.1',
+    'port': 9100  # Scrape http://127.0.0.1:9100/metrics
+}
+
+# Per-update timing and sampled profiling
+TRACING_CONFIG = {
+    'enabled': True,
+    'slow_update_ms': 1000,  # Log updates slower than this with a DB/API/handler breakdown
+    'profile_top_n': 25  # Functions listed from a sampled cProfile of a slow update
+}
+
+# Per-statement SQL timings (opt-in, adds a little overhead to every query)
+QUERY_STATS_CONFIG = {
+    'enabled': False,
+    'slow_query_ms': 50,  # Log statements slower than this
+    'samples_per_query': 1000,  # Recent durations kept per statement for the p99
+    'top_n': 5  # Statements shown by the /queries admin command
+}
+
+# Post-processing of generated designs before upload
+IMAGE_CONFIG = {
+    'format': 'jpeg',  # 'png' (as generated), 'jpeg' or 'webp'
+    'quality': 90,  # JPEG/WebP quality
+    'strip_metadata': True,  # Re-encode PNGs too, dropping text/EXIF chunks
+    'watermark_text': '',  # e.g. the studio's Instagram handle, empty for none
+    'watermark_font': '',  # Path to a .ttf font, Pillow's default font otherwise
+    'watermark_opacity': 128,  # 0-255
+    'workers': 2  # Threads encoding and uploading designs
+}
+
+# SQLite access
+DATABASE_CONFIG = {
+    'wal': True,  # Write-ahead logging, so reads don't wait for writes
+    'dedicated_writer': True  # Run all writes on one thread instead of contending for the lock
+}
+
+# Settings and slot caches, kept in sync across bot processes through the change_log table
+CHANGE_FEED_CONFIG = {
+    'enabled': True,
+    'poll_interval_ms': 1000,  # How often each process checks change_log for writes by other processes
+    'retention_hours': 24  # change_log rows older than this are pruned
+}
+
+# Moving finished reservations out of the hot reservations table
+ARCHIVE_CONFIG = {
+    'enabled': True,
+    'archive_after_days': 30,  # Confirmed and rejected reservations older than this are archived
+    'batch_size': 1000,  # Rows moved per transaction, so other writes get in between
+    'interval_hours': 24
+}
+
+# Online backups and periodic ANALYZE / PRAGMA optimize / incremental vacuum
+MAINTENANCE_CONFIG = {
+    'backup_enabled': True,
+    'backup_dir': 'backups',
+    'backup_interval_hours': 6,
+    'backups_to_keep': 7,  # Older backups are deleted after each new one
+    'backup_pages_per_step': 256,  # Pages copied per step; writers get the database between steps
+    'backup_step_sleep_ms': 10,
+    'backup_max_restarts': 5,  # Writes from other connections restart a stepped copy; then copy in one step
+    'maintenance_enabled': True,
+    'maintenance_interval_hours': 24,
+    'vacuum_pages_per_step': 1000  # Free pages released per incremental_vacuum write
+}
+
+# Server-side payloads of compact callback_data (see callback_router.py)
+CALLBACK_CONFIG = {
+    'payload_ttl_seconds': 86400,  # Buttons pressed later find their payload gone and fall back
+    'payload_max_entries': 50000
+}
+
+# Funnel events (AI designer -> image -> discount tap -> confirmed booking)
+ANALYTICS_CONFIG = {
+    'enabled': True,
+    'flush_interval_ms': 2000,  # Buffered events are written and rolled up at least this often
+    'max_batch_rows': 500,  # Flush early once this many events are pending
+    'funnel_weeks': 4  # Weeks shown in the stats screen funnel
+}
+
+# Outbound messages not sent in reply to an update (receipts to admins, notifications, broadcasts)
+SEND_QUEUE_CONFIG = {
+    'enabled': True,  # Send directly from the calling thread when disabled
+    'rate_per_second': 25,  # Across all chats; Telegram allows about 30
+    'burst': 5,  # Most sent in any second is burst + rate_per_second
+    'per_chat_rate_per_second': 1,  # Telegram allows about one message per second per chat
+    'per_chat_burst': 1,
+    'workers': 4,  # Threads making the API calls
+    'max_retries': 5,  # Retries after network errors, with exponential backoff
+    'max_flood_retries': 10,  # Retries after RetryAfter; a send still flood-limited after this many fails
+    'backoff_base_seconds': 1,
+    'backoff_max_seconds': 60,
+    'drain_timeout_seconds': 30  # On shutdown, wait this long for queued messages
+}
+
+# Circuit breaker and adaptive timeout of each AI provider
+AI_CIRCUIT_CONFIG = {
+    'failure_threshold': 5,  # Consecutive failed or slow requests that open the circuit
+    'slow_call_seconds': 20,  # Successful requests slower than this count as failures
+    'open_seconds': 30,  # Requests fail right away for this long, then one probe request is let through
+    'latency_samples': 200,  # Recent request durations, timed-out ones included, the timeout is derived from
+    'min_samples': 20,  # AI_API_CONFIG['timeout_seconds'] is used until this many are known
+    'timeout_percentile': 0.99,
+    'timeout_multiplier': 1.5,  # Timeout = percentile latency x multiplier, capped by the provider's timeout_seconds
+    'min_timeout_seconds': 10
+}
+
+# Text-to-image backends (see ai_providers.py); requests go to one picked by weight and fail over to the others
+AI_PROVIDERS_CONFIG = {
+    'providers': [
+        {
+            'name': 'clipdrop',
+            'type': 'clipdrop',
+            'weight': 1,  # Share of requests sent here first; 0 = only used when the others fail
+            'api_url': '',  # AI_API_CONFIG['api_url'] when empty
+            'api_key_setting': 'ai_api_key',  # Setting holding the key, as set from the admin panel
+            'timeout_seconds': 0,  # AI_API_CONFIG['timeout_seconds'] when 0
+            'cost_per_image': 0.0  # Added to bot_ai_cost_total per generated image
+        }
+        # A second ClipDrop account or endpoint, e.g. benchmarks/fake_clipdrop.py:
+        # {'name': 'clipdrop_backup', 'type': 'clipdrop', 'weight': 0, 'api_url': 'http://127.0.0.1:8765/text-to-image/v1',
+        #  'api_key_setting': 'ai_api_key_backup', 'timeout_seconds': 0, 'cost_per_image': 0.0}
+    ],
+    'hedging': True,  # Also ask the next provider when the first hasn't answered by its hedge_percentile latency
+    'hedge_percentile': 0.95,
+    'hedge_min_delay_seconds': 1.0,
+    'max_hedges': 1  # Extra requests in flight for one image
+}
+
+# Waitlist for users who found no free slot; a freed slot is held for the first matching user
+WAITLIST_CONFIG = {
+    'enabled': True,
+    'hold_minutes': 15,  # How long a freed slot is kept for the user it was offered to
+    'ranges_days': [7, 30],  # Join buttons: slots within this many days from today
+    'any_days': 60  # The "any time" entry is dropped after this many days
+}
@@ -1,150 +1,708 @@
 # -*- coding: utf-8 -*-
 
+import time
+import queue
 import sqlite3
 import logging
-from datetime import datetime, timedelta
-from config import DATABASE_NAME, PERSIAN_TEXTS
+import threading
+from functools import wraps
+from concurrent.futures import Future
+from datetime import date, datetime, timedelta
+from collections import OrderedDict
+from config import (
+    DATABASE_NAME, DATABASE_CONFIG, PERSIAN_TEXTS, USER_WRITE_BUFFER_CONFIG, QUERY_STATS_CONFIG,
+    CHANGE_FEED_CONFIG, ARCHIVE_CONFIG, WAITLIST_CONFIG
+)
+from query_stats import ProfiledConnection
+from slot_dates import parse_slot_day
 
 logger = logging.getLogger(__name__)
 
-class Database:
+MIGRATIONS = []
+
+def connect(db_name, **kwargs):
+    """Open a connection, recording per-statement timings when QUERY_STATS_CONFIG is enabled"""
+    if QUERY_STATS_CONFIG['enabled']:
+        kwargs.setdefault('factory', ProfiledConnection)
+    return sqlite3.connect(db_name, **kwargs)
+
+def migration(version, description):
+    """Register a schema migration; migrations are applied in version order"""
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return func
+    return decorator
+
+@migration(1, 'initial schema and default settings')
+def _migrate_initial_schema(cursor):
+    # Users table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            first_name TEXT,
+            username TEXT,
+            join_date DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Slots table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS slots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            slot_text TEXT NOT NULL,
+            is_available BOOLEAN DEFAULT 1
+        )
+    ''')
+    
+    # Reservations table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reservations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            slot_id INTEGER,
+            status TEXT DEFAULT 'pending',
+            receipt_photo_id TEXT,
+            pending_time DATETIME,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            FOREIGN KEY (slot_id) REFERENCES slots(id)
+        )
+    ''')
+    
+    # Settings table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    
+    init_default_settings(cursor)
+
+@migration(2, 'expiry warnings table')
+def _migrate_expiry_warnings(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS expiry_warnings (
+            reservation_id INTEGER PRIMARY KEY,
+            warning_sent_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+@migration(3, 'conversation and user_data persistence tables')
+def _migrate_persistence_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER,
+            key TEXT,
+            value TEXT,
+            PRIMARY KEY (user_id, key)
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT,
+            conversation_key TEXT,
+            state TEXT,
+            PRIMARY KEY (name, conversation_key)
+        )
+    ''')
+
+@migration(4, 'move force_channel setting to force_join_channel')
+def _migrate_force_channel_key(cursor):
+    # The admin panel used to save the forced channel under a key nothing read
+    cursor.execute('''
+        UPDATE settings
+        SET value = (SELECT value FROM settings WHERE key = 'force_channel')
+        WHERE key = 'force_join_channel'
+          AND EXISTS (SELECT 1 FROM settings WHERE key = 'force_channel')
+    ''')
+    cursor.execute("DELETE FROM settings WHERE key = 'force_channel'")
+
+@migration(5, 'uploaded_files table for Telegram file_id reuse')
+def _migrate_uploaded_files(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS uploaded_files (
+            content_hash TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+@migration(6, 'change_log table for cross-process cache invalidation')
+def _migrate_change_log(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            entity_key TEXT,
+            changed_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+@migration(7, 'reservations_archive table and all_reservations view')
+def _migrate_reservations_archive(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reservations_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            slot_id INTEGER,
+            status TEXT,
+            receipt_photo_id TEXT,
+            pending_time DATETIME,
+            created_at DATETIME,
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_reservations_archive_status ON reservations_archive (status)')
+    # Same columns as reservations, for history queries that must see archived rows too
+    cursor.execute('''
+        CREATE VIEW IF NOT EXISTS all_reservations AS
+        SELECT id, user_id, slot_id, status, receipt_photo_id, pending_time, created_at FROM reservations
+        UNION ALL
+        SELECT id, user_id, slot_id, status, receipt_photo_id, pending_time, created_at FROM reservations_archive
+    ''')
+
+@migration(8, 'maintenance_log table')
+def _migrate_maintenance_log(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task TEXT NOT NULL,
+            duration_ms REAL,
+            detail TEXT,
+            finished_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_maintenance_log_task ON maintenance_log (task, id)')
+
+@migration(9, 'funnel events and daily rollup tables')
+def _migrate_events(cursor):
+    # Append-only; rolled up into event_daily, which the stats screen reads
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event TEXT NOT NULL,
+            user_id INTEGER,
+            created_at DATETIME NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS event_daily (
+            day TEXT,
+            event TEXT,
+            count INTEGER NOT NULL DEFAULT 0,
+            users INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, event)
+        ) WITHOUT ROWID
+    ''')
+    # Who was already counted per day and event, so users stays a distinct count
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS event_daily_users (
+            day TEXT,
+            event TEXT,
+            user_id INTEGER,
+            PRIMARY KEY (day, event, user_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS event_rollup_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_event_id INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO event_rollup_state (id, last_event_id) VALUES (1, 0)')
+
+@migration(10, 'slot days, waitlist and slot holds')
+def _migrate_waitlist(cursor):
+    # The day a slot's free text names, so freed slots can be matched to waitlist ranges
+    cursor.execute('ALTER TABLE slots ADD COLUMN slot_day TEXT')
+    cursor.execute('SELECT id, slot_text FROM slots')
+    cursor.executemany(
+        'UPDATE slots SET slot_day = ? WHERE id = ?',
+        [(parse_slot_day(slot_text), slot_id) for slot_id, slot_text in cursor.fetchall()]
+    )
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS waitlist (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL UNIQUE,
+            day_from TEXT NOT NULL,
+            day_to TEXT NOT NULL,
+            any_day INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_waitlist_any_day ON waitlist (any_day, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_waitlist_day_to ON waitlist (day_to)')
+    # One row per day of each dated entry: the first waiter for a day is a single index seek
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS waitlist_days (
+            day TEXT,
+            waitlist_id INTEGER,
+            PRIMARY KEY (day, waitlist_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_waitlist_days_entry ON waitlist_days (waitlist_id)')
+    # A freed slot kept for the waiter it was offered to; the slot stays unavailable meanwhile
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS slot_holds (
+            slot_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            expires_at DATETIME NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_slot_holds_expires_at ON slot_holds (expires_at)')
+    # Settings added after the first release
+    init_default_settings(cursor)
+
+def init_default_settings(cursor):
+    """Initialize default settings"""
+    default_settings = {
+        # Basic settings
+        'welcome_message': PERSIAN_TEXTS['welcome_message'],
+        'card_number': PERSIAN_TEXTS['card_number'],
+        'card_owner': PERSIAN_TEXTS['card_owner'],
+        'deposit_amount': PERSIAN_TEXTS['deposit_amount'],
+        'force_join_channel': '',
+        'ai_api_key': '',
+        'contact_info': PERSIAN_TEXTS['contact_info'],
+        
+        # Main menu button texts
+        'button_ai_design': PERSIAN_TEXTS['main_menu_buttons']['ai_design'],
+        'button_book_appointment': PERSIAN_TEXTS['main_menu_buttons']['book_appointment'],
+        'button_contact': PERSIAN_TEXTS['main_menu_buttons']['contact'],
+        'button_admin_panel': PERSIAN_TEXTS['main_menu_buttons']['admin_panel'],
+        
+        # AI Design messages
+        'ai_design_prompt': PERSIAN_TEXTS['ai_design_prompt'],
+        'ai_design_processing': PERSIAN_TEXTS['ai_design_processing'],
+        'ai_design_result': PERSIAN_TEXTS['ai_design_result'],
+        'ai_design_error': PERSIAN_TEXTS['ai_design_error'],
+        
+        # Booking messages
+        'booking_select_slot': PERSIAN_TEXTS['booking_select_slot'],
+        'booking_no_slots': PERSIAN_TEXTS['booking_no_slots'],
+        'booking_slot_unavailable': PERSIAN_TEXTS['booking_slot_unavailable'],
+        'booking_receipt_request': PERSIAN_TEXTS['booking_receipt_request'],
+        'booking_receipt_received': PERSIAN_TEXTS['booking_receipt_received'],
+        'booking_confirmed': PERSIAN_TEXTS['booking_confirmed'],
+        'booking_rejected': PERSIAN_TEXTS['booking_rejected'],
+        
+        # Discount booking
+        'booking_discount_select': PERSIAN_TEXTS['booking_discount_select'],
+        'booking_discount_button': PERSIAN_TEXTS['booking_discount_button'],
+        
+        # Waitlist
+        'booking_waitlist_days_button': PERSIAN_TEXTS['booking_waitlist_days_button'],
+        'booking_waitlist_any_button': PERSIAN_TEXTS['booking_waitlist_any_button'],
+        'booking_waitlist_leave_button': PERSIAN_TEXTS['booking_waitlist_leave_button'],
+        'booking_waitlist_joined': PERSIAN_TEXTS['booking_waitlist_joined'],
+        'booking_waitlist_left': PERSIAN_TEXTS['booking_waitlist_left'],
+        'booking_waitlist_offer': PERSIAN_TEXTS['booking_waitlist_offer'],
+        'booking_waitlist_offer_button': PERSIAN_TEXTS['booking_waitlist_offer_button'],
+        
+        # General messages
+        'back_button': PERSIAN_TEXTS['back_button'],
+        'cancel_button': PERSIAN_TEXTS['cancel_button'],
+        'operation_cancelled': PERSIAN_TEXTS['operation_cancelled'],
+        'error_general': PERSIAN_TEXTS['error_general'],
+        
+        # Admin messages
+        'admin_receipt_caption': PERSIAN_TEXTS['admin_receipt_caption'],
+        'admin_approve_button': PERSIAN_TEXTS['admin_approve_button'],
+        'admin_reject_button': PERSIAN_TEXTS['admin_reject_button']
+    }
+    
+    for key, value in default_settings.items():
+        cursor.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', (key, value))
+
+class DatabaseWriter:
+    """Run database writes on one dedicated thread, in submission order.
+
+    SQLite allows a single writer at a time, so update workers writing
+    concurrently only wait on each other's locks with busy retries. Queueing
+    the writes to one thread removes that contention, and submit() lets
+    callers that don't need the result continue without waiting.
+    """
+
     def __init__(self):
-        self.db_name = DATABASE_NAME
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) for the writer thread; returns a Future of its result"""
+        future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='database_writer', daemon=True)
+                self._thread.start()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def run(self, func, *args, **kwargs):
+        """Run func on the writer thread and wait for its result"""
+        if threading.current_thread() is self._thread:
+            # Writes made by a write already running on the writer thread
+            return func(*args, **kwargs)
+        return self.submit(func, *args, **kwargs).result()
+
+    @property
+    def pending(self):
+        """Number of queued writes"""
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, func, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def stop(self):
+        """Finish the queued writes and stop the writer thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread:
+            self._queue.put(None)
+            thread.join(timeout=10)
+
+database_writer = DatabaseWriter()
+
+def serialized_write(method):
+    """Decorator for methods that write: they run on the dedicated writer thread"""
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        if not DATABASE_CONFIG['dedicated_writer']:
+            return method(*args, **kwargs)
+        return database_writer.run(method, *args, **kwargs)
+    return wrapper
+
+_database = None
+_database_lock = threading.Lock()
+
+def get_database():
+    """Return the process-wide Database instance, creating it on first use"""
+    global _database
+    with _database_lock:
+        if _database is None:
+            _database = Database()
+        return _database
+
+class UserWriteBuffer:
+    """Collect user upserts in memory and write them to the database in batches.
+
+    A background thread flushes every flush_interval_ms, or as soon as
+    max_batch_rows users are pending. Users whose name and username did not
+    change since they were last written are skipped entirely.
+    """
+
+    def __init__(self, db, flush_interval_ms=500, max_batch_rows=500, max_known_users=100000):
+        self.db = db
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_batch_rows = max_batch_rows
+        self.max_known_users = max_known_users
+        self._pending = {}
+        # Last written (first_name, username) per user, least recently seen first
+        self._known = OrderedDict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def add(self, user_id, first_name, username):
+        """Queue an upsert; returns immediately"""
+        row = (first_name, username)
+        with self._lock:
+            if user_id not in self._pending and self._known.get(user_id) == row:
+                self._known.move_to_end(user_id)
+                return
+            self._pending[user_id] = row
+            pending_count = len(self._pending)
+            
+            if self._thread is None and not self._stopped:
+                self._thread = threading.Thread(target=self._run, name='user_write_buffer', daemon=True)
+                self._thread.start()
+        
+        if pending_count >= self.max_batch_rows:
+            self._wakeup.set()
+
+    @property
+    def pending(self):
+        """Number of users waiting to be written"""
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Write all pending users in one transaction"""
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch = self._pending
+            self._pending = {}
+        
+        try:
+            self.db.upsert_users([(user_id, first_name, username) for user_id, (first_name, username) in batch.items()])
+        except Exception as e:
+            logger.error(f"Error flushing {len(batch)} buffered users: {e}")
+            with self._lock:
+                # Keep newer values queued meanwhile, retry the rest on the next flush
+                for user_id, row in batch.items():
+                    self._pending.setdefault(user_id, row)
+            return 0
+        
+        with self._lock:
+            for user_id, row in batch.items():
+                self._known[user_id] = row
+                self._known.move_to_end(user_id)
+            while len(self._known) > self.max_known_users:
+                self._known.popitem(last=False)
+        return len(batch)
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def stop(self):
+        """Stop the background thread and write whatever is still pending"""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        self.flush()
+
+_user_write_buffer = None
+
+def get_user_write_buffer():
+    """Return the process-wide UserWriteBuffer for the shared database"""
+    global _user_write_buffer
+    db = get_database()
+    with _database_lock:
+        if _user_write_buffer is None:
+            _user_write_buffer = UserWriteBuffer(
+                db,
+                flush_interval_ms=USER_WRITE_BUFFER_CONFIG['flush_interval_ms'],
+                max_batch_rows=USER_WRITE_BUFFER_CONFIG['max_batch_rows'],
+                max_known_users=USER_WRITE_BUFFER_CONFIG['max_known_users']
+            )
+        return _user_write_buffer
+
+class Database:
+    def __init__(self, db_name=None):
+        self.db_name = db_name or DATABASE_NAME
         self.init_database()
+        # Settings and available slots, keyed ('setting', key) and ('slots',)
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+        # Bumped on every invalidation so a read racing a write doesn't cache the old value
+        self._cache_generation = 0
+        self._change_listeners = []
+        self._last_change_id = None
+        # change_log ids written and applied by this process, skipped when polling
+        self._local_change_ids = set()
+        self._change_feed_thread = None
 
     def init_database(self):
-        """Initialize database with required tables"""
+        """Bring the database schema up to date by applying pending migrations"""
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name, isolation_level=None)
             cursor = conn.cursor()
             
-            # Users table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    first_name TEXT,
-                    username TEXT,
-                    join_date DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+            if self._schema_version(cursor) == 0:
+                # Only takes effect on an empty file; lets maintenance release free pages
+                cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
             
-            # Slots table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS slots (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    slot_text TEXT NOT NULL,
-                    is_available BOOLEAN DEFAULT 1
-                )
-            ''')
+            if DATABASE_CONFIG['wal']:
+                # Readers no longer wait for writers; the setting is stored in the file
+                cursor.execute('PRAGMA journal_mode=WAL')
             
-            # Reservations table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS reservations (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    slot_id INTEGER,
-                    status TEXT DEFAULT 'pending',
-                    receipt_photo_id TEXT,
-                    pending_time DATETIME,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    FOREIGN KEY (slot_id) REFERENCES slots(id)
-                )
-            ''')
+            # Fast path: an up-to-date database needs a single read and no write transaction
+            latest_version = MIGRATIONS[-1][0]
+            if self._schema_version(cursor) >= latest_version:
+                logger.debug(f"Database schema is up to date (version {latest_version})")
+                return
             
-            # Settings table
+            # Take the write lock first so concurrent processes don't migrate twice
+            cursor.execute('BEGIN IMMEDIATE')
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
+            current_version = self._schema_version(cursor)
+            
+            applied = []
+            for version, description, migrate in MIGRATIONS:
+                if version <= current_version:
+                    continue
+                migrate(cursor)
+                cursor.execute(
+                    'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                    (version, description)
+                )
+                applied.append(version)
             
-            # Initialize default settings
-            self.init_default_settings(cursor)
+            cursor.execute('COMMIT')
             
-            conn.commit()
-            logger.info("Database initialized successfully")
+            if applied:
+                logger.info(f"Database migrated to version {applied[-1]} (applied {applied})")
             
         except Exception as e:
             logger.error(f"Error initializing database: {e}")
-            if conn:
+            if conn and conn.in_transaction:
                 conn.rollback()
             raise
         finally:
             if conn:
                 conn.close()
 
-    def init_default_settings(self, cursor):
-        """Initialize default settings"""
-        default_settings = {
-            # Basic settings
-            'welcome_message': PERSIAN_TEXTS['welcome_message'],
-            'card_number': PERSIAN_TEXTS['card_number'],
-            'card_owner': PERSIAN_TEXTS['card_owner'],
-            'deposit_amount': PERSIAN_TEXTS['deposit_amount'],
-            'force_join_channel': '',
-            'ai_api_key': '',
-            'contact_info': PERSIAN_TEXTS['contact_info'],
-            
-            # Main menu button texts
-            'button_ai_design': PERSIAN_TEXTS['main_menu_buttons']['ai_design'],
-            'button_book_appointment': PERSIAN_TEXTS['main_menu_buttons']['book_appointment'],
-            'button_contact': PERSIAN_TEXTS['main_menu_buttons']['contact'],
-            'button_admin_panel': PERSIAN_TEXTS['main_menu_buttons']['admin_panel'],
-            
-            # AI Design messages
-            'ai_design_prompt': PERSIAN_TEXTS['ai_design_prompt'],
-            'ai_design_processing': PERSIAN_TEXTS['ai_design_processing'],
-            'ai_design_result': PERSIAN_TEXTS['ai_design_result'],
-            'ai_design_error': PERSIAN_TEXTS['ai_design_error'],
-            
-            # Booking messages
-            'booking_select_slot': PERSIAN_TEXTS['booking_select_slot'],
-            'booking_no_slots': PERSIAN_TEXTS['booking_no_slots'],
-            'booking_slot_unavailable': PERSIAN_TEXTS['booking_slot_unavailable'],
-            'booking_receipt_request': PERSIAN_TEXTS['booking_receipt_request'],
-            'booking_receipt_received': PERSIAN_TEXTS['booking_receipt_received'],
-            'booking_confirmed': PERSIAN_TEXTS['booking_confirmed'],
-            'booking_rejected': PERSIAN_TEXTS['booking_rejected'],
-            
-            # Discount booking
-            'booking_discount_select': PERSIAN_TEXTS['booking_discount_select'],
-            'booking_discount_button': PERSIAN_TEXTS['booking_discount_button'],
-            
-            # General messages
-            'back_button': PERSIAN_TEXTS['back_button'],
-            'cancel_button': PERSIAN_TEXTS['cancel_button'],
-            'operation_cancelled': PERSIAN_TEXTS['operation_cancelled'],
-            'error_general': PERSIAN_TEXTS['error_general'],
-            
-            # Admin messages
-            'admin_receipt_caption': PERSIAN_TEXTS['admin_receipt_caption'],
-            'admin_approve_button': PERSIAN_TEXTS['admin_approve_button'],
-            'admin_reject_button': PERSIAN_TEXTS['admin_reject_button']
-        }
+    def _schema_version(self, cursor):
+        """Return the applied schema version, 0 for a database without migrations"""
+        try:
+            cursor.execute('SELECT MAX(version) FROM schema_version')
+        except sqlite3.OperationalError:
+            return 0
+        return cursor.fetchone()[0] or 0
+
+    def _cached(self, cache_key, load, *args):
+        """Return load(*args) from the cache, loading it on a miss.
+
+        With CHANGE_FEED_CONFIG disabled every call goes to the database.
+        """
+        if not CHANGE_FEED_CONFIG['enabled']:
+            return load(*args)
+        self._start_change_feed()
+        with self._cache_lock:
+            if cache_key in self._cache:
+                return self._cache[cache_key]
+            generation = self._cache_generation
+        value = load(*args)
+        with self._cache_lock:
+            if generation == self._cache_generation:
+                self._cache[cache_key] = value
+        return value
+
+    def add_change_listener(self, listener):
+        """Call listener(entity, entity_key) for every change, local or made by another process"""
+        self._change_listeners.append(listener)
+
+    def _log_changes(self, cursor, changes):
+        """Record (entity, key) changes in change_log, inside the caller's transaction; returns their ids"""
+        change_ids = []
+        for entity, key in changes:
+            cursor.execute('INSERT INTO change_log (entity, entity_key) VALUES (?, ?)', (entity, str(key)))
+            change_ids.append(cursor.lastrowid)
+        return change_ids
+
+    def _apply_changes(self, changes, change_ids=()):
+        """Drop the cache entries affected by committed changes and notify listeners.
+
+        change_ids are the change_log rows of a local write, so poll_changes
+        doesn't apply them a second time.
+        """
+        with self._cache_lock:
+            self._cache_generation += 1
+            if self._change_feed_thread is not None:
+                # Rows the poll already went past won't come up again
+                self._local_change_ids.update(
+                    change_id for change_id in change_ids if change_id > self._last_change_id
+                )
+            for entity, key in changes:
+                if entity == 'setting':
+                    self._cache.pop(('setting', key), None)
+                elif entity == 'slots':
+                    self._cache.pop(('slots',), None)
+        for entity, key in changes:
+            for listener in self._change_listeners:
+                try:
+                    listener(entity, key)
+                except Exception as e:
+                    logger.error(f"Error in change listener for {entity} {key}: {e}")
+
+    def _start_change_feed(self):
+        """Start polling change_log on first cached read"""
+        if self._change_feed_thread is not None:
+            return
+        with self._cache_lock:
+            if self._change_feed_thread is not None:
+                return
+            # Only changes made after this point can make cached values stale
+            conn = connect(self.db_name)
+            try:
+                self._last_change_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM change_log').fetchone()[0]
+            finally:
+                conn.close()
+            self._change_feed_thread = threading.Thread(target=self._run_change_feed, name='change_feed', daemon=True)
+            self._change_feed_thread.start()
+
+    def _run_change_feed(self):
+        while True:
+            time.sleep(CHANGE_FEED_CONFIG['poll_interval_ms'] / 1000.0)
+            try:
+                self.poll_changes()
+            except Exception as e:
+                logger.error(f"Error polling change_log: {e}")
+
+    def poll_changes(self):
+        """Apply changes other processes logged since the last poll; returns their number"""
+        conn = connect(self.db_name)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT id, entity, entity_key FROM change_log WHERE id > ? ORDER BY id',
+                (self._last_change_id,)
+            )
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
         
-        for key, value in default_settings.items():
-            cursor.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', (key, value))
+        if not rows:
+            return 0
+        with self._cache_lock:
+            self._last_change_id = rows[-1][0]
+            remote = []
+            for change_id, entity, entity_key in rows:
+                if change_id in self._local_change_ids:
+                    # Applied when this process wrote it
+                    self._local_change_ids.discard(change_id)
+                else:
+                    remote.append((entity, entity_key))
+        if remote:
+            self._apply_changes(remote)
+        return len(remote)
 
-    def add_user(self, user_id, first_name, username):
-        """Add or update user"""
+    @serialized_write
+    def prune_change_log(self, retention_hours=None):
+        """Delete change_log rows older than the retention period"""
+        retention_hours = retention_hours or CHANGE_FEED_CONFIG['retention_hours']
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name)
             cursor = conn.cursor()
             
-            cursor.execute('''
-                INSERT OR REPLACE INTO users (user_id, first_name, username)
-                VALUES (?, ?, ?)
-            ''', (user_id, first_name, username))
+            cursor.execute(
+                "DELETE FROM change_log WHERE changed_at < datetime('now', ?)",
+                (f'-{retention_hours} hours',)
+            )
             
             conn.commit()
-            logger.debug(f"User {user_id} added/updated successfully")
+            logger.debug(f"Pruned {cursor.rowcount} change_log rows")
+            return cursor.rowcount
             
         except Exception as e:
-            logger.error(f"Error adding user {user_id}: {e}")
+            logger.error(f"Error pruning change_log: {e}")
             if conn:
                 conn.rollback()
             raise
@@ -152,36 +710,81 @@ class Database:
             if conn:
                 conn.close()
 
-    def get_available_slots(self):
-        """Get all available appointment slots"""
+    def add_user(self, user_id, first_name, username):
+        """Add or update user"""
+        self.upsert_users([(user_id, first_name, username)])
+
+    @serialized_write
+    def upsert_users(self, users):
+        """Add or update many (user_id, first_name, username) rows in one transaction.
+
+        join_date is kept for existing users and unchanged rows are not rewritten.
+        """
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name)
             cursor = conn.cursor()
             
-            cursor.execute('SELECT id, slot_text FROM slots WHERE is_available = 1')
-            slots = cursor.fetchall()
+            cursor.executemany('''
+                INSERT INTO users (user_id, first_name, username)
+                VALUES (?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    first_name = excluded.first_name,
+                    username = excluded.username
+                WHERE first_name IS NOT excluded.first_name
+                   OR username IS NOT excluded.username
+            ''', users)
             
-            return slots
+            conn.commit()
+            logger.debug(f"{len(users)} users added/updated successfully")
             
         except Exception as e:
-            logger.error(f"Error getting available slots: {e}")
-            return []
+            logger.error(f"Error adding {len(users)} users: {e}")
+            if conn:
+                conn.rollback()
+            raise
         finally:
             if conn:
                 conn.close()
 
+    def get_available_slots(self):
+        """Get all available appointment slots"""
+        try:
+            return list(self._cached(('slots',), self._read_available_slots))
+        except Exception as e:
+            logger.error(f"Error getting available slots: {e}")
+            return []
+
+    def _read_available_slots(self):
+        conn = connect(self.db_name)
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id, slot_text FROM slots WHERE is_available = 1')
+            return tuple(cursor.fetchall())
+        finally:
+            conn.close()
+
+    @serialized_write
     def add_slot(self, slot_text):
-        """Add new appointment slot"""
+        """Add new appointment slot; returns the hold when it went to a waitlisted user, see _release_slot"""
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name)
             cursor = conn.cursor()
             
-            cursor.execute('INSERT INTO slots (slot_text) VALUES (?)', (slot_text,))
+            cursor.execute(
+                'INSERT INTO slots (slot_text, slot_day, is_available) VALUES (?, ?, 0)',
+                (slot_text, parse_slot_day(slot_text))
+            )
+            slot_id = cursor.lastrowid
+            hold = self._release_slot(cursor, slot_id)
             
+            changes = [('slots', slot_id)]
+            change_ids = self._log_changes(cursor, changes)
             conn.commit()
+            self._apply_changes(changes, change_ids)
             logger.info(f"Slot added: {slot_text}")
+            return hold
             
         except Exception as e:
             logger.error(f"Error adding slot: {e}")
@@ -192,16 +795,21 @@ class Database:
             if conn:
                 conn.close()
 
+    @serialized_write
     def delete_slot(self, slot_id):
         """Delete appointment slot"""
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name)
             cursor = conn.cursor()
             
             cursor.execute('DELETE FROM slots WHERE id = ?', (slot_id,))
+            cursor.execute('DELETE FROM slot_holds WHERE slot_id = ?', (slot_id,))
             
+            changes = [('slots', slot_id)]
+            change_ids = self._log_changes(cursor, changes)
             conn.commit()
+            self._apply_changes(changes, change_ids)
             logger.info(f"Slot deleted: {slot_id}")
             
         except Exception as e:
@@ -213,25 +821,42 @@ class Database:
             if conn:
                 conn.close()
 
+    @serialized_write
     def create_reservation(self, user_id, slot_id):
-        """Create temporary reservation"""
+        """Create temporary reservation; returns None when the slot was taken in the meantime"""
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name)
             cursor = conn.cursor()
             
             pending_time = datetime.now()
             
+            # Claim the slot first: callers checked availability against a cache, and other chats book concurrently
+            cursor.execute('''
+                UPDATE slots SET is_available = 0
+                WHERE id = ? AND (
+                    is_available = 1
+                    OR EXISTS (SELECT 1 FROM slot_holds WHERE slot_id = ? AND user_id = ? AND expires_at > ?)
+                )
+            ''', (slot_id, slot_id, user_id, pending_time))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                logger.info(f"Slot {slot_id} no longer available for user {user_id}")
+                return None
+            
             cursor.execute('''
                 INSERT INTO reservations (user_id, slot_id, status, pending_time)
                 VALUES (?, ?, 'pending', ?)
             ''', (user_id, slot_id, pending_time))
+            reservation_id = cursor.lastrowid
             
-            # Make slot unavailable
-            cursor.execute('UPDATE slots SET is_available = 0 WHERE id = ?', (slot_id,))
+            # A hold on the slot has served its purpose
+            cursor.execute('DELETE FROM slot_holds WHERE slot_id = ?', (slot_id,))
             
-            reservation_id = cursor.lastrowid
+            changes = [('reservation', reservation_id), ('slots', slot_id)]
+            change_ids = self._log_changes(cursor, changes)
             conn.commit()
+            self._apply_changes(changes, change_ids)
             
             logger.info(f"Reservation created: {reservation_id} for user {user_id}, slot {slot_id}")
             return reservation_id
@@ -245,11 +870,12 @@ class Database:
             if conn:
                 conn.close()
 
+    @serialized_write
     def update_reservation_receipt(self, reservation_id, receipt_photo_id):
         """Update reservation with receipt photo"""
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name)
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -258,7 +884,10 @@ class Database:
                 WHERE id = ?
             ''', (receipt_photo_id, reservation_id))
             
+            changes = [('reservation', reservation_id)]
+            change_ids = self._log_changes(cursor, changes)
             conn.commit()
+            self._apply_changes(changes, change_ids)
             logger.info(f"Receipt updated for reservation {reservation_id}")
             
         except Exception as e:
@@ -270,21 +899,30 @@ class Database:
             if conn:
                 conn.close()
 
+    @serialized_write
     def confirm_reservation(self, reservation_id):
-        """Confirm reservation by admin"""
+        """Confirm reservation by admin; returns False when it was no longer pending"""
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name)
             cursor = conn.cursor()
             
             cursor.execute('''
                 UPDATE reservations 
                 SET status = 'confirmed' 
-                WHERE id = ?
+                WHERE id = ? AND status = 'pending'
             ''', (reservation_id,))
+            if cursor.rowcount != 1:
+                # Another admin already handled the receipt, or it expired
+                logger.warning(f"Reservation {reservation_id} is no longer pending, not confirmed")
+                return False
             
+            changes = [('reservation', reservation_id)]
+            change_ids = self._log_changes(cursor, changes)
             conn.commit()
+            self._apply_changes(changes, change_ids)
             logger.info(f"Reservation confirmed: {reservation_id}")
+            return True
             
         except Exception as e:
             logger.error(f"Error confirming reservation {reservation_id}: {e}")
@@ -295,11 +933,16 @@ class Database:
             if conn:
                 conn.close()
 
+    @serialized_write
     def reject_reservation(self, reservation_id):
-        """Reject reservation and free the slot"""
+        """Reject reservation and free the slot.
+
+        Returns (rejected, hold): rejected is False when the reservation was no
+        longer pending, hold is set when the slot went to a waitlisted user.
+        """
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name)
             cursor = conn.cursor()
             
             # Get slot_id before rejection
@@ -313,16 +956,25 @@ class Database:
                 cursor.execute('''
                     UPDATE reservations 
                     SET status = 'rejected' 
-                    WHERE id = ?
+                    WHERE id = ? AND status = 'pending'
                 ''', (reservation_id,))
+                if cursor.rowcount != 1:
+                    # Another admin already handled the receipt, or it expired; the slot isn't ours to free
+                    logger.warning(f"Reservation {reservation_id} is no longer pending, not rejected")
+                    return False, None
                 
-                # Make slot available again
-                cursor.execute('UPDATE slots SET is_available = 1 WHERE id = ?', (slot_id,))
+                # Offer the slot to the waitlist or make it available again
+                hold = self._release_slot(cursor, slot_id)
                 
+                changes = [('reservation', reservation_id), ('slots', slot_id)]
+                change_ids = self._log_changes(cursor, changes)
                 conn.commit()
+                self._apply_changes(changes, change_ids)
                 logger.info(f"Reservation rejected: {reservation_id}, slot {slot_id} freed")
+                return True, hold
             else:
                 logger.warning(f"Reservation {reservation_id} not found for rejection")
+                return False, None
                 
         except Exception as e:
             logger.error(f"Error rejecting reservation {reservation_id}: {e}")
@@ -337,7 +989,7 @@ class Database:
         """Get reservations that have expired"""
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name)
             cursor = conn.cursor()
             
             timeout_time = datetime.now() - timedelta(minutes=timeout_minutes)
@@ -357,18 +1009,26 @@ class Database:
             if conn:
                 conn.close()
 
+    @serialized_write
     def cancel_expired_reservation(self, reservation_id, slot_id):
-        """Cancel expired reservation and free slot"""
+        """Cancel expired reservation and free slot; returns the hold when it went to a waitlisted user"""
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name)
             cursor = conn.cursor()
             
-            cursor.execute('DELETE FROM reservations WHERE id = ?', (reservation_id,))
-            cursor.execute('UPDATE slots SET is_available = 1 WHERE id = ?', (slot_id,))
+            cursor.execute("DELETE FROM reservations WHERE id = ? AND status = 'pending'", (reservation_id,))
+            if cursor.rowcount != 1:
+                # Confirmed or rejected since it was listed as expired
+                return None
+            hold = self._release_slot(cursor, slot_id)
             
+            changes = [('reservation', reservation_id), ('slots', slot_id)]
+            change_ids = self._log_changes(cursor, changes)
             conn.commit()
+            self._apply_changes(changes, change_ids)
             logger.info(f"Expired reservation cancelled: {reservation_id}, slot {slot_id} freed")
+            return hold
             
         except Exception as e:
             logger.error(f"Error cancelling expired reservation {reservation_id}: {e}")
@@ -379,35 +1039,497 @@ class Database:
             if conn:
                 conn.close()
 
-    def get_setting(self, key):
-        """Get setting value"""
+    def _release_slot(self, cursor, slot_id):
+        """Hold a freed slot for the first waitlisted user whose range covers its day, or make it available.
+
+        Runs inside the transaction that freed the slot. Dated entries are
+        found through waitlist_days by the slot's day, "any time" entries
+        through idx_waitlist_any_day, and the one that joined first gets the
+        slot; a slot whose text names no day only goes to "any time" entries.
+        Returns the hold as (user_id, slot_id, slot_text), or None when the
+        slot became available to everyone.
+        """
+        cursor.execute('SELECT slot_text, slot_day FROM slots WHERE id = ?', (slot_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        slot_text, slot_day = row
+        
+        candidates = []
+        if WAITLIST_CONFIG['enabled'] and (slot_day is None or slot_day >= date.today().isoformat()):
+            if slot_day is not None:
+                cursor.execute(
+                    'SELECT waitlist_id FROM waitlist_days WHERE day = ? ORDER BY waitlist_id LIMIT 1', (slot_day,)
+                )
+                candidates.extend(waitlist_id for waitlist_id, in cursor.fetchall())
+            cursor.execute('SELECT id FROM waitlist WHERE any_day = 1 ORDER BY id LIMIT 1')
+            candidates.extend(waitlist_id for waitlist_id, in cursor.fetchall())
+        
+        if not candidates:
+            cursor.execute('UPDATE slots SET is_available = 1 WHERE id = ?', (slot_id,))
+            return None
+        
+        waitlist_id = min(candidates)
+        cursor.execute('SELECT user_id FROM waitlist WHERE id = ?', (waitlist_id,))
+        user_id = cursor.fetchone()[0]
+        # One offer per entry: a user who lets the hold expire has to join again
+        cursor.execute('DELETE FROM waitlist_days WHERE waitlist_id = ?', (waitlist_id,))
+        cursor.execute('DELETE FROM waitlist WHERE id = ?', (waitlist_id,))
+        cursor.execute('UPDATE slots SET is_available = 0 WHERE id = ?', (slot_id,))
+        # A slot being freed can't be held already; a conflict here means it was freed twice
+        cursor.execute(
+            'INSERT INTO slot_holds (slot_id, user_id, expires_at) VALUES (?, ?, ?)',
+            (slot_id, user_id, datetime.now() + timedelta(minutes=WAITLIST_CONFIG['hold_minutes']))
+        )
+        logger.info(f"Slot {slot_id} held for waitlisted user {user_id}")
+        return user_id, slot_id, slot_text
+
+    @serialized_write
+    def join_waitlist(self, user_id, days=None):
+        """Put the user on the waitlist for slots within days from today, any slot when days is None.
+
+        Replaces an earlier entry of the user, who then moves to the back of the line.
+        Raises ValueError for days other than WAITLIST_CONFIG['ranges_days'], which
+        would come from a stale or crafted button.
+        """
+        if days is not None and days not in WAITLIST_CONFIG['ranges_days']:
+            raise ValueError(f"Waitlist range of {days} days is not offered")
+        
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name)
             cursor = conn.cursor()
             
-            cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
-            result = cursor.fetchone()
+            today = date.today()
+            any_day = days is None
+            day_to = today + timedelta(days=WAITLIST_CONFIG['any_days'] if any_day else days)
+            
+            cursor.execute(
+                'DELETE FROM waitlist_days WHERE waitlist_id IN (SELECT id FROM waitlist WHERE user_id = ?)', (user_id,)
+            )
+            cursor.execute('DELETE FROM waitlist WHERE user_id = ?', (user_id,))
+            cursor.execute(
+                'INSERT INTO waitlist (user_id, day_from, day_to, any_day) VALUES (?, ?, ?, ?)',
+                (user_id, today.isoformat(), day_to.isoformat(), int(any_day))
+            )
+            waitlist_id = cursor.lastrowid
+            if not any_day:
+                cursor.executemany(
+                    'INSERT INTO waitlist_days (day, waitlist_id) VALUES (?, ?)',
+                    [((today + timedelta(days=offset)).isoformat(), waitlist_id) for offset in range(days + 1)]
+                )
             
-            return result[0] if result else None
+            conn.commit()
+            logger.info(f"User {user_id} joined the waitlist until {day_to}")
             
         except Exception as e:
-            logger.error(f"Error getting setting {key}: {e}")
+            logger.error(f"Error adding user {user_id} to the waitlist: {e}")
+            if conn:
+                conn.rollback()
+            raise
+        finally:
+            if conn:
+                conn.close()
+
+    @serialized_write
+    def leave_waitlist(self, user_id):
+        """Take the user off the waitlist"""
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'DELETE FROM waitlist_days WHERE waitlist_id IN (SELECT id FROM waitlist WHERE user_id = ?)', (user_id,)
+            )
+            cursor.execute('DELETE FROM waitlist WHERE user_id = ?', (user_id,))
+            
+            conn.commit()
+            logger.info(f"User {user_id} left the waitlist")
+            
+        except Exception as e:
+            logger.error(f"Error removing user {user_id} from the waitlist: {e}")
+            if conn:
+                conn.rollback()
+            raise
+        finally:
+            if conn:
+                conn.close()
+
+    def is_on_waitlist(self, user_id):
+        """Whether the user has a waitlist entry"""
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT 1 FROM waitlist WHERE user_id = ?', (user_id,))
+            return cursor.fetchone() is not None
+            
+        except Exception as e:
+            logger.error(f"Error checking waitlist of user {user_id}: {e}")
+            return False
+        finally:
+            if conn:
+                conn.close()
+
+    def get_slot_hold(self, slot_id):
+        """Return (user_id, slot_text) of an unexpired hold on the slot, or None"""
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT h.user_id, s.slot_text FROM slot_holds h
+                JOIN slots s ON s.id = h.slot_id
+                WHERE h.slot_id = ? AND h.expires_at > ?
+            ''', (slot_id, datetime.now()))
+            return cursor.fetchone()
+            
+        except Exception as e:
+            logger.error(f"Error getting hold of slot {slot_id}: {e}")
             return None
         finally:
             if conn:
                 conn.close()
 
+    @serialized_write
+    def expire_slot_holds(self):
+        """Pass slots whose hold ran out on to the next waiting user, or make them available.
+
+        Returns the new holds, see _release_slot.
+        """
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT slot_id FROM slot_holds WHERE expires_at <= ?', (datetime.now(),))
+            expired = [slot_id for slot_id, in cursor.fetchall()]
+            if not expired:
+                return []
+            
+            holds = []
+            for slot_id in expired:
+                cursor.execute('DELETE FROM slot_holds WHERE slot_id = ?', (slot_id,))
+                hold = self._release_slot(cursor, slot_id)
+                if hold:
+                    holds.append(hold)
+            
+            changes = [('slots', slot_id) for slot_id in expired]
+            change_ids = self._log_changes(cursor, changes)
+            conn.commit()
+            self._apply_changes(changes, change_ids)
+            logger.info(f"{len(expired)} slot holds expired, {len(holds)} passed on")
+            return holds
+            
+        except Exception as e:
+            logger.error(f"Error expiring slot holds: {e}")
+            if conn:
+                conn.rollback()
+            raise
+        finally:
+            if conn:
+                conn.close()
+
+    @serialized_write
+    def prune_waitlist(self):
+        """Drop waitlist days that have passed and entries whose range ended; returns the entries dropped"""
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+            
+            today = date.today().isoformat()
+            cursor.execute('DELETE FROM waitlist_days WHERE day < ?', (today,))
+            cursor.execute('DELETE FROM waitlist WHERE day_to < ?', (today,))
+            removed = cursor.rowcount
+            
+            conn.commit()
+            if removed:
+                logger.info(f"Pruned {removed} ended waitlist entries")
+            return removed
+            
+        except Exception as e:
+            logger.error(f"Error pruning waitlist: {e}")
+            if conn:
+                conn.rollback()
+            raise
+        finally:
+            if conn:
+                conn.close()
+
+    def archive_reservations(self, archive_after_days=None, batch_size=None):
+        """Move confirmed and rejected reservations older than the cutoff to reservations_archive.
+
+        Each batch is its own write transaction; returns the number of rows moved.
+        """
+        archive_after_days = archive_after_days if archive_after_days is not None else ARCHIVE_CONFIG['archive_after_days']
+        batch_size = batch_size or ARCHIVE_CONFIG['batch_size']
+        moved = 0
+        while True:
+            count = self._archive_reservation_batch(archive_after_days, batch_size)
+            moved += count
+            if count < batch_size:
+                break
+        if moved:
+            logger.info(f"Archived {moved} reservations older than {archive_after_days} days")
+        return moved
+
+    @serialized_write
+    def _archive_reservation_batch(self, archive_after_days, batch_size):
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+            
+            # Old rows have the lowest ids, so the scan in id order stops early
+            cursor.execute('''
+                SELECT id FROM reservations
+                WHERE status IN ('confirmed', 'rejected')
+                AND created_at < datetime('now', ?)
+                ORDER BY id
+                LIMIT ?
+            ''', (f'-{archive_after_days} days', batch_size))
+            ids = [(row[0],) for row in cursor.fetchall()]
+            
+            cursor.executemany('''
+                INSERT INTO reservations_archive
+                    (id, user_id, slot_id, status, receipt_photo_id, pending_time, created_at)
+                SELECT id, user_id, slot_id, status, receipt_photo_id, pending_time, created_at
+                FROM reservations WHERE id = ?
+            ''', ids)
+            cursor.executemany('DELETE FROM reservations WHERE id = ?', ids)
+            cursor.executemany('DELETE FROM expiry_warnings WHERE reservation_id = ?', ids)
+            
+            conn.commit()
+            return len(ids)
+            
+        except Exception as e:
+            logger.error(f"Error archiving reservations: {e}")
+            if conn:
+                conn.rollback()
+            raise
+        finally:
+            if conn:
+                conn.close()
+
+    @serialized_write
+    def log_maintenance(self, task, duration_ms, detail=''):
+        """Record how long a backup or maintenance task took"""
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'INSERT INTO maintenance_log (task, duration_ms, detail) VALUES (?, ?, ?)',
+                (task, duration_ms, detail)
+            )
+            
+            conn.commit()
+            
+        except Exception as e:
+            logger.error(f"Error logging maintenance task {task}: {e}")
+            if conn:
+                conn.rollback()
+        finally:
+            if conn:
+                conn.close()
+
+    def get_last_maintenance(self):
+        """Return the latest (task, duration_ms, detail, finished_at) per task"""
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT task, duration_ms, detail, finished_at FROM maintenance_log
+                WHERE id IN (SELECT MAX(id) FROM maintenance_log GROUP BY task)
+                ORDER BY task
+            ''')
+            return cursor.fetchall()
+            
+        except Exception as e:
+            logger.error(f"Error getting maintenance log: {e}")
+            return []
+        finally:
+            if conn:
+                conn.close()
+
+    @serialized_write
+    def insert_events(self, events):
+        """Append (event, user_id, created_at) rows in one transaction"""
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+            
+            cursor.executemany('INSERT INTO events (event, user_id, created_at) VALUES (?, ?, ?)', events)
+            
+            conn.commit()
+            logger.debug(f"{len(events)} events recorded")
+            
+        except Exception as e:
+            logger.error(f"Error recording {len(events)} events: {e}")
+            if conn:
+                conn.rollback()
+            raise
+        finally:
+            if conn:
+                conn.close()
+
+    @serialized_write
+    def rollup_events(self):
+        """Add events not rolled up yet to event_daily; returns how many were added.
+
+        Only rows after event_rollup_state.last_event_id are read, and the
+        write lock is taken first so two processes never add the same events.
+        """
+        conn = None
+        try:
+            conn = connect(self.db_name, isolation_level=None)
+            cursor = conn.cursor()
+            
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT last_event_id FROM event_rollup_state WHERE id = 1')
+            last_event_id = cursor.fetchone()[0]
+            cursor.execute('SELECT COALESCE(MAX(id), 0), COUNT(*) FROM events WHERE id > ?', (last_event_id,))
+            max_event_id, added = cursor.fetchone()
+            if not added:
+                cursor.execute('COMMIT')
+                return 0
+            
+            new_events = (last_event_id, max_event_id)
+            cursor.execute('''
+                INSERT INTO event_daily (day, event, count)
+                SELECT date(created_at), event, COUNT(*) FROM events
+                WHERE id > ? AND id <= ?
+                GROUP BY date(created_at), event
+                ON CONFLICT (day, event) DO UPDATE SET count = count + excluded.count
+            ''', new_events)
+            cursor.execute('''
+                INSERT OR IGNORE INTO event_daily_users (day, event, user_id)
+                SELECT DISTINCT date(created_at), event, user_id FROM events
+                WHERE id > ? AND id <= ? AND user_id IS NOT NULL
+            ''', new_events)
+            # Only the days and events that got new rows are recounted
+            cursor.execute('''
+                UPDATE event_daily SET users = (
+                    SELECT COUNT(*) FROM event_daily_users u
+                    WHERE u.day = event_daily.day AND u.event = event_daily.event
+                )
+                WHERE (day, event) IN (
+                    SELECT date(created_at), event FROM events WHERE id > ? AND id <= ?
+                )
+            ''', new_events)
+            cursor.execute('UPDATE event_rollup_state SET last_event_id = ? WHERE id = 1', (max_event_id,))
+            cursor.execute('COMMIT')
+            return added
+            
+        except Exception as e:
+            logger.error(f"Error rolling up events: {e}")
+            if conn and conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            if conn:
+                conn.close()
+
+    def get_funnel(self, events, weeks=4):
+        """Return {week: {event: (count, users)}} for the last weeks, keyed by each week's Monday.
+
+        users is the number of distinct users in the week, so someone active
+        on several days counts once.
+        """
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+            
+            placeholders = ', '.join('?' for _ in events)
+            # Monday of the week weeks - 1 before this one; weeks run Monday to Sunday across New Year too
+            params = (f'-{(weeks - 1) * 7} days', *events)
+            cursor.execute(f'''
+                SELECT date(day, 'weekday 0', '-6 days') AS week, event, SUM(count)
+                FROM event_daily
+                WHERE day >= date('now', 'weekday 0', '-6 days', ?) AND event IN ({placeholders})
+                GROUP BY week, event
+            ''', params)
+            counts = cursor.fetchall()
+            cursor.execute(f'''
+                SELECT date(day, 'weekday 0', '-6 days') AS week, event, COUNT(DISTINCT user_id)
+                FROM event_daily_users
+                WHERE day >= date('now', 'weekday 0', '-6 days', ?) AND event IN ({placeholders})
+                GROUP BY week, event
+            ''', params)
+            users = {(week, event): count for week, event, count in cursor.fetchall()}
+            
+            funnel = {}
+            for week, event, count in sorted(counts):
+                funnel.setdefault(week, {})[event] = (count, users.get((week, event), 0))
+            return funnel
+            
+        except Exception as e:
+            logger.error(f"Error getting funnel: {e}")
+            return {}
+        finally:
+            if conn:
+                conn.close()
+
+    def count_reservations(self, status):
+        """Count reservations with the given status"""
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+            
+            # Pending reservations are never archived, other statuses may be in both tables
+            table = 'reservations' if status == 'pending' else 'all_reservations'
+            cursor.execute(f'SELECT COUNT(*) FROM {table} WHERE status = ?', (status,))
+            return cursor.fetchone()[0]
+            
+        except Exception as e:
+            logger.error(f"Error counting {status} reservations: {e}")
+            return 0
+        finally:
+            if conn:
+                conn.close()
+
+    def get_setting(self, key):
+        """Get setting value, served from memory until the change feed reports a write"""
+        try:
+            return self._cached(('setting', key), self._read_setting, key)
+        except Exception as e:
+            logger.error(f"Error getting setting {key}: {e}")
+            return None
+
+    def _read_setting(self, key):
+        conn = connect(self.db_name)
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
+            result = cursor.fetchone()
+            return result[0] if result else None
+        finally:
+            conn.close()
+
+    @serialized_write
     def set_setting(self, key, value):
         """Set setting value"""
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name)
             cursor = conn.cursor()
             
             cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
             
+            changes = [('setting', key)]
+            change_ids = self._log_changes(cursor, changes)
             conn.commit()
+            self._apply_changes(changes, change_ids)
             logger.debug(f"Setting updated: {key}")
             
         except Exception as e:
@@ -423,7 +1545,7 @@ class Database:
         """Get all user IDs for broadcasting"""
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name)
             cursor = conn.cursor()
             
             cursor.execute('SELECT user_id FROM users')
@@ -442,7 +1564,7 @@ class Database:
         """Get reservations that will expire soon (for notifications)"""
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name)
             cursor = conn.cursor()
             
             # Get reservations that will expire in warning_minutes
@@ -469,21 +1591,14 @@ class Database:
             if conn:
                 conn.close()
 
+    @serialized_write
     def mark_expiry_warning_sent(self, reservation_id):
         """Mark that expiry warning has been sent for a reservation"""
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name)
             cursor = conn.cursor()
             
-            # Create expiry_warnings table if it doesn't exist
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS expiry_warnings (
-                    reservation_id INTEGER PRIMARY KEY,
-                    warning_sent_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
             cursor.execute('''
                 INSERT OR IGNORE INTO expiry_warnings (reservation_id)
                 VALUES (?)
@@ -498,17 +1613,18 @@ class Database:
                 conn.close()
 
     def get_reservation_by_id(self, reservation_id):
-        """Get reservation details by ID"""
+        """Get reservation details by ID; first_name and username are None while the user's row is unwritten"""
         conn = None
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = connect(self.db_name)
             cursor = conn.cursor()
             
+            # /start upserts users through UserWriteBuffer, so the row may not exist yet
             cursor.execute('''
                 SELECT r.*, s.slot_text, u.first_name, u.username 
-                FROM reservations r
+                FROM all_reservations r
                 JOIN slots s ON r.slot_id = s.id
-                JOIN users u ON r.user_id = u.user_id
+                LEFT JOIN users u ON r.user_id = u.user_id
                 WHERE r.id = ?
             ''', (reservation_id,))
             
@@ -520,4 +1636,45 @@ class Database:
             return None
         finally:
             if conn:
-                conn.close()
\ No newline at end of file
+                conn.close()
+
+    def get_uploaded_file_id(self, content_hash):
+        """Return the Telegram file_id of an image uploaded before, or None"""
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT file_id FROM uploaded_files WHERE content_hash = ?', (content_hash,))
+            result = cursor.fetchone()
+            return result[0] if result else None
+            
+        except Exception as e:
+            logger.error(f"Error getting uploaded file {content_hash}: {e}")
+            return None
+        finally:
+            if conn:
+                conn.close()
+
+    @serialized_write
+    def save_uploaded_file_id(self, content_hash, file_id):
+        """Remember the Telegram file_id of an uploaded image"""
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'INSERT OR REPLACE INTO uploaded_files (content_hash, file_id) VALUES (?, ?)',
+                (content_hash, file_id)
+            )
+            
+            conn.commit()
+            
+        except Exception as e:
+            logger.error(f"Error saving uploaded file {content_hash}: {e}")
+            if conn:
+                conn.rollback()
+        finally:
+            if conn:
+                conn.close()
@@ -1,11 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 import logging
-import requests
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, Update
+from telegram.error import BadRequest
 from telegram.ext import CallbackContext, ConversationHandler
-from database import Database
-from config import ADMIN_IDS, AI_API_CONFIG
+from database import get_database, get_user_write_buffer
+from membership import requires_channel_membership
+from callback_router import Payload, encode_callback
+from analytics import record_event
+from ai_providers import ai_router, ProviderError
+from send_queue import queue_send
+from waitlist import notify_slot_offers
+from image_processing import image_executor, postprocess_image
+from config import ADMIN_IDS, AI_API_CONFIG, DISPATCH_CONFIG, PERSIAN_TEXTS, WAITLIST_CONFIG
 
 logger = logging.getLogger(__name__)
 
@@ -13,32 +24,22 @@ logger = logging.getLogger(__name__)
 AI_DESIGN_DESCRIPTION = 1
 BOOKING_RECEIPT_UPLOAD = 2
 
-db = Database()
+# Keeps the admins' receipt caption well under Telegram's 1024 characters
+DESIGN_DESCRIPTION_CAPTION_CHARS = 300
 
+db = get_database()
+user_write_buffer = get_user_write_buffer()
+
+# Runs AI requests so the variants of one description are generated in parallel
+ai_executor = ThreadPoolExecutor(max_workers=AI_API_CONFIG['max_parallel_requests'], thread_name_prefix='ai')
+
+@requires_channel_membership
 def start(update: Update, context: CallbackContext):
     """Start command handler"""
     user = update.effective_user
     
-    try:
-        db.add_user(user.id, user.first_name, user.username)
-    except Exception as e:
-        logger.error(f"Error adding user {user.id}: {e}")
-    
-    # Check forced subscription
-    force_channel = db.get_setting('force_join_channel')
-    if force_channel:
-        try:
-            member = context.bot.get_chat_member(force_channel, user.id)
-            if member.status in ['left', 'kicked']:
-                keyboard = [[InlineKeyboardButton("عضویت در کانال", url=f"https://t.me/{force_channel.replace('@', '')}")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                update.message.reply_text(
-                    "برای استفاده از ربات ابتدا در کانال ما عضو شوید:",
-                    reply_markup=reply_markup
-                )
-                return
-        except Exception as e:
-            logger.warning(f"Error checking channel membership: {e}")
+    # Written in batches by a background thread, see UserWriteBuffer
+    user_write_buffer.add(user.id, user.first_name, user.username)
     
     welcome_message = db.get_setting('welcome_message')
     
@@ -61,26 +62,42 @@ def start(update: Update, context: CallbackContext):
     reply_markup = InlineKeyboardMarkup(keyboard)
     update.message.reply_text(welcome_message, reply_markup=reply_markup)
 
+@requires_channel_membership
 def button_handler(update: Update, context: CallbackContext):
     """Handle inline button presses"""
     query = update.callback_query
     query.answer()
     
-    if query.data == 'ai_design':
+    action, args = context.callback_action, context.callback_args
+    if action == 'ai_design':
         start_ai_design(query, context)
-    elif query.data == 'book_appointment':
+    elif action == 'book_appointment':
         show_available_slots(query, context)
-    elif query.data == 'contact':
+    elif action == 'contact':
         show_contact_info(query, context)
-    elif query.data.startswith('book_slot_'):
-        slot_id = int(query.data.split('_')[2])
-        book_slot(query, context, slot_id)
-    elif query.data.startswith('book_discount_'):
-        slot_id = int(query.data.split('_')[2])
-        book_slot_with_discount(query, context, slot_id)
-    elif query.data == 'back_to_main':
+    elif action == 'book_appointment_discount':
+        record_event('discount_tap', query.from_user.id)
+        book_slot_with_discount(query, context, design=design_payload(args))
+    elif action == 'book_slot':
+        # Returning the state starts the booking conversation when called as its entry point
+        return book_slot(query, context, args[0])
+    elif action == 'book_discount':
+        return book_slot_with_discount(query, context, args[0], design=design_payload(args[1:]))
+    elif action == 'waitlist_join':
+        join_waitlist(query, context, args[0] or None)
+    elif action == 'waitlist_leave':
+        leave_waitlist(query, context)
+    elif action == 'back_to_main':
         back_to_main_menu(query, context)
 
+def design_payload(args):
+    """The design a discount button was pressed for: its Payload, or one made from an older button's variant number"""
+    if not args or args[0] is None:
+        return None
+    if isinstance(args[0], Payload):
+        return args[0]
+    return Payload({'variant': args[0]})
+
 def start_ai_design(query, context):
     """Start AI design conversation"""
     ai_prompt = db.get_setting('ai_design_prompt') or PERSIAN_TEXTS['ai_design_prompt']
@@ -92,6 +109,13 @@ def start_ai_design(query, context):
     )
     return AI_DESIGN_DESCRIPTION
 
+@requires_channel_membership
+def ai_design_entry(update: Update, context: CallbackContext):
+    """Entry point of the AI design conversation"""
+    update.callback_query.answer()
+    record_event('ai_design_open', update.effective_user.id)
+    return start_ai_design(update.callback_query, context)
+
 def handle_ai_design_description(update: Update, context: CallbackContext):
     """Process AI design description"""
     description = update.message.text
@@ -103,125 +127,260 @@ def handle_ai_design_description(update: Update, context: CallbackContext):
     discount_button_text = db.get_setting('booking_discount_button') or PERSIAN_TEXTS['booking_discount_button']
     back_button_text = db.get_setting('back_button') or PERSIAN_TEXTS['back_button']
     
+    # Fail fast instead of waiting out timeouts while every provider is down
+    if not ai_router.available():
+        update.message.reply_text(
+            error_message,
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(back_button_text, callback_data='back_to_main')]])
+        )
+        return ConversationHandler.END
+    
     # Show processing message
     processing_msg = update.message.reply_text(processing_message)
     
-    # Call AI API
-    try:
-        generated_image_path = call_ai_api(description)
+    # Call AI API, one request per variant in parallel
+    styles = design_variant_styles()
+    generation = DesignGeneration(
+        context.bot, update.message, processing_msg, len(styles), processing_message,
+        result_message, discount_button_text, error_message, back_button_text
+    )
+    for index, style in enumerate(styles):
+        future = ai_executor.submit(call_ai_api, description, style)
+        future.add_done_callback(partial(generation.variant_finished, index))
+    
+    if not DISPATCH_CONFIG['nonblocking_ai']:
+        if not generation.done.wait(DISPATCH_CONFIG['ai_wait_timeout_seconds']):
+            # The design is still delivered when it finishes; just free this worker
+            logger.warning(f"AI design for user {update.effective_user.id} still running, not waiting any longer")
+    
+    return ConversationHandler.END
+
+class DesignGeneration:
+    """Variants of one description being generated.
+
+    Each finished variant is shown in a single preview message while the
+    others are generated; when the last one finishes the set is sent as one
+    album and the preview is removed. Completion is driven by callbacks of
+    the AI requests, so no update worker waits for the multi-second generation.
+    """
+
+    def __init__(self, bot, message, processing_msg, total, processing_message, result_message,
+                 discount_button_text, error_message, back_button_text):
+        self.bot = bot
+        self.message = message
+        self.processing_msg = processing_msg
+        self.total = total
+        self.processing_message = processing_message
+        self.result_message = result_message
+        self.discount_button_text = discount_button_text
+        self.error_message = error_message
+        self.back_button_text = back_button_text
+        self.images = {}
+        self.completed = 0
+        self.preview_msg = None
+        self.delivered = False
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+        # Preview and album uploads of one generation go out one at a time
+        self._send_lock = threading.Lock()
+
+    def variant_finished(self, index, future):
+        try:
+            image = future.result()
+        except Exception as e:
+            logger.error(f"AI API error: {e}")
+            image = None
         
-        if generated_image_path:
-            # Delete processing message
+        with self._lock:
+            if image:
+                self.images[index] = image
+            self.completed += 1
+            completed = self.completed
+        
+        try:
+            self._variant_done(image, completed)
+        finally:
+            # Even when delivery could not be started, so a blocking handler never waits forever
+            if completed == self.total:
+                self.done.set()
+
+    def _variant_done(self, image, completed):
+        if completed < self.total:
+            # Show progress while the remaining variants are generated
+            progress = f"🎨 {completed} از {self.total} طرح آماده شد"
             try:
-                context.bot.delete_message(
-                    chat_id=processing_msg.chat_id,
-                    message_id=processing_msg.message_id
-                )
+                self.processing_msg.edit_text(f"{self.processing_message}\n\n{progress}")
             except Exception as e:
-                logger.warning(f"Could not delete processing message: {e}")
-            
-            # Send generated image with discount offer
-            keyboard = [[InlineKeyboardButton(discount_button_text, callback_data='book_appointment_discount')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
+                logger.warning(f"Could not update processing message: {e}")
+            if image:
+                image_executor.submit(self.show_preview, image, progress)
+            return
+        
+        if not self.images:
+            logger.error("AI API error: API call failed")
+            show_ai_design_error(self.message, self.processing_msg, self.error_message, self.back_button_text)
+        else:
+            # Compression and upload continue on the image executor
+            image_executor.submit(self.deliver, [self.images[index] for index in sorted(self.images)])
+
+    def show_preview(self, image, caption):
+        """Show a finished variant in the preview message; runs on the image executor"""
+        with self._send_lock:
+            if self.delivered:
+                return
             try:
-                # Send photo from local file
-                with open(generated_image_path, 'rb') as photo_file:
-                    update.message.reply_photo(
-                        photo=photo_file,
-                        caption=result_message,
-                        reply_markup=reply_markup
-                    )
-                
-                # Clean up temporary file
-                import os
+                data, extension = postprocess_image(image)
+                if self.preview_msg is None:
+                    self.preview_msg = reply_photo_cached(self.message, data, f'design.{extension}', caption=caption)
+                    return
+                edited = self.bot.edit_message_media(
+                    chat_id=self.preview_msg.chat_id,
+                    message_id=self.preview_msg.message_id,
+                    media=InputMediaPhoto(media=data, filename=f'design.{extension}', caption=caption)
+                )
+                # The album then reuses this upload
+                if getattr(edited, 'photo', None):
+                    db.save_uploaded_file_id(hashlib.sha256(data).hexdigest(), edited.photo[-1].file_id)
+            except Exception as e:
+                logger.warning(f"Could not show design preview: {e}")
+
+    def deliver(self, images):
+        """Send the finished designs and remove the preview; runs on the image executor"""
+        with self._send_lock:
+            self.delivered = True
+            send_generated_designs(
+                self.bot, self.message, self.processing_msg, images,
+                self.result_message, self.discount_button_text, self.error_message, self.back_button_text
+            )
+            if self.preview_msg is not None:
                 try:
-                    os.unlink(generated_image_path)
-                    logger.info(f"Cleaned up temporary file: {generated_image_path}")
+                    self.bot.delete_message(chat_id=self.preview_msg.chat_id, message_id=self.preview_msg.message_id)
                 except Exception as e:
-                    logger.warning(f"Could not clean up temporary file {generated_image_path}: {e}")
-                    
-            except Exception as e:
-                logger.error(f"Error sending generated image: {e}")
-                raise Exception("Error sending image")
-        else:
-            raise Exception("API call failed")
-            
-    except Exception as e:
-        logger.error(f"AI API error: {e}")
+                    logger.warning(f"Could not delete design preview: {e}")
+
+def design_variant_styles():
+    """Style suffixes of the variants generated per description, [None] for a single plain design"""
+    variants = AI_API_CONFIG['variants']
+    styles = AI_API_CONFIG['variant_styles']
+    if variants <= 1 or not styles:
+        return [None]
+    return [styles[index % len(styles)] for index in range(variants)]
+
+def send_generated_designs(bot, message, processing_msg, images, result_message, discount_button_text,
+                           error_message, back_button_text):
+    """Post-process generated designs and send them with the discount offer; runs on the image executor.
+
+    A single design is sent as a photo with the discount button, several as one
+    album followed by a message with a discount button per variant.
+    """
+    try:
+        processed = [postprocess_image(image) for image in images]
+        
+        # Delete processing message
         try:
-            processing_msg.edit_text(
-                error_message,
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(back_button_text, callback_data='back_to_main')]])
+            bot.delete_message(
+                chat_id=processing_msg.chat_id,
+                message_id=processing_msg.message_id
             )
-        except Exception as edit_e:
-            logger.error(f"Could not edit processing message: {edit_e}")
-            update.message.reply_text(
-                error_message,
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(back_button_text, callback_data='back_to_main')]])
+        except Exception as e:
+            logger.warning(f"Could not delete processing message: {e}")
+        
+        if len(processed) == 1:
+            # Send generated image with discount offer
+            data, extension = processed[0]
+            design = Payload({'variant': None, 'description': message.text})
+            keyboard = [[InlineKeyboardButton(discount_button_text, callback_data=encode_callback('book_appointment_discount', design))]]
+            reply_photo_cached(
+                message, data, f'design.{extension}',
+                caption=result_message,
+                reply_markup=InlineKeyboardMarkup(keyboard)
             )
-    
-    return ConversationHandler.END
+            record_event('ai_design_image', message.chat_id)
+            return
+        
+        send_album_cached(bot, message.chat_id, processed, result_message)
+        keyboard = [
+            [InlineKeyboardButton(
+                f"{discount_button_text} - طرح {index}",
+                callback_data=encode_callback('book_appointment_discount', Payload({'variant': index, 'description': message.text}))
+            )]
+            for index in range(1, len(processed) + 1)
+        ]
+        message.reply_text("کدام طرح را برای اجرا انتخاب می‌کنید؟", reply_markup=InlineKeyboardMarkup(keyboard))
+        record_event('ai_design_image', message.chat_id)
+    except Exception as e:
+        logger.error(f"Error sending generated image: {e}")
+        show_ai_design_error(message, processing_msg, error_message, back_button_text)
+
+def reply_photo_cached(message, data, filename, **kwargs):
+    """Reply with an image, sending the file_id of an earlier upload of the same bytes if there is one"""
+    content_hash = hashlib.sha256(data).hexdigest()
+    file_id = db.get_uploaded_file_id(content_hash)
+    if file_id:
+        try:
+            return message.reply_photo(photo=file_id, **kwargs)
+        except BadRequest as e:
+            # Unknown or expired file_id, upload again below
+            logger.warning(f"Stored file_id for {content_hash} was rejected: {e}")
+
+    sent = message.reply_photo(photo=data, filename=filename, **kwargs)
+    if sent.photo:
+        db.save_uploaded_file_id(content_hash, sent.photo[-1].file_id)
+    return sent
+
+def send_album_cached(bot, chat_id, images, caption):
+    """Send (bytes, extension) images as one media group, reusing file_ids of earlier uploads"""
+    hashes = [hashlib.sha256(data).hexdigest() for data, _ in images]
+    file_ids = [db.get_uploaded_file_id(content_hash) for content_hash in hashes]
+
+    def media(use_file_ids):
+        return [
+            InputMediaPhoto(
+                media=file_id if use_file_ids and file_id else data,
+                filename=f'design_{index}.{extension}',
+                caption=caption if index == 1 else None
+            )
+            for index, ((data, extension), file_id) in enumerate(zip(images, file_ids), 1)
+        ]
 
-def call_ai_api(description):
-    """Call ClipDrop API to generate tattoo design"""
-    api_key = db.get_setting('ai_api_key')
+    try:
+        sent = bot.send_media_group(chat_id=chat_id, media=media(True))
+    except BadRequest as e:
+        if not any(file_ids):
+            raise
+        logger.warning(f"Stored file_id in album was rejected: {e}")
+        file_ids = [None] * len(images)
+        sent = bot.send_media_group(chat_id=chat_id, media=media(False))
+
+    for content_hash, file_id, sent_message in zip(hashes, file_ids, sent):
+        if not file_id and sent_message.photo:
+            db.save_uploaded_file_id(content_hash, sent_message.photo[-1].file_id)
+    return sent
+
+def show_ai_design_error(message, processing_msg, error_message, back_button_text):
+    """Replace the processing message with the AI design error"""
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(back_button_text, callback_data='back_to_main')]])
+    try:
+        processing_msg.edit_text(error_message, reply_markup=reply_markup)
+    except Exception as edit_e:
+        logger.error(f"Could not edit processing message: {edit_e}")
+        message.reply_text(error_message, reply_markup=reply_markup)
+
+def call_ai_api(description, style=None):
+    """Generate a tattoo design with the configured AI providers, returning the image bytes or None"""
+    # Prepare the prompt for tattoo design
+    tattoo_prompt = f"Black and white tattoo design: {description}, detailed line art, tattoo style, clean lines, professional tattoo artwork"
+    if style:
+        tattoo_prompt = f"{tattoo_prompt}, {style}"
     
-    if not api_key:
-        logger.error("AI API key not set")
-        return None
+    logger.info(f"Generating design with prompt: {tattoo_prompt}")
     
     try:
-        # ClipDrop API implementation
-        headers = {
-            'x-api-key': api_key,
-        }
-        
-        # Prepare the prompt for tattoo design
-        tattoo_prompt = f"Black and white tattoo design: {description}, detailed line art, tattoo style, clean lines, professional tattoo artwork"
-        
-        data = {
-            'prompt': tattoo_prompt,
-            'width': 512,
-            'height': 512,
-        }
-        
-        logger.info(f"Calling ClipDrop API with prompt: {tattoo_prompt}")
-        
-        response = requests.post(
-            AI_API_CONFIG['api_url'], 
-            headers=headers, 
-            data=data,
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            # Save the image temporarily and get URL
-            import tempfile
-            import os
-            
-            # Create temporary file
-            temp_dir = '/tmp'
-            os.makedirs(temp_dir, exist_ok=True)
-            
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.png', dir=temp_dir) as temp_file:
-                temp_file.write(response.content)
-                temp_filename = temp_file.name
-            
-            logger.info(f"ClipDrop API call successful, image saved to: {temp_filename}")
-            return temp_filename  # Return local file path for telegram to upload
-        else:
-            logger.error(f"ClipDrop API error: {response.status_code}, {response.text}")
-            return None
-            
-    except requests.exceptions.Timeout:
-        logger.error("ClipDrop API call timed out")
-        return None
-    except requests.exceptions.ConnectionError:
-        logger.error("ClipDrop API connection error")
-        return None
-    except Exception as e:
-        logger.error(f"ClipDrop API call failed: {e}")
+        image = ai_router.generate_image(tattoo_prompt)
+        logger.info(f"AI design generated, received {len(image)} bytes")
+        return image
+    except ProviderError as e:
+        logger.error(f"AI design failed: {e}")
         return None
 
 def show_available_slots(query, context):
@@ -234,15 +393,14 @@ def show_available_slots(query, context):
     back_button_text = db.get_setting('back_button') or PERSIAN_TEXTS['back_button']
     
     if not slots:
-        query.edit_message_text(
-            no_slots_message,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(back_button_text, callback_data='back_to_main')]])
-        )
+        keyboard = waitlist_keyboard(query.from_user.id) if WAITLIST_CONFIG['enabled'] else []
+        keyboard.append([InlineKeyboardButton(back_button_text, callback_data='back_to_main')])
+        query.edit_message_text(no_slots_message, reply_markup=InlineKeyboardMarkup(keyboard))
         return
     
     keyboard = []
     for slot_id, slot_text in slots:
-        keyboard.append([InlineKeyboardButton(slot_text, callback_data=f'book_slot_{slot_id}')])
+        keyboard.append([InlineKeyboardButton(slot_text, callback_data=encode_callback('book_slot', slot_id))])
     
     keyboard.append([InlineKeyboardButton(back_button_text, callback_data='back_to_main')])
     
@@ -251,7 +409,66 @@ def show_available_slots(query, context):
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
-def book_slot(query, context, slot_id, discount=False):
+def waitlist_keyboard(user_id):
+    """Rows of the no-slots screen: join the waitlist for each range, or leave it"""
+    days_button_text = db.get_setting('booking_waitlist_days_button') or PERSIAN_TEXTS['booking_waitlist_days_button']
+    any_button_text = db.get_setting('booking_waitlist_any_button') or PERSIAN_TEXTS['booking_waitlist_any_button']
+    
+    keyboard = [
+        [InlineKeyboardButton(days_button_text.format(days=days), callback_data=encode_callback('waitlist_join', days))]
+        for days in WAITLIST_CONFIG['ranges_days']
+    ]
+    # 0 stands for any time
+    keyboard.append([InlineKeyboardButton(any_button_text, callback_data=encode_callback('waitlist_join', 0))])
+    if db.is_on_waitlist(user_id):
+        leave_button_text = db.get_setting('booking_waitlist_leave_button') or PERSIAN_TEXTS['booking_waitlist_leave_button']
+        keyboard.append([InlineKeyboardButton(leave_button_text, callback_data='waitlist_leave')])
+    return keyboard
+
+def join_waitlist(query, context, days=None):
+    """Put the user on the waitlist for slots within days, any slot when days is None"""
+    user_id = query.from_user.id
+    back_button_text = db.get_setting('back_button') or PERSIAN_TEXTS['back_button']
+    
+    try:
+        db.join_waitlist(user_id, days)
+    except Exception as e:
+        logger.error(f"Error joining waitlist: {e}")
+        error_message = db.get_setting('error_general') or PERSIAN_TEXTS['error_general']
+        query.edit_message_text(
+            error_message,
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(back_button_text, callback_data='back_to_main')]])
+        )
+        return
+    
+    record_event('waitlist_join', user_id)
+    joined_message = db.get_setting('booking_waitlist_joined') or PERSIAN_TEXTS['booking_waitlist_joined']
+    leave_button_text = db.get_setting('booking_waitlist_leave_button') or PERSIAN_TEXTS['booking_waitlist_leave_button']
+    query.edit_message_text(
+        joined_message,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(leave_button_text, callback_data='waitlist_leave')],
+            [InlineKeyboardButton(back_button_text, callback_data='back_to_main')]
+        ])
+    )
+
+def leave_waitlist(query, context):
+    """Take the user off the waitlist"""
+    back_button_text = db.get_setting('back_button') or PERSIAN_TEXTS['back_button']
+    
+    try:
+        db.leave_waitlist(query.from_user.id)
+        message = db.get_setting('booking_waitlist_left') or PERSIAN_TEXTS['booking_waitlist_left']
+    except Exception as e:
+        logger.error(f"Error leaving waitlist: {e}")
+        message = db.get_setting('error_general') or PERSIAN_TEXTS['error_general']
+    
+    query.edit_message_text(
+        message,
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(back_button_text, callback_data='back_to_main')]])
+    )
+
+def book_slot(query, context, slot_id, discount=False, design=None):
     """Book an appointment slot"""
     user_id = query.from_user.id
     
@@ -263,6 +480,12 @@ def book_slot(query, context, slot_id, discount=False):
             slot_text = stext
             break
     
+    # A slot freed while the user was on the waitlist is held for them only
+    if not slot_text:
+        hold = db.get_slot_hold(slot_id)
+        if hold and hold[0] == user_id:
+            slot_text = hold[1]
+    
     # Get configurable messages
     slot_unavailable_message = db.get_setting('booking_slot_unavailable') or PERSIAN_TEXTS['booking_slot_unavailable']
     back_button_text = db.get_setting('back_button') or PERSIAN_TEXTS['back_button']
@@ -278,8 +501,19 @@ def book_slot(query, context, slot_id, discount=False):
     # Create reservation
     try:
         reservation_id = db.create_reservation(user_id, slot_id)
+        if reservation_id is None:
+            # Booked by someone else since the slot list was shown
+            query.edit_message_text(
+                slot_unavailable_message,
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(back_button_text, callback_data='back_to_main')]])
+            )
+            return
         context.user_data['current_reservation_id'] = reservation_id
-        context.user_data['selected_slot_text'] = slot_text
+        # Shown to the admins with the receipt; the payload is gone if the button was pressed much later
+        if design is not None and design.value:
+            context.user_data['selected_design'] = design.value
+        else:
+            context.user_data.pop('selected_design', None)
     except Exception as e:
         logger.error(f"Error creating reservation: {e}")
         query.edit_message_text(
@@ -322,15 +556,15 @@ def book_slot(query, context, slot_id, discount=False):
     
     return BOOKING_RECEIPT_UPLOAD
 
-def book_slot_with_discount(query, context, slot_id=None):
+def book_slot_with_discount(query, context, slot_id=None, design=None):
     """Book slot with 10% discount after AI design"""
     if slot_id is None:
         # Show available slots for discount booking
-        show_available_slots_for_discount(query, context)
+        show_available_slots_for_discount(query, context, design)
     else:
-        book_slot(query, context, slot_id, discount=True)
+        return book_slot(query, context, slot_id, discount=True, design=design)
 
-def show_available_slots_for_discount(query, context):
+def show_available_slots_for_discount(query, context, design=None):
     """Show available slots for discount booking"""
     slots = db.get_available_slots()
     
@@ -348,7 +582,10 @@ def show_available_slots_for_discount(query, context):
     
     keyboard = []
     for slot_id, slot_text in slots:
-        keyboard.append([InlineKeyboardButton(f"{slot_text} (با ۱۰٪ تخفیف)", callback_data=f'book_discount_{slot_id}')])
+        keyboard.append([InlineKeyboardButton(
+            f"{slot_text} (با ۱۰٪ تخفیف)",
+            callback_data=encode_callback('book_discount', slot_id, design)
+        )])
     
     keyboard.append([InlineKeyboardButton(back_button_text, callback_data='back_to_main')])
     
@@ -397,9 +634,13 @@ def send_receipt_to_admins(context, reservation_id, photo_file_id, user):
         reservation_data = db.get_reservation_by_id(reservation_id)
         
         if not reservation_data:
+            logger.error(f"Reservation {reservation_id} not found, receipt not sent to admins")
             return
         
         _, user_id, slot_id, status, receipt_photo_id, pending_time, created_at, slot_text, first_name, username = reservation_data
+        if first_name is None:
+            # The user's row is still buffered; the Telegram user has the same details
+            first_name, username = user.first_name, user.username
         
         # Get configurable admin messages
         admin_caption_template = db.get_setting('admin_receipt_caption') or PERSIAN_TEXTS['admin_receipt_caption']
@@ -414,24 +655,23 @@ def send_receipt_to_admins(context, reservation_id, photo_file_id, user):
             slot_text=slot_text
         )
         
+        # Carried from the design's discount button to the booking
+        design = context.user_data.pop('selected_design', None) or {}
+        if design.get('variant'):
+            caption += f"\n🎨 طرح انتخابی: {design['variant']}"
+        if design.get('description'):
+            caption += f"\n📝 توضیح طرح: {design['description'][:DESIGN_DESCRIPTION_CAPTION_CHARS]}"
+        
         keyboard = [
             [
-                InlineKeyboardButton(approve_button_text, callback_data=f'approve_reservation_{reservation_id}'),
-                InlineKeyboardButton(reject_button_text, callback_data=f'reject_reservation_{reservation_id}')
+                InlineKeyboardButton(approve_button_text, callback_data=encode_callback('approve_reservation', reservation_id)),
+                InlineKeyboardButton(reject_button_text, callback_data=encode_callback('reject_reservation', reservation_id))
             ]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         for admin_id in ADMIN_IDS:
-            try:
-                context.bot.send_photo(
-                    chat_id=admin_id,
-                    photo=photo_file_id,
-                    caption=caption,
-                    reply_markup=reply_markup
-                )
-            except Exception as e:
-                logger.error(f"Failed to send receipt to admin {admin_id}: {e}")
+            queue_send(context.bot.send_photo, admin_id, photo=photo_file_id, caption=caption, reply_markup=reply_markup)
                 
     except Exception as e:
         logger.error(f"Error in send_receipt_to_admins: {e}")
@@ -470,6 +710,11 @@ def back_to_main_menu(query, context):
     reply_markup = InlineKeyboardMarkup(keyboard)
     query.edit_message_text(welcome_message, reply_markup=reply_markup)
 
+def back_to_main_callback(update: Update, context: CallbackContext):
+    """Back button handler used as a conversation fallback"""
+    update.callback_query.answer()
+    back_to_main_menu(update.callback_query, context)
+
 def handle_reservation_approval(update: Update, context: CallbackContext):
     """Handle admin reservation approval/rejection"""
     query = update.callback_query
@@ -478,7 +723,7 @@ def handle_reservation_approval(update: Update, context: CallbackContext):
     if query.from_user.id not in ADMIN_IDS:
         return
     
-    action, reservation_id = query.data.split('_', 1)[0], int(query.data.split('_')[2])
+    action, reservation_id = context.callback_action.split('_', 1)[0], context.callback_args[0]
     
     try:
         reservation_data = db.get_reservation_by_id(reservation_id)
@@ -494,17 +739,13 @@ def handle_reservation_approval(update: Update, context: CallbackContext):
         booking_rejected_message = db.get_setting('booking_rejected') or PERSIAN_TEXTS['booking_rejected']
         
         if action == 'approve':
-            db.confirm_reservation(reservation_id)
+            if not db.confirm_reservation(reservation_id):
+                _reservation_already_handled(query)
+                return
+            record_event('booking_confirmed', user_id)
             
             # Notify user
-            try:
-                confirmation_message = booking_confirmed_template.format(slot_text=slot_text)
-                context.bot.send_message(
-                    chat_id=user_id,
-                    text=confirmation_message
-                )
-            except Exception as e:
-                logger.error(f"Failed to notify user {user_id}: {e}")
+            queue_send(context.bot.send_message, user_id, text=booking_confirmed_template.format(slot_text=slot_text))
             
             # Confirm to admin
             query.edit_message_caption(
@@ -513,16 +754,14 @@ def handle_reservation_approval(update: Update, context: CallbackContext):
             )
         
         elif action == 'reject':
-            db.reject_reservation(reservation_id)
+            rejected, hold = db.reject_reservation(reservation_id)
+            if not rejected:
+                _reservation_already_handled(query)
+                return
             
             # Notify user
-            try:
-                context.bot.send_message(
-                    chat_id=user_id,
-                    text=booking_rejected_message
-                )
-            except Exception as e:
-                logger.error(f"Failed to notify user {user_id}: {e}")
+            queue_send(context.bot.send_message, user_id, text=booking_rejected_message)
+            notify_slot_offers(context.bot, [hold])
             
             # Confirm to admin
             query.edit_message_caption(
@@ -537,6 +776,13 @@ def handle_reservation_approval(update: Update, context: CallbackContext):
             reply_markup=None
         )
 
+def _reservation_already_handled(query):
+    """Tell an admin that another admin (or expiry) got to the receipt first"""
+    query.edit_message_caption(
+        caption=f"{query.message.caption}\n\n⚠️ این رسید قبلاً بررسی شده است.",
+        reply_markup=None
+    )
+
 def cancel_conversation(update: Update, context: CallbackContext):
     """Cancel current conversation"""
     cancelled_message = db.get_setting('operation_cancelled') or PERSIAN_TEXTS['operation_cancelled']
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageDraw, ImageFont
+from config import IMAGE_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Pillow format name and file extension per IMAGE_CONFIG['format']
+FORMATS = {
+    'png': ('PNG', 'png'),
+    'jpeg': ('JPEG', 'jpg'),
+    'webp': ('WEBP', 'webp')
+}
+
+# Encoding runs here so generated designs don't hold up update workers
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_CONFIG['workers'], thread_name_prefix='image')
+
+def _load_font(size):
+    if IMAGE_CONFIG['watermark_font']:
+        try:
+            return ImageFont.truetype(IMAGE_CONFIG['watermark_font'], size)
+        except OSError as e:
+            logger.warning(f"Could not load watermark font, using the default: {e}")
+    return ImageFont.load_default()
+
+def add_watermark(image, text):
+    """Draw text semi-transparently in the bottom right corner"""
+    base = image.convert('RGBA')
+    overlay = Image.new('RGBA', base.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    font = _load_font(max(12, base.width // 30))
+
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+    margin = max(8, base.width // 50)
+    position = (base.width - (right - left) - margin, base.height - (bottom - top) - margin)
+    draw.text(position, text, font=font, fill=(255, 255, 255, IMAGE_CONFIG['watermark_opacity']),
+              stroke_width=1, stroke_fill=(0, 0, 0, IMAGE_CONFIG['watermark_opacity']))
+    return Image.alpha_composite(base, overlay)
+
+def postprocess_image(data):
+    """Re-encode a generated image according to IMAGE_CONFIG.
+
+    Returns (bytes, file extension). Re-encoding drops metadata chunks such as
+    text and EXIF; with format 'png' and nothing to change the original bytes
+    are returned as they are.
+    """
+    pillow_format, extension = FORMATS[IMAGE_CONFIG['format']]
+    watermark = IMAGE_CONFIG['watermark_text']
+    if pillow_format == 'PNG' and not watermark and not IMAGE_CONFIG['strip_metadata']:
+        return data, extension
+
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    if watermark:
+        image = add_watermark(image, watermark)
+    if pillow_format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    output = io.BytesIO()
+    options = {}
+    if pillow_format == 'JPEG':
+        options = {'quality': IMAGE_CONFIG['quality'], 'optimize': True, 'progressive': True}
+    elif pillow_format == 'WEBP':
+        options = {'quality': IMAGE_CONFIG['quality'], 'method': 4}
+    # Pillow only writes metadata that is passed explicitly, so nothing carries over
+    image.save(output, format=pillow_format, **options)
+    return output.getvalue(), extension
@@ -1,15 +1,35 @@
 # -*- coding: utf-8 -*-
 
 import logging
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, ConversationHandler
+from functools import partial
+from telegram.error import BadRequest, Unauthorized
+from telegram.ext import CommandHandler, MessageHandler, Filters, ConversationHandler
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 
-from config import BOT_TOKEN, SCHEDULER_CONFIG
-from database import Database
+from config import (
+    BOT_TOKEN, SCHEDULER_CONFIG, WEBHOOK_CONFIG, DISPATCH_CONFIG, METRICS_CONFIG, TRACING_CONFIG, CHANGE_FEED_CONFIG,
+    ARCHIVE_CONFIG, MAINTENANCE_CONFIG, SEND_QUEUE_CONFIG, WAITLIST_CONFIG
+)
+from concurrency import build_updater, ChatOrderedDispatcher
+from maintenance import backup_database, run_maintenance
+from analytics import event_buffer
+from send_queue import send_queue, queue_send
+from ai_providers import ai_router
+from circuit_breaker import CLOSED
+from waitlist import notify_slot_offers, expire_slot_holds
+from metrics import (
+    instrument_dispatcher, instrument_methods, start_metrics_server, timed_job,
+    DB_DURATION, PENDING_RESERVATIONS, UPDATE_QUEUE_DEPTH, WORKER_QUEUE_DEPTH, USER_BUFFER_DEPTH,
+    SEND_QUEUE_DEPTH, AI_CIRCUIT_OPEN, AI_TIMEOUT
+)
+from persistence import SQLitePersistence
+from callback_router import CallbackRouter, Payload
+from update_tracing import install_update_tracing
+from database import get_database, get_user_write_buffer, database_writer
 from handlers import (
     start, button_handler, handle_ai_design_description, handle_receipt_upload,
-    handle_reservation_approval, cancel_conversation, start_ai_design, back_to_main_menu,
+    handle_reservation_approval, cancel_conversation, ai_design_entry, back_to_main_callback,
     AI_DESIGN_DESCRIPTION, BOOKING_RECEIPT_UPLOAD
 )
 from admin_handlers import (
@@ -20,6 +40,7 @@ from admin_handlers import (
     admin_api_key_process, admin_stats, cancel_admin_conversation,
     admin_text_management, admin_main_messages, admin_ai_messages, admin_booking_messages,
     admin_button_texts, admin_edit_text_start, admin_edit_text_process,
+    admin_profiling_menu, admin_profiling_set, admin_query_stats, admin_ai_reset,
     ADMIN_ADD_SLOT, ADMIN_EDIT_SETTING, ADMIN_BROADCAST, ADMIN_SET_API_KEY, ADMIN_EDIT_TEXT
 )
 
@@ -31,17 +52,33 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-def cleanup_expired_reservations():
-    """Clean up expired reservations"""
-    db = Database()
+def cleanup_expired_reservations(bot):
+    """Clean up expired reservations, offering their slots to waitlisted users"""
+    db = get_database()
     expired_reservations = db.get_expired_reservations(SCHEDULER_CONFIG['reservation_timeout_minutes'])
     
+    holds = []
     for reservation_id, slot_id in expired_reservations:
         try:
-            db.cancel_expired_reservation(reservation_id, slot_id)
+            holds.append(db.cancel_expired_reservation(reservation_id, slot_id))
             logger.info(f"Cleaned up expired reservation {reservation_id}")
         except Exception as e:
             logger.error(f"Error cleaning up reservation {reservation_id}: {e}")
+    notify_slot_offers(bot, holds)
+    
+    if WAITLIST_CONFIG['enabled']:
+        db.prune_waitlist()
+
+def _expiry_warning_sent(reservation_id, user_id, future):
+    # Not marked after errors that may pass, so the next run tries again
+    error = future.exception()
+    if error is None:
+        get_database().mark_expiry_warning_sent(reservation_id)
+        logger.info(f"Sent expiry warning for reservation {reservation_id} to user {user_id}")
+    elif isinstance(error, (Unauthorized, BadRequest)):
+        # The user blocked the bot or the chat is gone; retrying every run won't deliver it
+        get_database().mark_expiry_warning_sent(reservation_id)
+        logger.info(f"Dropped expiry warning for reservation {reservation_id}, user {user_id} can't be messaged")
 
 def notify_expiring_reservations():
     """Notify users about reservations that will expire soon"""
@@ -52,7 +89,7 @@ def notify_expiring_reservations():
     bot_token = os.getenv('BOT_TOKEN', BOT_TOKEN)
     bot = Bot(token=bot_token)
     
-    db = Database()
+    db = get_database()
     near_expiry = db.get_reservations_near_expiry(
         timeout_minutes=SCHEDULER_CONFIG['reservation_timeout_minutes'], 
         warning_minutes=30  # Warn 30 minutes before expiry
@@ -72,10 +109,9 @@ def notify_expiring_reservations():
 
 اگر هنوز رسید پرداخت را ارسال نکرده‌اید، لطفاً سریع‌تر اقدام کنید تا رزرو شما لغو نشود."""
             
-            bot.send_message(chat_id=user_id, text=warning_message)
-            db.mark_expiry_warning_sent(reservation_id)
-            
-            logger.info(f"Sent expiry warning for reservation {reservation_id} to user {user_id}")
+            queue_send(bot.send_message, user_id, text=warning_message).add_done_callback(
+                partial(_expiry_warning_sent, reservation_id, user_id)
+            )
             
         except Exception as e:
             logger.error(f"Error sending expiry warning for reservation {reservation_id}: {e}")
@@ -84,32 +120,53 @@ def error_handler(update, context):
     """Log Errors caused by Updates."""
     logger.warning('Update "%s" caused error "%s"', update, context.error)
 
-def main():
-    """Start the bot."""
-    # Create updater and pass bot token
-    updater = Updater(BOT_TOKEN)
-    dp = updater.dispatcher
+def build_callback_router():
+    """Routes of every callback_data the bot's buttons send"""
+    router = CallbackRouter()
 
-    # Initialize database
-    db = Database()
-    
-    # Set up scheduler for cleaning expired reservations
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(
-        cleanup_expired_reservations,
-        IntervalTrigger(minutes=5),  # Check every 5 minutes
-        id='cleanup_expired_reservations'
-    )
-    scheduler.add_job(
-        notify_expiring_reservations,
-        IntervalTrigger(minutes=10),  # Check for expiring reservations every 10 minutes
-        id='notify_expiring_reservations'
-    )
-    scheduler.start()
+    # Started by conversations, so only parsed here
+    for action in ('ai_design', 'admin_add_slot', 'admin_broadcast', 'admin_api_key'):
+        router.add(action)
+    router.add('book_slot', int)
+    router.add('book_discount', int)
+    router.add('book_discount', int, Payload)
+    router.add('edit', str)
+    router.add('edit_text', str)
+
+    for action in ('book_appointment', 'contact', 'book_appointment_discount', 'back_to_main'):
+        router.add(action, callback=button_handler)
+    # Compact buttons carry the design; older buttons under an album name its variant
+    router.add('book_appointment_discount', Payload, callback=button_handler)
+    router.add('book_appointment_discount', int, callback=button_handler)
+    router.add('waitlist_join', int, callback=button_handler)
+    router.add('waitlist_leave', callback=button_handler)
+    router.add('approve_reservation', int, callback=handle_reservation_approval)
+    router.add('reject_reservation', int, callback=handle_reservation_approval)
+    router.add('admin_panel', callback=admin_panel)
+    router.add('admin_slots', callback=admin_slots_menu)
+    router.add('admin_view_slots', callback=admin_view_slots)
+    router.add('admin_delete_slots', callback=admin_delete_slots)
+    router.add('delete_slot', int, callback=admin_delete_slot_confirm)
+    router.add('admin_settings', callback=admin_settings_menu)
+    router.add('admin_stats', callback=admin_stats)
+    router.add('admin_ai_reset', callback=admin_ai_reset)
+    router.add('admin_text_management', callback=admin_text_management)
+    router.add('admin_main_messages', callback=admin_main_messages)
+    router.add('admin_ai_messages', callback=admin_ai_messages)
+    router.add('admin_booking_messages', callback=admin_booking_messages)
+    router.add('admin_button_texts', callback=admin_button_texts)
+    router.add('admin_profiling', callback=admin_profiling_menu)
+    router.add('admin_profiling_set', int, callback=admin_profiling_set)
+    return router
+
+def register_handlers(dp):
+    """Register all conversation, command and callback handlers on the dispatcher"""
+    router = build_callback_router()
+    back_to_main = router.handler('back_to_main', callback=back_to_main_callback, ends_conversation=True)
 
     # AI Design Conversation Handler
     ai_design_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(lambda u, c: start_ai_design(u.callback_query, c), pattern='ai_design')],
+        entry_points=[router.handler('ai_design', callback=ai_design_entry)],
         states={
             AI_DESIGN_DESCRIPTION: [
                 MessageHandler(Filters.text & ~Filters.command, handle_ai_design_description)
@@ -117,13 +174,15 @@ def main():
         },
         fallbacks=[
             CommandHandler('cancel', cancel_conversation),
-            CallbackQueryHandler(lambda u, c: back_to_main_menu(u.callback_query, c), pattern='back_to_main')
-        ]
+            back_to_main
+        ],
+        name='ai_design',
+        persistent=True
     )
 
     # Booking Conversation Handler  
     booking_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(lambda u, c: None, pattern='book_slot_.*')],
+        entry_points=[router.handler('book_slot', 'book_discount', callback=button_handler)],
         states={
             BOOKING_RECEIPT_UPLOAD: [
                 MessageHandler(Filters.photo, handle_receipt_upload),
@@ -132,69 +191,83 @@ def main():
         },
         fallbacks=[
             CommandHandler('cancel', cancel_conversation),
-            CallbackQueryHandler(lambda u, c: back_to_main_menu(u.callback_query, c), pattern='back_to_main')
-        ]
+            back_to_main
+        ],
+        name='booking',
+        persistent=True,
+        allow_reentry=True
     )
 
     # Admin Conversation Handlers
     admin_add_slot_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(admin_add_slot_start, pattern='admin_add_slot')],
+        entry_points=[router.handler('admin_add_slot', callback=admin_add_slot_start)],
         states={
             ADMIN_ADD_SLOT: [MessageHandler(Filters.text & ~Filters.command, admin_add_slot_process)]
         },
         fallbacks=[
             CommandHandler('cancel', cancel_admin_conversation),
-            CallbackQueryHandler(lambda u, c: admin_slots_menu(u, c), pattern='admin_slots')
-        ]
+            router.handler('admin_slots', callback=admin_slots_menu, ends_conversation=True)
+        ],
+        name='admin_add_slot',
+        persistent=True
     )
 
     admin_edit_setting_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(admin_edit_setting_start, pattern='edit_.*')],
+        entry_points=[router.handler('edit', callback=admin_edit_setting_start)],
         states={
             ADMIN_EDIT_SETTING: [MessageHandler(Filters.text & ~Filters.command, admin_edit_setting_process)]
         },
         fallbacks=[
             CommandHandler('cancel', cancel_admin_conversation),
-            CallbackQueryHandler(lambda u, c: admin_settings_menu(u, c), pattern='admin_settings')
-        ]
+            router.handler('admin_settings', callback=admin_settings_menu, ends_conversation=True)
+        ],
+        name='admin_edit_setting',
+        persistent=True
     )
 
     admin_broadcast_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(admin_broadcast_start, pattern='admin_broadcast')],
+        entry_points=[router.handler('admin_broadcast', callback=admin_broadcast_start)],
         states={
             ADMIN_BROADCAST: [MessageHandler(Filters.text & ~Filters.command, admin_broadcast_process)]
         },
         fallbacks=[
             CommandHandler('cancel', cancel_admin_conversation),
-            CallbackQueryHandler(lambda u, c: admin_panel(u, c), pattern='admin_panel')
-        ]
+            router.handler('admin_panel', callback=admin_panel, ends_conversation=True)
+        ],
+        name='admin_broadcast',
+        persistent=True
     )
 
     admin_api_key_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(admin_api_key_start, pattern='admin_api_key')],
+        entry_points=[router.handler('admin_api_key', callback=admin_api_key_start)],
         states={
             ADMIN_SET_API_KEY: [MessageHandler(Filters.text & ~Filters.command, admin_api_key_process)]
         },
         fallbacks=[
             CommandHandler('cancel', cancel_admin_conversation),
-            CallbackQueryHandler(lambda u, c: admin_panel(u, c), pattern='admin_panel')
-        ]
+            router.handler('admin_panel', callback=admin_panel, ends_conversation=True)
+        ],
+        name='admin_api_key',
+        persistent=True
     )
 
     admin_text_edit_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(admin_edit_text_start, pattern='edit_text_.*')],
+        entry_points=[router.handler('edit_text', callback=admin_edit_text_start)],
         states={
             ADMIN_EDIT_TEXT: [MessageHandler(Filters.text & ~Filters.command, admin_edit_text_process)]
         },
         fallbacks=[
             CommandHandler('cancel', cancel_admin_conversation),
-            CallbackQueryHandler(lambda u, c: admin_text_management(u, c), pattern='admin_text_management')
-        ]
+            router.handler('admin_text_management', callback=admin_text_management, ends_conversation=True)
+        ],
+        name='admin_edit_text',
+        persistent=True
     )
 
     # Command handlers
     dp.add_handler(CommandHandler("start", start))
     dp.add_handler(CommandHandler("admin", admin_panel))
+    dp.add_handler(CommandHandler("queries", admin_query_stats))
 
     # Conversation handlers
     dp.add_handler(ai_design_conv_handler)
@@ -205,27 +278,121 @@ def main():
     dp.add_handler(admin_api_key_handler)
     dp.add_handler(admin_text_edit_handler)
 
-    # Callback query handlers
-    dp.add_handler(CallbackQueryHandler(button_handler, pattern='^(book_appointment|contact|book_appointment_discount|back_to_main|book_discount_.*)$'))
-    dp.add_handler(CallbackQueryHandler(handle_reservation_approval, pattern='^(approve_reservation_|reject_reservation_).*'))
-    dp.add_handler(CallbackQueryHandler(admin_panel, pattern='admin_panel'))
-    dp.add_handler(CallbackQueryHandler(admin_slots_menu, pattern='admin_slots'))
-    dp.add_handler(CallbackQueryHandler(admin_view_slots, pattern='admin_view_slots'))
-    dp.add_handler(CallbackQueryHandler(admin_delete_slots, pattern='admin_delete_slots'))
-    dp.add_handler(CallbackQueryHandler(admin_delete_slot_confirm, pattern='delete_slot_.*'))
-    dp.add_handler(CallbackQueryHandler(admin_settings_menu, pattern='admin_settings'))
-    dp.add_handler(CallbackQueryHandler(admin_stats, pattern='admin_stats'))
-    dp.add_handler(CallbackQueryHandler(admin_text_management, pattern='admin_text_management'))
-    dp.add_handler(CallbackQueryHandler(admin_main_messages, pattern='admin_main_messages'))
-    dp.add_handler(CallbackQueryHandler(admin_ai_messages, pattern='admin_ai_messages'))
-    dp.add_handler(CallbackQueryHandler(admin_booking_messages, pattern='admin_booking_messages'))
-    dp.add_handler(CallbackQueryHandler(admin_button_texts, pattern='admin_button_texts'))
+    # Every other button, dispatched with one router lookup
+    dp.add_handler(router.handler())
 
     # Error handler
     dp.add_error_handler(error_handler)
 
+def start_updates(updater):
+    """Start receiving updates via webhook or long polling, depending on WEBHOOK_CONFIG"""
+    if not WEBHOOK_CONFIG['enabled']:
+        # start_polling deletes any previously registered webhook before polling
+        updater.start_polling(drop_pending_updates=WEBHOOK_CONFIG['drop_pending_updates'])
+        logger.info("Receiving updates via long polling")
+        return
+
+    url_path = WEBHOOK_CONFIG['url_path'] or BOT_TOKEN
+    webhook_url = None
+    if WEBHOOK_CONFIG['public_url']:
+        webhook_url = f"{WEBHOOK_CONFIG['public_url'].rstrip('/')}/{url_path}"
+
+    # start_webhook (re)registers the webhook with Telegram, replacing polling
+    updater.start_webhook(
+        listen=WEBHOOK_CONFIG['listen'],
+        port=WEBHOOK_CONFIG['port'],
+        url_path=url_path,
+        cert=WEBHOOK_CONFIG['cert'] or None,
+        key=WEBHOOK_CONFIG['key'] or None,
+        webhook_url=webhook_url,
+        max_connections=WEBHOOK_CONFIG['max_connections'],
+        drop_pending_updates=WEBHOOK_CONFIG['drop_pending_updates']
+    )
+    logger.info(f"Receiving updates via webhook on {WEBHOOK_CONFIG['listen']}:{WEBHOOK_CONFIG['port']}")
+
+def setup_metrics(updater):
+    """Instrument handlers and database calls and start the metrics endpoint"""
+    db = get_database()
+    dp = updater.dispatcher
+
+    instrument_dispatcher(dp)
+    instrument_methods(db, DB_DURATION)
+
+    PENDING_RESERVATIONS.set_function(lambda: db.count_reservations('pending'))
+    UPDATE_QUEUE_DEPTH.set_function(updater.update_queue.qsize)
+    USER_BUFFER_DEPTH.set_function(lambda: get_user_write_buffer().pending)
+    SEND_QUEUE_DEPTH.set_function(lambda: send_queue.pending)
+    AI_CIRCUIT_OPEN.set_function(lambda: {provider.name: int(provider.circuit.state != CLOSED) for provider in ai_router.providers})
+    AI_TIMEOUT.set_function(lambda: {provider.name: provider.circuit.timeout() for provider in ai_router.providers})
+    if isinstance(dp, ChatOrderedDispatcher):
+        WORKER_QUEUE_DEPTH.set_function(lambda: dp.ordered_executor.pending)
+
+    return start_metrics_server(METRICS_CONFIG['listen'], METRICS_CONFIG['port'])
+
+def main():
+    """Start the bot."""
+    # Initialize database (applies pending schema migrations once per process)
+    get_database()
+
+    # Create updater and pass bot token
+    updater = build_updater(BOT_TOKEN, DISPATCH_CONFIG, persistence=SQLitePersistence())
+    dp = updater.dispatcher
+    
+    # Set up scheduler for cleaning expired reservations
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(
+        timed_job('cleanup_expired_reservations', partial(cleanup_expired_reservations, updater.bot)),
+        IntervalTrigger(minutes=5),  # Check every 5 minutes
+        id='cleanup_expired_reservations'
+    )
+    if WAITLIST_CONFIG['enabled']:
+        # Often enough that a hold outlives hold_minutes by at most a minute
+        scheduler.add_job(
+            timed_job('expire_slot_holds', partial(expire_slot_holds, updater.bot)),
+            IntervalTrigger(minutes=1),
+            id='expire_slot_holds'
+        )
+    scheduler.add_job(
+        timed_job('notify_expiring_reservations', notify_expiring_reservations),
+        IntervalTrigger(minutes=10),  # Check for expiring reservations every 10 minutes
+        id='notify_expiring_reservations'
+    )
+    if CHANGE_FEED_CONFIG['enabled']:
+        scheduler.add_job(
+            timed_job('prune_change_log', get_database().prune_change_log),
+            IntervalTrigger(hours=1),
+            id='prune_change_log'
+        )
+    if ARCHIVE_CONFIG['enabled']:
+        scheduler.add_job(
+            timed_job('archive_reservations', get_database().archive_reservations),
+            IntervalTrigger(hours=ARCHIVE_CONFIG['interval_hours']),
+            id='archive_reservations'
+        )
+    if MAINTENANCE_CONFIG['backup_enabled']:
+        scheduler.add_job(
+            timed_job('backup_database', backup_database),
+            IntervalTrigger(hours=MAINTENANCE_CONFIG['backup_interval_hours']),
+            id='backup_database'
+        )
+    if MAINTENANCE_CONFIG['maintenance_enabled']:
+        scheduler.add_job(
+            timed_job('run_maintenance', run_maintenance),
+            IntervalTrigger(hours=MAINTENANCE_CONFIG['maintenance_interval_hours']),
+            id='run_maintenance'
+        )
+    scheduler.start()
+
+    register_handlers(dp)
+
+    if METRICS_CONFIG['enabled']:
+        setup_metrics(updater)
+
+    if TRACING_CONFIG['enabled']:
+        install_update_tracing(dp)
+
     # Start the Bot
-    updater.start_polling()
+    start_updates(updater)
     
     logger.info("Persian Tattoo Bot started successfully!")
     print("🤖 Persian Tattoo Bot is running...")
@@ -237,5 +404,13 @@ def main():
     # Stop scheduler on exit
     scheduler.shutdown()
 
+    # Deliver queued notifications; expiry warnings record themselves in the database
+    send_queue.stop(SEND_QUEUE_CONFIG['drain_timeout_seconds'])
+
+    # Write users still waiting in the /start buffer
+    get_user_write_buffer().stop()
+    event_buffer.stop()
+    database_writer.stop()
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import logging
+from datetime import datetime
+from config import MAINTENANCE_CONFIG
+from database import get_database, connect, serialized_write
+
+logger = logging.getLogger(__name__)
+
+class BackupRestarted(Exception):
+    """Raised from the backup progress callback to give up on a stepped copy"""
+
+def _backup_path(db_name, backup_dir):
+    base = os.path.splitext(os.path.basename(db_name))[0]
+    return os.path.join(backup_dir, f"{base}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db")
+
+def _copy(source_name, target_name, pages, sleep_seconds, max_restarts):
+    """Copy the database with the backup API; returns the number of restarts"""
+    source = connect(source_name)
+    target = connect(target_name)
+    progress = {'remaining': None, 'restarts': 0}
+
+    def on_step(status, remaining, total):
+        # remaining grows again when a write from another connection restarted the copy
+        if progress['remaining'] is not None and remaining > progress['remaining']:
+            progress['restarts'] += 1
+            if progress['restarts'] > max_restarts:
+                raise BackupRestarted()
+        progress['remaining'] = remaining
+        if remaining and sleep_seconds:
+            time.sleep(sleep_seconds)
+
+    try:
+        source.backup(target, pages=pages, progress=on_step if pages > 0 else None)
+    finally:
+        target.close()
+        source.close()
+    return progress['restarts']
+
+def backup_database(db_name=None, backup_dir=None):
+    """Take an online backup in page steps, then delete backups beyond backups_to_keep.
+
+    Bookings keep writing while the copy runs. If other connections keep
+    restarting the stepped copy, it is taken in one step instead, which
+    only holds a read snapshot in WAL mode.
+    """
+    db = get_database()
+    db_name = db_name or db.db_name
+    backup_dir = backup_dir or MAINTENANCE_CONFIG['backup_dir']
+    os.makedirs(backup_dir, exist_ok=True)
+    path = _backup_path(db_name, backup_dir)
+    partial_path = path + '.partial'
+
+    started = time.perf_counter()
+    try:
+        try:
+            restarts = _copy(db_name, partial_path, MAINTENANCE_CONFIG['backup_pages_per_step'],
+                             MAINTENANCE_CONFIG['backup_step_sleep_ms'] / 1000.0, MAINTENANCE_CONFIG['backup_max_restarts'])
+            detail = f"{restarts} restarts"
+        except BackupRestarted:
+            os.remove(partial_path)
+            _copy(db_name, partial_path, -1, 0, 0)
+            detail = 'copied in one step after repeated restarts'
+        os.replace(partial_path, path)
+    except Exception:
+        # rotate_backups only sees finished backups, so a failed copy would stay behind
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    duration_ms = (time.perf_counter() - started) * 1000
+
+    size_kib = os.path.getsize(path) / 1024
+    logger.info(f"Database backed up to {path} in {duration_ms:.0f}ms ({size_kib:.0f} KiB, {detail})")
+    db.log_maintenance('backup', duration_ms, f"{size_kib:.0f} KiB, {detail}")
+    rotate_backups(db_name, backup_dir, MAINTENANCE_CONFIG['backups_to_keep'])
+    return path
+
+def rotate_backups(db_name, backup_dir, keep):
+    """Delete all but the newest keep backups of db_name"""
+    prefix = os.path.splitext(os.path.basename(db_name))[0] + '-'
+    backups = sorted(name for name in os.listdir(backup_dir) if name.startswith(prefix) and name.endswith('.db'))
+    for name in backups[:-keep] if keep > 0 else backups:
+        os.remove(os.path.join(backup_dir, name))
+        logger.info(f"Deleted old backup {name}")
+
+def _pragma_value(db_name, pragma):
+    conn = connect(db_name)
+    try:
+        return conn.execute(f'PRAGMA {pragma}').fetchone()[0]
+    finally:
+        conn.close()
+
+# These write, so they queue behind other writes instead of competing for the lock
+@serialized_write
+def _execute(db_name, sql):
+    conn = connect(db_name, isolation_level=None)
+    try:
+        conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+def _timed(db, task, func, *args):
+    started = time.perf_counter()
+    detail = func(*args) or ''
+    duration_ms = (time.perf_counter() - started) * 1000
+    logger.info(f"Maintenance task {task} took {duration_ms:.0f}ms {detail}".rstrip())
+    db.log_maintenance(task, duration_ms, detail)
+
+def _incremental_vacuum(db_name):
+    released = 0
+    free_pages = _pragma_value(db_name, 'freelist_count')
+    # One write per step so bookings get the writer in between
+    while free_pages:
+        _execute(db_name, f"PRAGMA incremental_vacuum({MAINTENANCE_CONFIG['vacuum_pages_per_step']})")
+        remaining = _pragma_value(db_name, 'freelist_count')
+        if remaining >= free_pages:
+            break
+        released += free_pages - remaining
+        free_pages = remaining
+    return f"{released} pages released"
+
+def run_maintenance(db_name=None):
+    """Refresh planner statistics and release free pages, logging each task's duration"""
+    db = get_database()
+    db_name = db_name or db.db_name
+    _timed(db, 'analyze', _execute, db_name, 'ANALYZE')
+    _timed(db, 'optimize', _execute, db_name, 'PRAGMA optimize')
+    if _pragma_value(db_name, 'auto_vacuum') != 2:
+        # Switching needs a full VACUUM, which would block every write while it rewrites the file
+        logger.warning(f"{db_name} was created without incremental auto_vacuum, free pages are not released; "
+                       f"stop the bot and run: python -m maintenance enable-incremental-vacuum")
+        return
+    _timed(db, 'incremental_vacuum', _incremental_vacuum, db_name)
+
+def enable_incremental_vacuum(db_name=None):
+    """Switch a database created before auto_vacuum was set to INCREMENTAL.
+
+    Takes a full VACUUM, which rewrites the whole file under an exclusive
+    lock, so only run it with the bot stopped.
+    """
+    db = get_database()
+    db_name = db_name or db.db_name
+    started = time.perf_counter()
+    conn = connect(db_name, isolation_level=None)
+    try:
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+    duration_ms = (time.perf_counter() - started) * 1000
+    logger.info(f"{db_name} switched to incremental auto_vacuum in {duration_ms:.0f}ms")
+    db.log_maintenance('vacuum', duration_ms, 'auto_vacuum=INCREMENTAL')
+
+if __name__ == '__main__':
+    # python -m maintenance enable-incremental-vacuum, on the bot's DATABASE_NAME
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] != ['enable-incremental-vacuum']:
+        sys.exit('usage: python -m maintenance enable-incremental-vacuum')
+    enable_incremental_vacuum(get_database().db_name)
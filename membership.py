@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+from functools import wraps
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from database import get_database
+from config import MEMBERSHIP_CACHE_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Statuses that must join the channel before using the bot
+NOT_MEMBER_STATUSES = ('left', 'kicked')
+
+class MembershipCache:
+    """Per-user forced channel membership results with status dependent TTLs"""
+
+    def __init__(self, member_ttl_seconds=600, not_member_ttl_seconds=30, max_entries=100000):
+        self.member_ttl = member_ttl_seconds
+        self.not_member_ttl = not_member_ttl_seconds
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, channel, user_id):
+        """Return the cached status, or None when missing or expired"""
+        with self._lock:
+            entry = self._entries.get((channel, user_id))
+            if not entry:
+                return None
+            status, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[(channel, user_id)]
+                return None
+            return status
+
+    def set(self, channel, user_id, status):
+        ttl = self.not_member_ttl if status in NOT_MEMBER_STATUSES else self.member_ttl
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._evict_expired()
+            self._entries[(channel, user_id)] = (status, time.monotonic() + ttl)
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for key in [key for key, (_, expires_at) in self._entries.items() if expires_at < now]:
+            del self._entries[key]
+        if len(self._entries) >= self.max_entries:
+            self._entries.clear()
+
+    def clear(self):
+        """Forget all results, e.g. after the forced channel changed"""
+        with self._lock:
+            self._entries.clear()
+
+membership_cache = MembershipCache(
+    member_ttl_seconds=MEMBERSHIP_CACHE_CONFIG['member_ttl_seconds'],
+    not_member_ttl_seconds=MEMBERSHIP_CACHE_CONFIG['not_member_ttl_seconds'],
+    max_entries=MEMBERSHIP_CACHE_CONFIG['max_entries']
+)
+
+def _forget_previous_channel(entity, key):
+    # Cached membership results belong to the previous channel, also when another process changed it
+    if entity == 'setting' and key == 'force_join_channel':
+        membership_cache.clear()
+
+get_database().add_change_listener(_forget_previous_channel)
+
+def get_membership_status(bot, channel, user_id):
+    """Return the user's status in the channel, asking Telegram only on a cache miss"""
+    status = membership_cache.get(channel, user_id)
+    if status is None:
+        status = bot.get_chat_member(channel, user_id).status
+        membership_cache.set(channel, user_id, status)
+    return status
+
+def check_channel_membership(update, context):
+    """Return True if the user may continue, otherwise ask them to join the forced channel"""
+    force_channel = get_database().get_setting('force_join_channel')
+    user = update.effective_user
+    if not force_channel or not user:
+        return True
+
+    try:
+        status = get_membership_status(context.bot, force_channel, user.id)
+    except Exception as e:
+        logger.warning(f"Error checking channel membership: {e}")
+        return True
+
+    if status not in NOT_MEMBER_STATUSES:
+        return True
+
+    keyboard = [[InlineKeyboardButton("عضویت در کانال", url=f"https://t.me/{force_channel.replace('@', '')}")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    join_message = "برای استفاده از ربات ابتدا در کانال ما عضو شوید:"
+
+    if update.callback_query:
+        update.callback_query.answer()
+        update.callback_query.edit_message_text(join_message, reply_markup=reply_markup)
+    elif update.effective_message:
+        update.effective_message.reply_text(join_message, reply_markup=reply_markup)
+    return False
+
+def requires_channel_membership(handler):
+    """Decorator for entry point handlers that only members of the forced channel may use"""
+    @wraps(handler)
+    def wrapper(update, context, *args, **kwargs):
+        if not check_channel_membership(update, context):
+            return None
+        return handler(update, context, *args, **kwargs)
+    return wrapper
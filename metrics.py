@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+import time
+import bisect
+import logging
+import threading
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telegram.ext import ConversationHandler
+from callback_router import CallbackRouteHandler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+class Counter:
+    """Monotonic counter, optionally split by labels"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+class Histogram:
+    """Latency histogram with fixed buckets, optionally split by labels"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        """Context manager observing the duration of its block"""
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self._series.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, ("le", le))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {count}')
+        return lines
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+class Gauge:
+    """Value computed by a callback at scrape time.
+
+    With labelnames the callback returns a dict from label values (a tuple,
+    or a plain value for a single label) to the gauge's value.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        _registry.append(self)
+
+    def set_function(self, callback):
+        self.callback = callback
+
+    def render(self):
+        if self.callback is None:
+            return []
+        try:
+            value = self.callback()
+        except Exception as e:
+            logger.warning(f"Error collecting gauge {self.name}: {e}")
+            return []
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        if not self.labelnames:
+            return lines + [f'{self.name} {value}']
+        for key, series_value in sorted(value.items()):
+            key = key if isinstance(key, tuple) else (key,)
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {series_value}')
+        return lines
+
+def render_metrics():
+    """Render all registered metrics in the Prometheus text format"""
+    lines = []
+    for metric in list(_registry):
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# Metrics exported by the bot
+UPDATES_TOTAL = Counter('bot_updates_total', 'Updates handled, per handler', ['handler'])
+HANDLER_ERRORS_TOTAL = Counter('bot_handler_errors_total', 'Handler calls that raised, per handler', ['handler'])
+HANDLER_DURATION = Histogram('bot_handler_duration_seconds', 'Handler latency', ['handler'])
+DB_DURATION = Histogram('bot_db_call_duration_seconds', 'Database method latency', ['method'])
+AI_REQUEST_DURATION = Histogram('bot_ai_request_duration_seconds', 'AI provider request latency', ['provider'])
+AI_RESPONSES_TOTAL = Counter('bot_ai_responses_total', 'AI provider responses by status code', ['provider', 'status'])
+JOB_DURATION = Histogram('bot_scheduler_job_duration_seconds', 'Scheduler job duration', ['job'])
+PENDING_RESERVATIONS = Gauge('bot_pending_reservations', 'Reservations waiting for a receipt or approval')
+UPDATE_QUEUE_DEPTH = Gauge('bot_update_queue_depth', 'Updates received but not yet dispatched')
+WORKER_QUEUE_DEPTH = Gauge('bot_update_worker_backlog', 'Updates queued or running on update workers')
+AI_COST_TOTAL = Counter('bot_ai_cost_total', 'Cost of generated images per provider, in its cost_per_image unit', ['provider'])
+AI_HEDGES_TOTAL = Counter('bot_ai_hedged_requests_total', 'Requests sent to a provider because the one asked first was slow', ['provider'])
+AI_CIRCUIT_OPEN = Gauge('bot_ai_circuit_open', 'Whether requests to a provider fail fast (1) or go through (0)', ['provider'])
+AI_TIMEOUT = Gauge('bot_ai_timeout_seconds', 'Current request timeout per provider, derived from recent latency', ['provider'])
+SEND_QUEUE_WAIT = Histogram('bot_send_queue_wait_seconds', 'Time outgoing messages waited in the send queue', ['priority'])
+SENDS_TOTAL = Counter('bot_sends_total', 'Outgoing messages by result (sent, failed, retried)', ['priority', 'result'])
+SEND_QUEUE_DEPTH = Gauge('bot_send_queue_pending', 'Outgoing messages queued or being sent')
+USER_BUFFER_DEPTH = Gauge('bot_user_write_buffer_pending', 'Users waiting to be written by the /start buffer')
+
+def timed_handler(callback, name=None):
+    """Wrap a handler callback so its calls are counted and timed"""
+    label = name or getattr(callback, '__name__', 'unknown')
+
+    @wraps(callback)
+    def wrapper(update, context, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return callback(update, context, *args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS_TOTAL.inc(handler=label)
+            raise
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - started, handler=label)
+            UPDATES_TOTAL.inc(handler=label)
+    return wrapper
+
+def _instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        for nested in handler.entry_points + handler.fallbacks:
+            _instrument_handler(nested)
+        for state_handlers in handler.states.values():
+            for nested in state_handlers:
+                _instrument_handler(nested)
+        return
+    if isinstance(handler, CallbackRouteHandler) and handler.callback is None:
+        # The router's catch-all handler, one label per routed callback
+        handler.router.wrap_callbacks(timed_handler)
+        return
+    if getattr(handler, 'callback', None) is not None:
+        handler.callback = timed_handler(handler.callback)
+
+def instrument_dispatcher(dispatcher):
+    """Time every handler registered on the dispatcher, including conversation states"""
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler)
+
+def instrument_methods(obj, histogram, label='method'):
+    """Replace the public methods of obj with timed wrappers"""
+    for name in dir(obj):
+        if name.startswith('_'):
+            continue
+        method = getattr(obj, name)
+        if not callable(method):
+            continue
+
+        def make_wrapper(method, name):
+            @wraps(method)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started, **{label: name})
+            return wrapper
+
+        setattr(obj, name, make_wrapper(method, name))
+
+def timed_job(name, job):
+    """Wrap a scheduler job so its duration is recorded"""
+    @wraps(job)
+    def wrapper(*args, **kwargs):
+        with JOB_DURATION.time(job=name):
+            return job(*args, **kwargs)
+    return wrapper
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        payload = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(listen='127.0.0.1', port=9100):
+    """Serve /metrics from a daemon thread; returns the server so it can be shut down"""
+    server = ThreadingHTTPServer((listen, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics_server', daemon=True).start()
+    logger.info(f"Metrics endpoint listening on http://{listen}:{server.server_address[1]}/metrics")
+    return server
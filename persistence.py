@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import threading
+from collections import defaultdict, OrderedDict
+from telegram.ext import BasePersistence
+from database import get_database, connect, serialized_write
+from config import PERSISTENCE_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Writes of one user's data hold one of these locks, picked by user id
+USER_LOCK_STRIPES = 64
+
+class _UserDataLoader:
+    """default_factory for LazyUserData that also knows how to load a user from the database.
+
+    PTB copies user_data with copy(), which keeps default_factory but drops
+    instance attributes, so the loader has to live here.
+    """
+
+    def __init__(self, persistence):
+        self.persistence = persistence
+
+    def __call__(self):
+        return {}
+
+    def load(self, user_id):
+        return self.persistence.load_user_data(user_id)
+
+class LazyUserData(defaultdict):
+    """user_data mapping that reads a user's stored data on first access"""
+
+    def __missing__(self, user_id):
+        value = self.default_factory.load(user_id)
+        self[user_id] = value
+        return value
+
+class LazyConversations(dict):
+    """Conversation states of one ConversationHandler, loaded per key on first lookup"""
+
+    def __init__(self, persistence, name):
+        super().__init__()
+        self.persistence = persistence
+        self.name = name
+        self._loaded = set()
+
+    def _ensure_loaded(self, key):
+        if key in self._loaded:
+            return
+        self._loaded.add(key)
+        state = self.persistence.load_conversation_state(self.name, key)
+        if state is not None and not super().__contains__(key):
+            super().__setitem__(key, state)
+
+    def get(self, key, default=None):
+        self._ensure_loaded(key)
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        self._ensure_loaded(key)
+        return super().__contains__(key)
+
+    def __getitem__(self, key):
+        self._ensure_loaded(key)
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        self._loaded.add(key)
+        super().__setitem__(key, value)
+
+class SQLitePersistence(BasePersistence):
+    """Store conversation states and user_data in the bot's SQLite database.
+
+    Only keys that changed since the last write are stored, and nothing is
+    read at startup: users and conversations are loaded on first access.
+    What was last stored is remembered for the max_cached_users most recent
+    users; for the others it is read back when their data is next written.
+    """
+
+    def __init__(self, db_name=None, max_cached_users=None):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        # Tables are created by the schema migrations of the shared database
+        self.db_name = db_name or get_database().db_name
+        self.max_cached_users = max_cached_users or PERSISTENCE_CONFIG['max_cached_users']
+        # Serialized values as last read from / written to the database, least recently used user first
+        self._user_snapshots = OrderedDict()
+        self._lock = threading.Lock()
+        self._user_locks = [threading.Lock() for _ in range(USER_LOCK_STRIPES)]
+
+    def _remember(self, user_id, snapshot):
+        with self._lock:
+            self._user_snapshots[user_id] = snapshot
+            self._user_snapshots.move_to_end(user_id)
+            while len(self._user_snapshots) > self.max_cached_users:
+                self._user_snapshots.popitem(last=False)
+
+    def load_user_data(self, user_id):
+        """Read the stored user_data of one user"""
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+
+            cursor.execute('SELECT key, value FROM user_data WHERE user_id = ?', (user_id,))
+            rows = cursor.fetchall()
+
+            self._remember(user_id, dict(rows))
+            return {key: json.loads(value) for key, value in rows}
+
+        except Exception as e:
+            logger.error(f"Error loading user data for {user_id}: {e}")
+            return {}
+        finally:
+            if conn:
+                conn.close()
+
+    def load_conversation_state(self, name, key):
+        """Read the stored state of one conversation"""
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                SELECT state FROM conversations
+                WHERE name = ? AND conversation_key = ?
+            ''', (name, json.dumps(key)))
+            result = cursor.fetchone()
+
+            return json.loads(result[0]) if result else None
+
+        except Exception as e:
+            logger.error(f"Error loading conversation {name} {key}: {e}")
+            return None
+        finally:
+            if conn:
+                conn.close()
+
+    def get_user_data(self):
+        return LazyUserData(_UserDataLoader(self))
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return LazyConversations(self, name)
+
+    @serialized_write
+    def update_conversation(self, name, key, new_state):
+        """Write a single conversation transition"""
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+
+            if new_state is None:
+                cursor.execute('''
+                    DELETE FROM conversations
+                    WHERE name = ? AND conversation_key = ?
+                ''', (name, json.dumps(key)))
+            else:
+                cursor.execute('''
+                    INSERT INTO conversations (name, conversation_key, state)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT (name, conversation_key) DO UPDATE SET state = excluded.state
+                ''', (name, json.dumps(key), json.dumps(new_state)))
+
+            conn.commit()
+
+        except Exception as e:
+            logger.error(f"Error saving conversation {name} {key}: {e}")
+            if conn:
+                conn.rollback()
+        finally:
+            if conn:
+                conn.close()
+
+    def update_user_data(self, user_id, data):
+        """Write only the user_data keys that changed since the last write.
+
+        Updates of the same user from chats handled in parallel take turns,
+        so an older copy of the data is never written over a newer one.
+        """
+        with self._user_locks[hash(user_id) % USER_LOCK_STRIPES]:
+            serialized = {}
+            for key, value in data.items():
+                try:
+                    serialized[str(key)] = json.dumps(value, ensure_ascii=False, sort_keys=True)
+                except (TypeError, ValueError):
+                    logger.warning(f"Skipping non-serializable user_data key {key} for user {user_id}")
+
+            with self._lock:
+                previous = self._user_snapshots.get(user_id)
+            if previous == serialized:
+                return
+            self._write_user_data(user_id, serialized, previous)
+
+    @serialized_write
+    def _write_user_data(self, user_id, serialized, previous):
+        conn = None
+        try:
+            conn = connect(self.db_name)
+            cursor = conn.cursor()
+
+            if previous is None:
+                # Not remembered any more, compare with what is stored
+                cursor.execute('SELECT key, value FROM user_data WHERE user_id = ?', (user_id,))
+                previous = dict(cursor.fetchall())
+            changed = [(key, value) for key, value in serialized.items() if previous.get(key) != value]
+            removed = [key for key in previous if key not in serialized]
+
+            cursor.executemany('''
+                INSERT INTO user_data (user_id, key, value)
+                VALUES (?, ?, ?)
+                ON CONFLICT (user_id, key) DO UPDATE SET value = excluded.value
+            ''', [(user_id, key, value) for key, value in changed])
+            cursor.executemany(
+                'DELETE FROM user_data WHERE user_id = ? AND key = ?',
+                [(user_id, key) for key in removed]
+            )
+
+            conn.commit()
+            self._remember(user_id, serialized)
+
+        except Exception as e:
+            logger.error(f"Error saving user data for {user_id}: {e}")
+            if conn:
+                conn.rollback()
+        finally:
+            if conn:
+                conn.close()
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import re
+import time
+import sqlite3
+import logging
+import threading
+from collections import deque
+from config import QUERY_STATS_CONFIG
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r'\s+')
+
+# Statements EXPLAIN QUERY PLAN can describe
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+def normalize_sql(sql):
+    """Collapse whitespace so the same statement from different call sites is counted once"""
+    return _WHITESPACE.sub(' ', sql).strip()
+
+class _StatementStats:
+    def __init__(self, max_samples):
+        self.count = 0
+        self.total = 0.0
+        self.slow = 0
+        self.samples = deque(maxlen=max_samples)
+
+    def p99(self):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+class QueryStats:
+    """Count, total and p99 time per SQL statement executed through a profiled connection"""
+
+    def __init__(self, slow_query_ms=50, max_samples=1000):
+        self.slow_query_ms = slow_query_ms
+        self.max_samples = max_samples
+        self._statements = {}
+        self._lock = threading.Lock()
+
+    def record(self, sql, elapsed):
+        sql = normalize_sql(sql)
+        slow = elapsed * 1000 >= self.slow_query_ms
+        with self._lock:
+            stats = self._statements.get(sql)
+            if stats is None:
+                stats = self._statements[sql] = _StatementStats(self.max_samples)
+            stats.count += 1
+            stats.total += elapsed
+            stats.samples.append(elapsed)
+            if slow:
+                stats.slow += 1
+        if slow:
+            logger.warning(f"Slow query ({elapsed * 1000:.1f} ms): {sql}")
+
+    def top(self, limit=5):
+        """Return (sql, count, total, p99, slow) for the statements with the most total time"""
+        with self._lock:
+            rows = [(sql, s.count, s.total, s.p99(), s.slow) for sql, s in self._statements.items()]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+
+query_stats = QueryStats(
+    slow_query_ms=QUERY_STATS_CONFIG['slow_query_ms'],
+    max_samples=QUERY_STATS_CONFIG['samples_per_query']
+)
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor recording the duration of every execute in query_stats"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            query_stats.record(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            query_stats.record(sql, time.perf_counter() - started)
+
+class ProfiledConnection(sqlite3.Connection):
+    """Connection whose cursors, including the execute shortcuts, are profiled"""
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def explain_query_plan(db_name, sql):
+    """Return the EXPLAIN QUERY PLAN lines of a recorded statement, binding NULL for its parameters"""
+    if not sql.upper().startswith(_EXPLAINABLE):
+        return []
+    conn = sqlite3.connect(db_name)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', (None,) * sql.count('?'))
+        return [row[3] for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        return [f'error: {e}']
+    finally:
+        conn.close()
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import random
+import logging
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from metrics import SEND_QUEUE_WAIT, SENDS_TOTAL
+from config import SEND_QUEUE_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Lower values are sent first
+PRIORITY_TRANSACTIONAL = 0
+PRIORITY_BROADCAST = 1
+PRIORITY_NAMES = {PRIORITY_TRANSACTIONAL: 'transactional', PRIORITY_BROADCAST: 'broadcast'}
+
+# Chat buckets that refilled are dropped this often
+BUCKET_SWEEP_SECONDS = 60
+
+class TokenBucket:
+    """Allow rate events per second on average, with bursts of up to burst; not thread safe"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available, 0 if one is available now"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+class _Send:
+    __slots__ = ('priority', 'seq', 'method', 'chat_id', 'kwargs', 'future', 'queued_at', 'attempts', 'flood_retries')
+
+    def __init__(self, priority, seq, method, chat_id, kwargs):
+        self.priority = priority
+        self.seq = seq
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.future = Future()
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+        self.flood_retries = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class _Chat:
+    __slots__ = ('sends', 'state', 'not_before')
+
+    def __init__(self):
+        self.sends = []  # heap of _Send, highest priority and then oldest first
+        self.state = None  # 'ready', 'delayed', 'sending' or None while not scheduled
+        self.not_before = 0  # Backoff after a network error
+
+class SendQueue:
+    """One queue for the Bot API calls the bot makes on its own, paced to stay under Telegram's flood limits.
+
+    A scheduler thread hands sends to a small worker pool as a global and a
+    per-chat token bucket allow. Transactional messages go ahead of
+    broadcasts, and one chat never has two sends in flight, so its messages
+    arrive in order. RetryAfter pauses the whole queue for the time Telegram
+    asks for and the send is retried up to max_flood_retries times; network
+    errors are retried max_retries times with exponential backoff. Other
+    errors fail the send.
+
+    submit() returns a Future with the API call's result.
+    """
+
+    def __init__(self, rate_per_second=25, burst=5, per_chat_rate_per_second=1, per_chat_burst=1, workers=4,
+                 max_retries=5, max_flood_retries=10, backoff_base_seconds=1, backoff_max_seconds=60):
+        self.per_chat_rate = per_chat_rate_per_second
+        self.per_chat_burst = per_chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self.max_flood_retries = max_flood_retries
+        self.backoff_base = backoff_base_seconds
+        self.backoff_max = backoff_max_seconds
+        self._global = TokenBucket(rate_per_second, burst, time.monotonic())
+        self._buckets = {}
+        self._chats = {}
+        self._ready = []  # (priority, seq, chat_id); may hold stale entries, checked against the chat state
+        self._delayed = []  # (due, chat_id)
+        self._paused_until = 0
+        self._last_sweep = time.monotonic()
+        self._seq = itertools.count()
+        self._queued = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        self._stopped = False
+        self._thread = None
+        self._executor = None
+
+    def submit(self, method, chat_id, priority=PRIORITY_TRANSACTIONAL, **kwargs):
+        """Queue method(chat_id=chat_id, **kwargs), e.g. bot.send_message; returns a Future"""
+        with self._lock:
+            send = _Send(priority, next(self._seq), method, chat_id, kwargs)
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _Chat()
+            heapq.heappush(chat.sends, send)
+            self._queued += 1
+
+            if chat.state is None:
+                self._schedule(chat_id, chat, time.monotonic())
+            elif chat.state == 'ready' and chat.sends[0] is send:
+                # Jumps the queue with its higher priority; the old entry is skipped as stale
+                heapq.heappush(self._ready, (priority, send.seq, chat_id))
+
+            if self._thread is None and not self._stopped:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='send')
+                self._thread = threading.Thread(target=self._run, name='send_queue', daemon=True)
+                self._thread.start()
+            self._changed.notify()
+        return send.future
+
+    @property
+    def pending(self):
+        """Number of queued or in-flight sends"""
+        with self._lock:
+            return self._queued
+
+    def _bucket(self, chat_id, now):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst, now)
+        return bucket
+
+    def _schedule(self, chat_id, chat, now):
+        """Put a chat with queued sends in the ready heap, or in the delayed heap until it may send again"""
+        due = max(chat.not_before, now + self._bucket(chat_id, now).wait_time(now))
+        if due > now:
+            chat.state = 'delayed'
+            heapq.heappush(self._delayed, (due, chat_id))
+        else:
+            chat.state = 'ready'
+            head = chat.sends[0]
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+
+    def _next_send(self):
+        """Block until a send may go out under both rate limits and take it; None once stopped and empty"""
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, chat_id = heapq.heappop(self._delayed)
+                chat = self._chats.get(chat_id)
+                if chat is not None and chat.state == 'delayed':
+                    self._schedule(chat_id, chat, now)
+
+            if now - self._last_sweep > BUCKET_SWEEP_SECONDS:
+                self._last_sweep = now
+                for chat_id in [chat_id for chat_id, bucket in self._buckets.items()
+                                if chat_id not in self._chats and bucket.full(now)]:
+                    del self._buckets[chat_id]
+
+            while self._ready:
+                chat = self._chats.get(self._ready[0][2])
+                if chat is not None and chat.state == 'ready':
+                    break
+                heapq.heappop(self._ready)
+
+            if self._stopped and not self._queued:
+                return None
+
+            wait = self._delayed[0][0] - now if self._delayed else None
+            if self._ready:
+                ready_in = max(self._paused_until - now, self._global.wait_time(now))
+                if ready_in <= 0:
+                    _, _, chat_id = heapq.heappop(self._ready)
+                    chat = self._chats[chat_id]
+                    send = heapq.heappop(chat.sends)
+                    chat.state = 'sending'
+                    self._global.take(now)
+                    self._bucket(chat_id, now).take(now)
+                    return send
+                wait = ready_in if wait is None else min(wait, ready_in)
+            self._changed.wait(wait)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                send = self._next_send()
+            if send is None:
+                return
+            self._executor.submit(self._send, send)
+
+    def _send(self, send):
+        if not send.attempts:
+            SEND_QUEUE_WAIT.observe(time.monotonic() - send.queued_at, priority=PRIORITY_NAMES.get(send.priority))
+        send.attempts += 1
+        result = error = None
+        retry_after = backoff = None
+        try:
+            result = send.method(chat_id=send.chat_id, **send.kwargs)
+        except RetryAfter as e:
+            send.flood_retries += 1
+            if send.flood_retries <= self.max_flood_retries:
+                retry_after = e.retry_after
+            error = e
+        except BadRequest as e:
+            # A NetworkError subclass, but retrying won't help
+            error = e
+        except NetworkError as e:
+            if send.attempts <= self.max_retries:
+                backoff = min(self.backoff_max, self.backoff_base * 2 ** (send.attempts - 1)) * random.uniform(0.5, 1)
+            error = e
+        except Exception as e:
+            error = e
+
+        priority = PRIORITY_NAMES.get(send.priority)
+        with self._lock:
+            now = time.monotonic()
+            chat = self._chats[send.chat_id]
+            if retry_after is not None or backoff is not None:
+                SENDS_TOTAL.inc(priority=priority, result='retried')
+                if retry_after is not None:
+                    # Flood control applies to the bot, so every chat waits
+                    logger.warning(f"Flood control: pausing outgoing messages for {retry_after}s")
+                    self._paused_until = max(self._paused_until, now + retry_after)
+                else:
+                    logger.warning(f"Network error sending to chat {send.chat_id}, retrying in {backoff:.1f}s: {error}")
+                    chat.not_before = now + backoff
+                heapq.heappush(chat.sends, send)
+            else:
+                SENDS_TOTAL.inc(priority=priority, result='failed' if error else 'sent')
+                chat.not_before = 0
+                self._queued -= 1
+                if not self._queued:
+                    self._idle.notify_all()
+
+            if chat.sends:
+                self._schedule(send.chat_id, chat, now)
+            else:
+                del self._chats[send.chat_id]
+            self._changed.notify()
+
+        if error is not None and backoff is None and retry_after is None:
+            logger.error(f"Failed to send {getattr(send.method, '__name__', 'message')} to chat {send.chat_id}: {error}")
+            send.future.set_exception(error)
+        elif retry_after is None and backoff is None:
+            send.future.set_result(result)
+
+    def stop(self, timeout=30):
+        """Send what is queued, waiting at most timeout seconds, then stop the threads"""
+        with self._lock:
+            self._stopped = True
+            self._changed.notify()
+            deadline = time.monotonic() + timeout
+            while self._queued and time.monotonic() < deadline:
+                self._idle.wait(deadline - time.monotonic())
+            if self._queued:
+                logger.warning(f"Stopping with {self._queued} outgoing messages still queued")
+        if self._thread:
+            self._thread.join(timeout=1)
+            self._executor.shutdown(wait=False)
+
+# enabled is read by queue_send and drain_timeout_seconds by main on shutdown
+send_queue = SendQueue(**{
+    key: value for key, value in SEND_QUEUE_CONFIG.items() if key not in ('enabled', 'drain_timeout_seconds')
+})
+
+def queue_send(method, chat_id, priority=PRIORITY_TRANSACTIONAL, **kwargs):
+    """Send through the shared queue; returns a Future with the result, or its error"""
+    if SEND_QUEUE_CONFIG['enabled']:
+        return send_queue.submit(method, chat_id, priority, **kwargs)
+
+    future = Future()
+    try:
+        future.set_result(method(chat_id=chat_id, **kwargs))
+    except Exception as e:
+        logger.error(f"Failed to send {getattr(method, '__name__', 'message')} to chat {chat_id}: {e}")
+        future.set_exception(e)
+    return future
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import re
+from datetime import date
+
+# Persian and Arabic-Indic digits
+DIGITS = str.maketrans('۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '01234567890123456789')
+
+JALALI_MONTHS = {
+    'فروردین': 1, 'اردیبهشت': 2, 'خرداد': 3, 'تیر': 4, 'مرداد': 5, 'شهریور': 6,
+    'مهر': 7, 'آبان': 8, 'آذر': 9, 'دی': 10, 'بهمن': 11, 'اسفند': 12
+}
+
+NUMERIC_DATE = re.compile(r'(\d{4})\s*[/\-.]\s*(\d{1,2})\s*[/\-.]\s*(\d{1,2})')
+NAMED_DATE = re.compile(r'(\d{1,2})\s+(' + '|'.join(JALALI_MONTHS) + r')\s+(\d{4})')
+
+def jalali_to_gregorian(jy, jm, jd):
+    """Convert a Jalali (Solar Hijri) date to a datetime.date"""
+    jy += 1595
+    days = -355668 + 365 * jy + (jy // 33) * 8 + ((jy % 33) + 3) // 4 + jd
+    days += (jm - 1) * 31 if jm < 7 else (jm - 7) * 30 + 186
+    gy = 400 * (days // 146097)
+    days %= 146097
+    if days > 36524:
+        days -= 1
+        gy += 100 * (days // 36524)
+        days %= 36524
+        if days >= 365:
+            days += 1
+    gy += 4 * (days // 1461)
+    days %= 1461
+    if days > 365:
+        gy += (days - 1) // 365
+        days = (days - 1) % 365
+    leap = (gy % 4 == 0 and gy % 100 != 0) or gy % 400 == 0
+    month_days = (31, 29 if leap else 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+    gm = 0
+    while days >= month_days[gm]:
+        days -= month_days[gm]
+        gm += 1
+    return date(gy, gm + 1, days + 1)
+
+def jalali_month_days(year, month):
+    """Days in a Jalali month: 31 in the first six, 30 in the next five, 29 in Esfand or 30 in leap years"""
+    if month <= 6:
+        return 31
+    if month <= 11:
+        return 30
+    # Esfand 30 of a common year falls on Farvardin 1 of the next
+    return 30 if jalali_to_gregorian(year, 12, 30) != jalali_to_gregorian(year + 1, 1, 1) else 29
+
+def parse_slot_day(slot_text):
+    """The day of a slot's free text as 'YYYY-MM-DD' (Gregorian), or None if it names no date.
+
+    Understands '۲۵ تیر ۱۴۰۴' and numeric '1404/04/25' or '2025-07-16'; years
+    before 1700 are taken as Jalali.
+    """
+    text = (slot_text or '').translate(DIGITS)
+    match = NAMED_DATE.search(text)
+    if match:
+        year, month, day = int(match.group(3)), JALALI_MONTHS[match.group(2)], int(match.group(1))
+    else:
+        match = NUMERIC_DATE.search(text)
+        if not match:
+            return None
+        year, month, day = (int(group) for group in match.groups())
+
+    try:
+        if year < 1700:
+            if not (1 <= month <= 12 and 1 <= day <= jalali_month_days(year, month)):
+                return None
+            return jalali_to_gregorian(year, month, day).isoformat()
+        return date(year, month, day).isoformat()
+    except (ValueError, IndexError):
+        return None
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import pytest
+
+# The bot's modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import database
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A migrated database in a temporary file, installed as the process-wide instance"""
+    # Every read goes to the file; no change_log polling thread outlives the test
+    monkeypatch.setitem(config.CHANGE_FEED_CONFIG, 'enabled', False)
+    instance = database.Database(str(tmp_path / 'test.db'))
+    monkeypatch.setattr(database, '_database', instance)
+    return instance
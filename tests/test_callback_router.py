@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import base64
+
+import pytest
+
+from callback_router import (
+    ACTION_CODES, COMPACT_PREFIX, MAX_CALLBACK_DATA_BYTES, CallbackRouter, Payload, decode_callback, encode_callback
+)
+
+@pytest.mark.parametrize('args', [
+    (),
+    (0,),
+    (981,),
+    (-3, 2 ** 40),
+    ('welcome_message', True, False, None),
+    ('طرح اژدها',),
+])
+def test_round_trip(args):
+    data = encode_callback('book_discount', *args)
+    assert data.startswith(COMPACT_PREFIX)
+    assert decode_callback(data) == ('book_discount', args)
+
+def test_payload_round_trip():
+    design = {'variant': 2, 'description': 'شیر با تاج به سبک رئالیسم ' * 20}
+    data = encode_callback('book_appointment_discount', Payload(design))
+    assert len(data) <= MAX_CALLBACK_DATA_BYTES
+
+    action, (payload,) = decode_callback(data)
+    assert action == 'book_appointment_discount'
+    assert payload.value == design
+
+def test_every_action_fits_with_a_large_id():
+    for action in ACTION_CODES:
+        assert len(encode_callback(action, 2 ** 62)) <= MAX_CALLBACK_DATA_BYTES
+
+def test_over_64_bytes_is_rejected():
+    with pytest.raises(ValueError):
+        encode_callback('book_slot', 'x' * 45)
+
+def test_unencodable_argument_is_rejected():
+    with pytest.raises(TypeError):
+        encode_callback('book_slot', 1.5)
+
+def _compact(raw):
+    return COMPACT_PREFIX + base64.urlsafe_b64encode(bytes(raw)).decode('ascii').rstrip('=')
+
+@pytest.mark.parametrize('raw', [
+    [],  # empty
+    [2, 1],  # unknown version
+    [1],  # no action code
+    [1, 0x81],  # truncated varint
+    [1, 99],  # unknown action
+    [1, 1, 42],  # unknown argument tag
+    [1, 1, 4, 1, 2],  # truncated payload key
+    [1, 1, 1, 5, 97],  # truncated string
+])
+def test_malformed_data_decodes_to_none(raw):
+    assert decode_callback(_compact(raw)) is None
+
+def test_invalid_base64_decodes_to_none():
+    assert decode_callback(COMPACT_PREFIX + '!!!') is None
+
+def test_router_matches_compact_and_text_data():
+    router = CallbackRouter()
+    router.add('book_slot', int, callback=print)
+    router.add('edit', str)
+    router.add('edit_text', str)
+
+    route, args = router.match(encode_callback('book_slot', 7))
+    assert (route.action, args) == ('book_slot', (7,))
+    route, args = router.match('book_slot_7')
+    assert (route.action, args) == ('book_slot', (7,))
+    route, args = router.match('edit_text_welcome_message')
+    assert (route.action, args) == ('edit_text', ('welcome_message',))
+    assert router.match('book_slot_seven') is None
+    assert router.match(encode_callback('book_slot', 'seven')) is None
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import types
+
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker, 'time', types.SimpleNamespace(monotonic=clock))
+    return clock
+
+@pytest.fixture
+def circuit(clock):
+    return CircuitBreaker('test', max_timeout_seconds=30, failure_threshold=3, slow_call_seconds=20, open_seconds=10,
+                          latency_samples=50, min_samples=5, timeout_percentile=0.99, timeout_multiplier=1.5,
+                          min_timeout_seconds=2)
+
+def test_opens_after_consecutive_failures(circuit):
+    circuit.record_failure()
+    circuit.record_failure()
+    assert circuit.state == CLOSED
+    circuit.record_failure()
+    assert circuit.state == OPEN
+    assert not circuit.allow()
+
+def test_success_resets_the_failure_count(circuit):
+    for _ in range(2):
+        circuit.record_failure()
+    circuit.record_success(1.0)
+    circuit.record_failure()
+    assert circuit.state == CLOSED
+
+def test_slow_successes_count_as_failures(circuit):
+    for _ in range(3):
+        circuit.record_success(25.0)
+    assert circuit.state == OPEN
+
+def test_half_open_lets_one_probe_through(circuit, clock):
+    for _ in range(3):
+        circuit.record_failure()
+    clock.now += 10
+    assert circuit.state == HALF_OPEN
+    assert circuit.allow()
+    assert not circuit.allow()
+    # The probe always gets the full timeout
+    assert circuit.timeout() == 30
+
+    circuit.record_success(1.0)
+    assert circuit.state == CLOSED
+    assert circuit.allow()
+
+def test_failed_probe_opens_again(circuit, clock):
+    for _ in range(3):
+        circuit.record_failure()
+    clock.now += 10
+    assert circuit.allow()
+    circuit.record_failure()
+    assert circuit.state == OPEN
+    clock.now += 9
+    assert not circuit.allow()
+
+def test_released_probe_makes_way_for_the_next(circuit, clock):
+    for _ in range(3):
+        circuit.record_failure()
+    clock.now += 10
+    assert circuit.allow()
+    circuit.release_probe()
+    assert circuit.state == HALF_OPEN
+    assert circuit.allow()
+
+def test_probe_that_never_reports_back_expires(circuit, clock):
+    for _ in range(3):
+        circuit.record_failure()
+    clock.now += 10
+    assert circuit.allow()
+    clock.now += 30
+    assert circuit.allow()
+
+def test_timeout_follows_latency(circuit):
+    assert circuit.timeout() == 30
+    for _ in range(5):
+        circuit.record_success(4.0)
+    assert circuit.timeout() == pytest.approx(6.0)
+    for _ in range(5):
+        circuit.record_success(0.1)
+    assert circuit.timeout() == pytest.approx(6.0)
+
+def test_timeout_is_clamped(circuit):
+    for _ in range(5):
+        circuit.record_success(0.1)
+    assert circuit.timeout() == 2
+
+def test_timeouts_grow_the_timeout_back(circuit):
+    for _ in range(5):
+        circuit.record_success(2.0)
+    assert circuit.timeout() == pytest.approx(3.0)
+    for _ in range(20):
+        circuit.record_timeout(circuit.timeout())
+        # Keeps the circuit closed, so only the samples move the timeout
+        circuit.record_success()
+    assert circuit.timeout() == 30
+
+def test_reset_forgets_state_and_latencies(circuit):
+    for _ in range(5):
+        circuit.record_success(2.0)
+    for _ in range(3):
+        circuit.record_failure()
+    circuit.reset()
+    assert circuit.state == CLOSED
+    assert circuit.timeout() == 30
+    assert circuit.percentile(0.5) is None
+    assert circuit.snapshot() == (CLOSED, 0, 0, 30)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import sqlite3
+
+import config
+from database import MIGRATIONS, Database
+
+# Tables of the first release, created before schema migrations existed
+BASELINE_SCHEMA = '''
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        first_name TEXT,
+        username TEXT,
+        join_date DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE slots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        slot_text TEXT NOT NULL,
+        is_available BOOLEAN DEFAULT 1
+    );
+    CREATE TABLE reservations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        slot_id INTEGER,
+        status TEXT DEFAULT 'pending',
+        receipt_photo_id TEXT,
+        pending_time DATETIME,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(user_id),
+        FOREIGN KEY (slot_id) REFERENCES slots(id)
+    );
+    CREATE TABLE settings (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    INSERT INTO users (user_id, first_name, username) VALUES (42, 'سارا', 'sara');
+    INSERT INTO slots (slot_text, is_available) VALUES ('۲۵ تیر ۱۴۰۴ ساعت ۱۶', 0), ('شنبه ساعت ۱۰', 1);
+    INSERT INTO reservations (user_id, slot_id, status) VALUES (42, 1, 'confirmed');
+    INSERT INTO settings (key, value) VALUES ('welcome_message', 'سلام!'), ('force_channel', '@studio');
+'''
+
+def _query(db_name, sql, *params):
+    conn = sqlite3.connect(db_name)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+def test_migrations_are_numbered_in_order():
+    versions = [version for version, _, _ in MIGRATIONS]
+    assert versions == list(range(1, len(versions) + 1))
+
+def test_baseline_database_is_migrated_to_the_latest_version(tmp_path, monkeypatch):
+    db_name = str(tmp_path / 'baseline.db')
+    conn = sqlite3.connect(db_name)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.close()
+
+    # Settings are read from the file, without starting the change_log poller
+    monkeypatch.setitem(config.CHANGE_FEED_CONFIG, 'enabled', False)
+    db = Database(db_name)
+
+    assert _query(db_name, 'SELECT MAX(version) FROM schema_version') == [(MIGRATIONS[-1][0],)]
+    # Existing rows and edited settings are kept
+    assert _query(db_name, 'SELECT first_name FROM users') == [('سارا',)]
+    assert _query(db_name, 'SELECT status FROM reservations') == [('confirmed',)]
+    assert db.get_setting('welcome_message') == 'سلام!'
+    # Migration 4 moved the forced channel to the key that is read
+    assert db.get_setting('force_join_channel') == '@studio'
+    assert _query(db_name, "SELECT 1 FROM settings WHERE key = 'force_channel'") == []
+    # Migration 10 backfilled slot days and added the waitlist settings and tables
+    assert _query(db_name, 'SELECT slot_text, slot_day FROM slots ORDER BY id') == [
+        ('۲۵ تیر ۱۴۰۴ ساعت ۱۶', '2025-07-16'), ('شنبه ساعت ۱۰', None)
+    ]
+    assert db.get_setting('booking_waitlist_offer')
+    for table in ('waitlist', 'waitlist_days', 'slot_holds', 'events', 'change_log', 'user_data', 'reservations_archive'):
+        assert _query(db_name, "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", table) == [(1,)]
+
+def test_reopening_an_up_to_date_database_applies_nothing(tmp_path):
+    db_name = str(tmp_path / 'fresh.db')
+    Database(db_name)
+    applied = _query(db_name, 'SELECT version, applied_at FROM schema_version ORDER BY version')
+    assert [version for version, _ in applied] == [version for version, _, _ in MIGRATIONS]
+
+    Database(db_name)
+    assert _query(db_name, 'SELECT version, applied_at FROM schema_version ORDER BY version') == applied
+
+def test_new_database_uses_incremental_auto_vacuum(tmp_path):
+    db_name = str(tmp_path / 'fresh.db')
+    Database(db_name)
+    assert _query(db_name, 'PRAGMA auto_vacuum') == [(2,)]
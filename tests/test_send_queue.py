@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+
+import pytest
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from send_queue import PRIORITY_BROADCAST, SendQueue
+
+@pytest.fixture
+def queue():
+    # Limits high enough that pacing doesn't slow the tests down
+    send_queue = SendQueue(rate_per_second=10000, burst=100, per_chat_rate_per_second=10000, per_chat_burst=100,
+                           workers=4, max_retries=2, max_flood_retries=3, backoff_base_seconds=0.001,
+                           backoff_max_seconds=0.001)
+    yield send_queue
+    send_queue.stop(timeout=5)
+
+class Recorder:
+    """Stands in for a Bot API method, recording calls per chat and the most sends in flight for one chat"""
+
+    def __init__(self):
+        self.calls = {}
+        self.in_flight = {}
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, chat_id, text):
+        with self._lock:
+            self.calls.setdefault(chat_id, []).append(text)
+            self.in_flight[chat_id] = self.in_flight.get(chat_id, 0) + 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight[chat_id])
+        time.sleep(random.uniform(0, 0.002))
+        with self._lock:
+            self.in_flight[chat_id] -= 1
+        return text
+
+def test_sends_of_one_chat_keep_their_order(queue):
+    send = Recorder()
+    futures = [queue.submit(send, chat_id, text=number) for number in range(30) for chat_id in (1, 2, 3)]
+
+    assert [future.result(timeout=5) for future in futures] == [number for number in range(30) for _ in range(3)]
+    assert send.calls == {chat_id: list(range(30)) for chat_id in (1, 2, 3)}
+    assert send.max_in_flight == 1
+    assert queue.pending == 0
+
+def test_transactional_sends_go_ahead_of_broadcasts():
+    send = Recorder()
+    # Sends 50ms apart, so everything queues behind the first
+    queue = SendQueue(rate_per_second=1000, burst=1, per_chat_rate_per_second=20, per_chat_burst=1, workers=1)
+    try:
+        futures = [queue.submit(send, 1, text='first')]
+        futures += [queue.submit(send, 1, priority=PRIORITY_BROADCAST, text=f'broadcast {n}') for n in range(2)]
+        futures.append(queue.submit(send, 1, text='receipt'))
+        for future in futures:
+            future.result(timeout=10)
+    finally:
+        queue.stop(timeout=1)
+    assert send.calls[1] == ['first', 'receipt', 'broadcast 0', 'broadcast 1']
+
+def test_flood_control_retries_are_capped(queue):
+    calls = []
+
+    def flooded(chat_id, text):
+        calls.append(text)
+        raise RetryAfter(0)
+
+    with pytest.raises(RetryAfter):
+        queue.submit(flooded, 1, text='hi').result(timeout=5)
+    assert len(calls) == queue.max_flood_retries + 1
+
+def test_network_errors_are_retried_with_backoff(queue):
+    calls = []
+
+    def flaky(chat_id, text):
+        calls.append(text)
+        if len(calls) <= queue.max_retries:
+            raise NetworkError('connection reset')
+        return 'sent'
+
+    assert queue.submit(flaky, 1, text='hi').result(timeout=5) == 'sent'
+    assert len(calls) == queue.max_retries + 1
+
+def test_bad_request_is_not_retried(queue):
+    calls = []
+
+    def rejected(chat_id, text):
+        calls.append(text)
+        raise BadRequest('Chat not found')
+
+    with pytest.raises(BadRequest):
+        queue.submit(rejected, 1, text='hi').result(timeout=5)
+    assert calls == ['hi']
+
+def test_unknown_options_are_rejected():
+    with pytest.raises(TypeError):
+        SendQueue(enabled=True)
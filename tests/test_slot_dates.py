@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+from datetime import date
+
+import pytest
+
+from slot_dates import jalali_month_days, jalali_to_gregorian, parse_slot_day
+
+@pytest.mark.parametrize('jalali, gregorian', [
+    ((1404, 1, 1), date(2025, 3, 21)),
+    ((1404, 4, 25), date(2025, 7, 16)),
+    ((1403, 12, 30), date(2025, 3, 20)),
+    ((1399, 12, 30), date(2021, 3, 20)),
+    ((1402, 10, 11), date(2024, 1, 1)),
+])
+def test_jalali_to_gregorian(jalali, gregorian):
+    assert jalali_to_gregorian(*jalali) == gregorian
+
+@pytest.mark.parametrize('year, month, days', [
+    (1404, 1, 31),
+    (1404, 6, 31),
+    (1404, 7, 30),
+    (1404, 11, 30),
+    (1403, 12, 30),  # leap
+    (1399, 12, 30),  # leap
+    (1402, 12, 29),
+    (1400, 12, 29),
+])
+def test_jalali_month_days(year, month, days):
+    assert jalali_month_days(year, month) == days
+
+@pytest.mark.parametrize('text, day', [
+    ('۲۵ تیر ۱۴۰۴ ساعت ۱۰', '2025-07-16'),
+    ('شنبه 25 تیر 1404', '2025-07-16'),
+    ('1404/04/25 - 16:00', '2025-07-16'),
+    ('۱۴۰۴/۴/۲۵', '2025-07-16'),
+    ('2025-07-16 10:00', '2025-07-16'),
+    ('۳۰ اسفند ۱۴۰۳', '2025-03-20'),
+])
+def test_parse_slot_day(text, day):
+    assert parse_slot_day(text) == day
+
+@pytest.mark.parametrize('text', [
+    'شنبه ساعت ۱۰',
+    '',
+    None,
+    '31 مهر 1404',  # Mehr has 30 days
+    '30 اسفند 1402',  # not a leap year
+    '1404/13/01',
+    '1404/04/00',
+    '2025-02-30',
+])
+def test_parse_slot_day_without_a_valid_date(text):
+    assert parse_slot_day(text) is None
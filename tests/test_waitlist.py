@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import sqlite3
+from datetime import date, datetime, timedelta
+
+import pytest
+
+def _slot_text(days_ahead):
+    return f"{(date.today() + timedelta(days=days_ahead)).isoformat()} ساعت ۱۶"
+
+def _slot_id(db, slot_text):
+    conn = sqlite3.connect(db.db_name)
+    try:
+        return conn.execute('SELECT id FROM slots WHERE slot_text = ?', (slot_text,)).fetchone()[0]
+    finally:
+        conn.close()
+
+def _expire_holds(db):
+    conn = sqlite3.connect(db.db_name)
+    try:
+        conn.execute('UPDATE slot_holds SET expires_at = ?', (datetime.now() - timedelta(minutes=1),))
+        conn.commit()
+    finally:
+        conn.close()
+
+def test_slot_without_waiters_is_available(db):
+    assert db.add_slot(_slot_text(3)) is None
+    assert [text for _, text in db.get_available_slots()] == [_slot_text(3)]
+
+def test_first_waiter_whose_range_covers_the_day_gets_the_hold(db):
+    db.join_waitlist(1, 7)
+    db.join_waitlist(2, 30)
+    db.join_waitlist(3)
+
+    user_id, slot_id, slot_text = db.add_slot(_slot_text(20))
+    # User 1 only waits for the next 7 days
+    assert (user_id, slot_text) == (2, _slot_text(20))
+    assert db.get_available_slots() == []
+    assert db.get_slot_hold(slot_id) == (2, _slot_text(20))
+    assert not db.is_on_waitlist(2)
+    assert db.is_on_waitlist(1) and db.is_on_waitlist(3)
+
+def test_earlier_any_time_entry_goes_first(db):
+    db.join_waitlist(1)
+    db.join_waitlist(2, 7)
+    assert db.add_slot(_slot_text(2))[0] == 1
+    assert db.add_slot(_slot_text(2) + ' ۱۸')[0] == 2
+
+def test_slot_without_a_date_only_goes_to_any_time_entries(db):
+    db.join_waitlist(1, 30)
+    assert db.add_slot('شنبه ساعت ۱۰') is None
+    db.join_waitlist(2)
+    assert db.add_slot('یکشنبه ساعت ۱۰')[0] == 2
+
+def test_past_slot_is_not_offered(db):
+    db.join_waitlist(1)
+    assert db.add_slot(_slot_text(-1)) is None
+
+def test_joining_again_moves_to_the_back(db):
+    db.join_waitlist(1, 7)
+    db.join_waitlist(2, 7)
+    db.join_waitlist(1, 30)
+    assert db.add_slot(_slot_text(1))[0] == 2
+
+def test_unoffered_range_is_rejected(db):
+    with pytest.raises(ValueError):
+        db.join_waitlist(1, 9999)
+
+def test_only_the_holder_can_book_a_held_slot(db):
+    db.join_waitlist(1)
+    _, slot_id, _ = db.add_slot(_slot_text(3))
+    assert db.create_reservation(2, slot_id) is None
+    assert db.create_reservation(1, slot_id) is not None
+    assert db.get_slot_hold(slot_id) is None
+
+def test_expired_hold_passes_to_the_next_waiter(db):
+    db.join_waitlist(1)
+    db.join_waitlist(2, 7)
+    _, slot_id, _ = db.add_slot(_slot_text(3))
+
+    _expire_holds(db)
+    assert db.expire_slot_holds() == [(2, slot_id, _slot_text(3))]
+    assert db.create_reservation(1, slot_id) is None
+
+    _expire_holds(db)
+    assert db.expire_slot_holds() == []
+    assert db.get_available_slots() == [(slot_id, _slot_text(3))]
+
+def test_rejected_reservation_frees_the_slot_once(db):
+    slot_text = _slot_text(5)
+    db.add_slot(slot_text)
+    slot_id = _slot_id(db, slot_text)
+    reservation_id = db.create_reservation(1, slot_id)
+    db.join_waitlist(2)
+
+    assert db.reject_reservation(reservation_id) == (True, (2, slot_id, slot_text))
+    # A second admin tapping reject must not free the slot again
+    db.join_waitlist(3)
+    assert db.reject_reservation(reservation_id) == (False, None)
+    assert not db.confirm_reservation(reservation_id)
+    assert db.get_slot_hold(slot_id) == (2, slot_text)
+
+def test_confirmed_reservation_is_not_cancelled_as_expired(db):
+    slot_text = _slot_text(5)
+    db.add_slot(slot_text)
+    slot_id = _slot_id(db, slot_text)
+    reservation_id = db.create_reservation(1, slot_id)
+
+    assert db.confirm_reservation(reservation_id)
+    assert db.cancel_expired_reservation(reservation_id, slot_id) is None
+    assert db.get_reservation_by_id(reservation_id)[3] == 'confirmed'
+    assert db.get_available_slots() == []
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import time
+import random
+import pstats
+import cProfile
+import logging
+import threading
+from functools import wraps
+from telegram import Update
+from database import get_database
+from config import TRACING_CONFIG
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_sample_rate = 0.0
+# Only one profiler may be active per interpreter on newer Pythons
+_profile_lock = threading.Lock()
+
+class UpdateTrace:
+    """Time spent on one update, split into database, Telegram API and handler code"""
+
+    def __init__(self, update):
+        self.update = update
+        self.started = time.perf_counter()
+        self.db_time = 0.0
+        self.db_calls = 0
+        self.api_time = 0.0
+        self.api_calls = 0
+        # Kind of the outermost timed call in progress, so nested calls are not counted twice
+        self.active = None
+        self.profile = None
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+def _describe_update(update):
+    """Return the update kind and the command or callback_data that triggered it"""
+    if update.callback_query:
+        return 'callback', update.callback_query.data
+    message = update.effective_message
+    if message and message.text and message.text.startswith('/'):
+        return 'command', message.text.split()[0]
+    if message and message.photo:
+        return 'photo', None
+    if message:
+        return 'message', None
+    return 'other', None
+
+def begin_update_trace(update):
+    """Start timing the update on this thread and maybe profile it"""
+    trace = UpdateTrace(update)
+    if _sample_rate and random.random() < _sample_rate and _profile_lock.acquire(blocking=False):
+        trace.profile = cProfile.Profile()
+        trace.profile.enable()
+    _local.trace = trace
+    return trace
+
+def end_update_trace(trace):
+    """Stop timing the update and log it if it was slower than the threshold"""
+    _local.trace = None
+    if trace.profile:
+        trace.profile.disable()
+        _profile_lock.release()
+
+    update = trace.update
+    total = time.perf_counter() - trace.started
+    if total * 1000 < TRACING_CONFIG['slow_update_ms']:
+        return
+
+    kind, data = _describe_update(update)
+    record = {
+        'update_id': update.update_id,
+        'kind': kind,
+        'data': data,
+        'user_id': update.effective_user.id if update.effective_user else None,
+        'total_ms': round(total * 1000, 1),
+        'db_ms': round(trace.db_time * 1000, 1),
+        'db_calls': trace.db_calls,
+        'api_ms': round(trace.api_time * 1000, 1),
+        'api_calls': trace.api_calls,
+        'handler_ms': round(max(0.0, total - trace.db_time - trace.api_time) * 1000, 1)
+    }
+    logger.warning(f"Slow update: {json.dumps(record, ensure_ascii=False)}")
+
+    if trace.profile:
+        output = io.StringIO()
+        stats = pstats.Stats(trace.profile, stream=output)
+        stats.sort_stats('cumulative').print_stats(TRACING_CONFIG['profile_top_n'])
+        logger.warning(f"Profile of slow update {update.update_id}:\n{output.getvalue()}")
+
+def _traced(process_update):
+    @wraps(process_update)
+    def wrapper(update):
+        if not isinstance(update, Update):
+            return process_update(update)
+        trace = begin_update_trace(update)
+        try:
+            return process_update(update)
+        finally:
+            # Also after DispatcherHandlerStop or an error, so the profiler is never left running
+            end_update_trace(trace)
+    return wrapper
+
+def _timed(func, kind):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        trace = current_trace()
+        if trace is None or trace.active:
+            return func(*args, **kwargs)
+        trace.active = kind
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            trace.active = None
+            elapsed = time.perf_counter() - started
+            if kind == 'db':
+                trace.db_time += elapsed
+                trace.db_calls += 1
+            else:
+                trace.api_time += elapsed
+                trace.api_calls += 1
+    return wrapper
+
+def _instrument_database(db):
+    for name in dir(db):
+        if name.startswith('_') or not callable(getattr(db, name)):
+            continue
+        setattr(db, name, _timed(getattr(db, name), 'db'))
+
+def _instrument_bot(bot):
+    request = bot.request
+    # Request only allows new attributes with a deprecation warning, bypass it
+    object.__setattr__(request, '_request_wrapper', _timed(request._request_wrapper, 'api'))
+
+def get_profiling_sample_rate():
+    """Fraction of updates profiled with cProfile"""
+    return _sample_rate
+
+def set_profiling_sample_rate(rate):
+    """Change the profiling sample rate at runtime and remember it across restarts"""
+    global _sample_rate
+    _sample_rate = max(0.0, min(1.0, rate))
+    get_database().set_setting('profiling_sample_rate', str(_sample_rate))
+    logger.info(f"Update profiling sample rate set to {_sample_rate:.0%}")
+
+def install_update_tracing(dispatcher):
+    """Time every update the dispatcher handles, attributing database and Telegram API time to it"""
+    global _sample_rate
+    db = get_database()
+    try:
+        _sample_rate = float(db.get_setting('profiling_sample_rate') or 0)
+    except ValueError:
+        _sample_rate = 0.0
+
+    _instrument_database(db)
+    _instrument_bot(dispatcher.bot)
+
+    # With ChatOrderedDispatcher, process_update only queues the update; time the worker that handles it
+    name = 'run_update' if hasattr(dispatcher, 'run_update') else 'process_update'
+    setattr(dispatcher, name, _traced(getattr(dispatcher, name)))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from database import get_database
+from callback_router import encode_callback
+from analytics import record_event
+from send_queue import queue_send
+from config import PERSIAN_TEXTS, WAITLIST_CONFIG
+
+logger = logging.getLogger(__name__)
+
+def notify_slot_offers(bot, holds):
+    """Tell each waitlisted user that a slot is held for them, with a button that books it.
+
+    holds are the (user_id, slot_id, slot_text) returned by the database
+    methods that free slots; None entries, for slots that went to nobody, are skipped.
+    """
+    db = get_database()
+    offer_template = db.get_setting('booking_waitlist_offer') or PERSIAN_TEXTS['booking_waitlist_offer']
+    button_text = db.get_setting('booking_waitlist_offer_button') or PERSIAN_TEXTS['booking_waitlist_offer_button']
+
+    for hold in holds:
+        if not hold:
+            continue
+        user_id, slot_id, slot_text = hold
+        try:
+            queue_send(
+                bot.send_message, user_id,
+                text=offer_template.format(slot_text=slot_text, hold_minutes=WAITLIST_CONFIG['hold_minutes']),
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton(button_text, callback_data=encode_callback('book_slot', slot_id))
+                ]])
+            )
+            record_event('waitlist_offer', user_id)
+            logger.info(f"Offered slot {slot_id} to waitlisted user {user_id}")
+        except Exception as e:
+            logger.error(f"Error offering slot {slot_id} to user {user_id}: {e}")
+
+def expire_slot_holds(bot):
+    """Scheduler job: pass slots whose hold ran out to the next waiting user"""
+    notify_slot_offers(bot, get_database().expire_slot_holds())